@@ -0,0 +1,119 @@
+# @Author: Humberto Alejandro Ortega Alcocer
+# @Date: 2024-Junio-24
+# @Description: Compara llamadas individuales vs. micro-batching de predicciones contra un SkyPrice local simulado.
+# @Usage: python benchmarks/bench_batching.py [--requests 200] [--window 0.01] [--batch-size 16] [--latency 0.05]
+# @License: MIT
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+
+os.environ.setdefault('OPENAI_API_KEY', 'benchmark')
+os.environ.setdefault('SKYPRICE_EXTRACTION_CACHE_PATH', '')
+os.environ.setdefault('SKYPRICE_STATE_PATH', '')
+os.environ.setdefault('SKYPRICE_COMPARABLES_PATH', '')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import logging
+
+import httpx
+
+import skyprice_bot
+from fake_backends import FakeSkyPrice, fake_price
+from skyprice_batch import PredictionBatcher, percentile
+from skyprice_models import ApartmentDetails
+
+
+def random_details(rng):
+    """Build a random (distinct) apartment so the prediction cache never hits."""
+    size = rng.randint(40, 300)
+    return ApartmentDetails(size, size, rng.randint(1, 5), rng.randint(1, 4), rng.randint(0, 3), rng.randint(0, 60),
+                            19.3 + rng.random() * 0.2, -99.25 + rng.random() * 0.2, 'Benito Juárez')
+
+
+async def run_scenario(name, server, batcher, apartments):
+    """Predict every apartment concurrently and check the results against the fake models."""
+    skyprice_bot.prediction_cache.invalidate()
+    skyprice_bot.prediction_batcher = batcher
+    requests_before = server.requests
+    latencies = []
+
+    async def predict(details):
+        started = time.perf_counter()
+        prediction = await skyprice_bot.predict_price(details)
+        latencies.append(time.perf_counter() - started)
+        return prediction
+
+    started = time.perf_counter()
+    predictions = await asyncio.gather(*(predict(details) for details in apartments))
+    elapsed = time.perf_counter() - started
+
+    correct = sum(
+        prediction.__dict__ == {
+            'Random_Forest': expected['random_forest'], 'SVM': expected['svm'], 'Neural_Network': expected['neural_network'],
+        }
+        for prediction, expected in ((p, fake_price(d.__dict__)) for p, d in zip(predictions, apartments))
+    )
+    result = {
+        'scenario': name,
+        'requests': len(apartments),
+        'correct': correct,
+        'upstream_calls': server.requests - requests_before,
+        'elapsed_s': round(elapsed, 3),
+        'p50_s': round(percentile(latencies, 0.50), 4),
+        'p99_s': round(percentile(latencies, 0.99), 4),
+    }
+    if batcher is not None:
+        stats = batcher.stats()
+        result.update({
+            'mean_batch_size': round(stats['mean_batch_size'], 2),
+            'added_latency_p50_s': round(stats['added_latency_p50_s'], 4),
+            'added_latency_p99_s': round(stats['added_latency_p99_s'], 4),
+        })
+    return result
+
+
+async def run(args):
+    server = await FakeSkyPrice(latency=args.latency).start()
+    skyprice_bot.SKYPRICE_API_URL = f'{server.url}/predict'
+    skyprice_bot.SKYPRICE_BATCH_API_URL = f'{server.url}/predict/batch'
+    skyprice_bot.http_client = httpx.AsyncClient(limits=httpx.Limits(max_connections=args.requests))
+
+    rng = random.Random(args.seed)
+    apartments = [random_details(rng) for _ in range(args.requests)]
+    batcher = PredictionBatcher(skyprice_bot.fetch_price_predictions, window=args.window, max_batch_size=args.batch_size)
+    try:
+        results = [
+            await run_scenario('single-requests', server, None, apartments),
+            await run_scenario('micro-batching', server, batcher, apartments),
+        ]
+    finally:
+        await skyprice_bot.http_client.aclose()
+        await server.stop()
+
+    for result in results:
+        print(json.dumps(result))
+    single, batched = results
+    ok = batched['correct'] == single['correct'] == args.requests and batched['upstream_calls'] < single['upstream_calls']
+    print(json.dumps({'upstream_call_reduction': round(1 - batched['upstream_calls'] / single['upstream_calls'], 3), 'ok': ok}))
+    return ok
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Benchmark micro-batched SkyPrice predictions against a local fake server.')
+    parser.add_argument('--requests', type=int, default=200, help='Concurrent predictions.')
+    parser.add_argument('--window', type=float, default=0.01, help='Batch window in seconds.')
+    parser.add_argument('--batch-size', type=int, default=16, help='Maximum batch size.')
+    parser.add_argument('--latency', type=float, default=0.05, help='Fake SkyPrice latency in seconds.')
+    parser.add_argument('--seed', type=int, default=7, help='Random seed for the synthetic apartments.')
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+    sys.exit(0 if asyncio.run(run(args)) else 1)
+
+
+if __name__ == '__main__':
+    main()
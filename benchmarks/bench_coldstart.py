@@ -0,0 +1,153 @@
+# @Author: Humberto Alejandro Ortega Alcocer
+# @Date: 2024-Junio-24
+# @Description: Mide el arranque en frío del punto de entrada serverless y desglosa el tiempo de importación por paquete.
+# @Usage: python benchmarks/bench_coldstart.py [--cold-starts 5] [--warm 20] [--top 10]
+# @License: MIT
+import argparse
+import asyncio
+import json
+import os
+import re
+import statistics
+import sys
+import tempfile
+import time
+
+from fake_backends import FakeSkyPrice, FakeTelegram, synthetic_update
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# Mensaje que el fast path resuelve sin LLM, como la mayoría de los anuncios completos
+MESSAGE = '{size} m2, 2 recámaras, 1 baño, 1 estacionamiento, 10 años, Benito Juárez'
+
+# Línea de python -X importtime: "import time: <self us> | <cumulative us> | <indentación><módulo>"
+IMPORTTIME_RE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( +)(\S+)$')
+
+def child(args) -> None:
+    """One instance lifetime: import the entry point, handle a cold update, then warm ones."""
+    started = time.perf_counter()
+    import skyprice_serverless
+    import_s = time.perf_counter() - started
+
+    def invoke(sequence: int) -> float:
+        event = {'body': json.dumps(synthetic_update(sequence, 1000, MESSAGE.format(size=40 + sequence))), 'headers': {}}
+        started = time.perf_counter()
+        response = skyprice_serverless.handler(event)
+        if response['statusCode'] != 200:
+            raise RuntimeError(f'Update {sequence} failed with {response["statusCode"]}')
+        return time.perf_counter() - started
+
+    first_s = invoke(1)
+    warm = [invoke(sequence) for sequence in range(2, args.warm + 2)]
+    openai_loaded = 'openai' in sys.modules
+
+    # Lo que costaría construir el cliente de OpenAI al importar (como antes de cargarlo de forma diferida)
+    started = time.perf_counter()
+    import skyprice_bot
+    skyprice_bot.create_openai_client()
+    openai_client_s = time.perf_counter() - started
+
+    print(json.dumps({
+        'import_s': import_s,
+        'first_update_s': first_s,
+        'init_s': skyprice_serverless.stats()['init_s'],
+        'warm_p50_s': statistics.median(warm),
+        'warm_max_s': max(warm),
+        'openai_loaded': openai_loaded,
+        'openai_client_s': openai_client_s,
+    }))
+
+async def run_process(command: list, env: dict) -> tuple:
+    """Run a Python subprocess and return its stdout, stderr and wall time."""
+    started = time.perf_counter()
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, *command, cwd=ROOT, env=env, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+    )
+    stdout, stderr = await process.communicate()
+    if process.returncode:
+        raise RuntimeError(stderr.decode('utf-8', 'replace')[-2000:])
+    return stdout.decode('utf-8'), stderr.decode('utf-8'), time.perf_counter() - started
+
+def import_breakdown(stderr: str, module: str, top: int) -> list:
+    """Return the packages imported directly by ``module`` with their cumulative import time."""
+    totals, depth = {}, None
+    for line in stderr.splitlines():
+        match = IMPORTTIME_RE.match(line)
+        if match is None:
+            continue
+        if match[4] == module:
+            totals[f'{module} (own)'] = int(match[1])
+            depth = len(match[3])
+    # importtime lista a los hijos antes que al padre, dos espacios más adentro
+    for line in stderr.splitlines():
+        match = IMPORTTIME_RE.match(line)
+        if match is not None and depth is not None and len(match[3]) == depth + 2:
+            package = match[4].split('.')[0]
+            totals[package] = totals.get(package, 0) + int(match[2])
+    ordered = sorted(totals.items(), key=lambda item: item[1], reverse=True)[:top]
+    return [{'module': name, 'ms': round(us / 1000, 1)} for name, us in ordered]
+
+async def run(args) -> bool:
+    telegram = await FakeTelegram().start()
+    skyprice = await FakeSkyPrice().start()
+    state_dir = tempfile.mkdtemp(prefix='skyprice-coldstart-')
+    env = dict(
+        os.environ,
+        OPENAI_API_KEY='benchmark',
+        TELEGRAM_TOKEN='123:benchmark',
+        TELEGRAM_API_BASE_URL=f'{telegram.url}/bot',
+        SKYPRICE_API_URL=f'{skyprice.url}/predict',
+        SKYPRICE_EXTRACTION_CACHE_PATH='',
+        SKYPRICE_PREDICTION_CACHE_TTL='0',
+        SKYPRICE_STATE_PATH=os.path.join(state_dir, 'state.sqlite3'),
+        SKYPRICE_COMPARABLES_PATH=os.path.join(state_dir, 'comparables.sqlite3'),
+        PYTHONPATH=ROOT,
+    )
+    try:
+        # Desglose del tiempo de importación del bot (un proceso nuevo, con bytecode ya compilado)
+        await run_process(['-c', 'import skyprice_bot'], env)
+        _, stderr, _ = await run_process(['-X', 'importtime', '-c', 'import skyprice_bot'], env)
+        breakdown = import_breakdown(stderr, 'skyprice_bot', args.top)
+        print(json.dumps({'import_breakdown': breakdown}))
+
+        runs = []
+        for _ in range(args.cold_starts):
+            stdout, _, wall_s = await run_process([os.path.abspath(__file__), '--child', '--warm', str(args.warm)], env)
+            runs.append(dict(json.loads(stdout.strip().splitlines()[-1]), process_s=wall_s))
+    finally:
+        await telegram.stop()
+        await skyprice.stop()
+
+    def median_ms(key: str) -> float:
+        return round(statistics.median(run[key] for run in runs) * 1000, 1)
+
+    result = {
+        'cold_starts': len(runs),
+        'process_ms': median_ms('process_s'),
+        'entry_import_ms': median_ms('import_s'),
+        'first_update_ms': median_ms('first_update_s'),
+        'bot_init_ms': median_ms('init_s'),
+        'warm_p50_ms': median_ms('warm_p50_s'),
+        'warm_max_ms': median_ms('warm_max_s'),
+        'openai_deferred_ms': median_ms('openai_client_s'),
+        'openai_loaded_on_fast_path': any(run['openai_loaded'] for run in runs),
+        'skyprice_requests': skyprice.requests,
+        'telegram_calls': dict(telegram.calls),
+    }
+    print(json.dumps(result))
+    return not result['openai_loaded_on_fast_path']
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Measure the cold start of the serverless entry point.')
+    parser.add_argument('--cold-starts', type=int, default=5, help='Fresh processes (cold instances) to measure.')
+    parser.add_argument('--warm', type=int, default=20, help='Warm invocations after each cold one.')
+    parser.add_argument('--top', type=int, default=10, help='Packages shown in the import-time breakdown.')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        child(args)
+        return
+    sys.exit(0 if asyncio.run(run(args)) else 1)
+
+if __name__ == '__main__':
+    main()
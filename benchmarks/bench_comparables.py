@@ -0,0 +1,130 @@
+# @Author: Humberto Alejandro Ortega Alcocer
+# @Date: 2024-Junio-24
+# @Description: Mide la ingesta y la latencia de las consultas del almacén de comparables con millones de valuaciones sintéticas.
+# @Usage: python benchmarks/bench_comparables.py [--records 1000000] [--queries 1000] [--cell 0.0025] [--path comparables.sqlite3]
+# @License: MIT
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from skyprice_batch import percentile
+from skyprice_comparables import ComparablesStore
+from skyprice_geo import gazetteer, haversine_km
+
+
+def random_valuation(rng, places):
+    """Build a random valuation around a gazetteer place, so the density follows the colonias."""
+    place = rng.choice(places)
+    size = rng.randint(35, 300)
+    price = size * rng.uniform(20000, 90000)
+    details = {
+        'Size_Terrain': size, 'Size_Construction': size, 'Rooms': rng.randint(1, 5), 'Bathrooms': rng.randint(1, 4),
+        'Parking': rng.randint(0, 3), 'Age': rng.randint(0, 60), 'Lat': place.lat + rng.gauss(0, 0.01),
+        'Lng': place.lng + rng.gauss(0, 0.01), 'Municipality': place.municipality,
+    }
+    return details, {'Random_Forest': price, 'SVM': price * 1.02, 'Neural_Network': price * 0.98}
+
+
+def timed(function, *args, **kwargs):
+    started = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - started
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Benchmark the comparables store (grid index on SQLite) at millions of valuations.')
+    parser.add_argument('--records', type=int, default=1000000, help='Synthetic valuations to load.')
+    parser.add_argument('--queries', type=int, default=1000, help='Queries of each kind to time.')
+    parser.add_argument('--appends', type=int, default=20000, help='Valuations appended through the handler path (background writer).')
+    parser.add_argument('--cell', type=float, default=0.0025, help='Grid cell size in degrees.')
+    parser.add_argument('--k', type=int, default=5, help='Comparables per query.')
+    parser.add_argument('--radius', type=float, default=1.0, help='Radius (km) of the price per m² statistics.')
+    parser.add_argument('--verify', type=int, default=3, help='Queries checked against a brute-force scan.')
+    parser.add_argument('--path', default=None, help='SQLite file (a temporary file by default).')
+    parser.add_argument('--seed', type=int, default=7, help='Random seed for the synthetic valuations.')
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    places = list(gazetteer.colonias) + list(gazetteer.municipalities.values())
+    directory = None
+    if args.path is None:
+        directory = tempfile.TemporaryDirectory()
+        args.path = os.path.join(directory.name, 'comparables.sqlite3')
+    store = ComparablesStore(args.path, cell_size=args.cell)
+
+    # Carga inicial en lotes (como una importación), guardando los puntos para la verificación
+    points = []
+    started = time.perf_counter()
+    while len(points) < args.records:
+        chunk = [random_valuation(rng, places) for _ in range(min(50000, args.records - len(points)))]
+        store.extend(store.row(details, prediction) for details, prediction in chunk)
+        points.extend((details, prediction) for details, prediction in chunk)
+    load_s = time.perf_counter() - started
+
+    # Ingesta desde el handler: append solo encola, el hilo escribe en lotes
+    appended = [random_valuation(rng, places) for _ in range(args.appends)]
+    append_latencies = []
+    started = time.perf_counter()
+    for details, prediction in appended:
+        _, elapsed = timed(store.append, details, prediction)
+        append_latencies.append(elapsed)
+    _, flush_s = timed(store.flush)
+    writer_s = time.perf_counter() - started
+    points.extend(appended)
+
+    queries = [random_valuation(rng, places)[0] for _ in range(args.queries)]
+    nearest_latencies, stats_latencies, found, counts = [], [], 0, []
+    for details in queries:
+        result, elapsed = timed(store.nearest, details['Lat'], details['Lng'], args.k, size=details['Size_Construction'], rooms=details['Rooms'])
+        nearest_latencies.append(elapsed)
+        found += len(result)
+        stats, elapsed = timed(store.area_stats, details['Lat'], details['Lng'], args.radius)
+        stats_latencies.append(elapsed)
+        counts.append(stats['count'])
+
+    # Verificación contra un recorrido completo
+    correct = 0
+    for details in queries[:args.verify]:
+        lat, lng, size, rooms = details['Lat'], details['Lng'], details['Size_Construction'], details['Rooms']
+        expected = sorted(
+            haversine_km(lat, lng, other['Lat'], other['Lng']) for other, _ in points
+            if size * 0.75 <= other['Size_Construction'] <= size * 1.25 and rooms - 1 <= other['Rooms'] <= rooms + 1
+        )
+        expected = [round(distance, 9) for distance in expected if distance <= 5.0][:args.k]
+        got = [round(result['distance_km'], 9) for result in store.nearest(lat, lng, args.k, size=size, rooms=rooms)]
+        correct += got == expected
+
+    total = store.count()
+    store.close()
+    if directory is not None:
+        directory.cleanup()
+
+    result = {
+        'records': total,
+        'cell': args.cell,
+        'load_s': round(load_s, 2),
+        'load_rows_per_s': round(args.records / load_s),
+        'append_p50_us': round(percentile(append_latencies, 0.50) * 1e6, 2),
+        'append_p99_us': round(percentile(append_latencies, 0.99) * 1e6, 2),
+        'appends_per_s_written': round(args.appends / writer_s) if args.appends else 0,
+        'flush_s': round(flush_s, 3),
+        'nearest_p50_ms': round(percentile(nearest_latencies, 0.50) * 1e3, 3),
+        'nearest_p99_ms': round(percentile(nearest_latencies, 0.99) * 1e3, 3),
+        'mean_comparables': round(found / max(1, len(queries)), 2),
+        'area_stats_p50_ms': round(percentile(stats_latencies, 0.50) * 1e3, 3),
+        'area_stats_p99_ms': round(percentile(stats_latencies, 0.99) * 1e3, 3),
+        'mean_area_count': round(sum(counts) / max(1, len(counts)), 1),
+        'verified': f'{correct}/{min(args.verify, len(queries))}',
+    }
+    print(json.dumps(result))
+    sys.exit(0 if correct == min(args.verify, len(queries)) else 1)
+
+
+if __name__ == '__main__':
+    main()
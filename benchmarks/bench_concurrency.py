@@ -0,0 +1,184 @@
+# @Author: Humberto Alejandro Ortega Alcocer
+# @Date: 2024-Junio-24
+# @Description: Benchmark de rendimiento de handle_message contra backends simulados (OpenAI y SkyPrice).
+# @Usage: python benchmarks/bench_concurrency.py [--messages 64] [--llm-latency 0.5] [--api-latency 0.2]
+# @License: MIT
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from types import SimpleNamespace
+
+# Allow running the benchmark from the repository root without a real API key
+os.environ.setdefault('OPENAI_API_KEY', 'benchmark')
+os.environ.setdefault('SKYPRICE_EXTRACTION_CACHE_PATH', '')
+os.environ.setdefault('SKYPRICE_STATE_PATH', '')
+os.environ.setdefault('SKYPRICE_COMPARABLES_PATH', '')
+os.environ.setdefault('SKYPRICE_EXTRACTION_STREAM', '0')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import logging
+
+from telegram.ext import SimpleUpdateProcessor
+
+import skyprice_bot
+
+# Respuesta simulada de OpenAI con todos los campos requeridos
+FAKE_DETAILS = {
+    'Size_Terrain': 100, 'Size_Construction': 80, 'Rooms': 2, 'Bathrooms': 1, 'Parking': 1,
+    'Age': 10, 'Lat': 19.3727, 'Lng': -99.1564, 'Municipality': 'Benito Juárez',
+}
+
+# Respuesta simulada de SkyPrice
+FAKE_PREDICTION = {'random_forest': 3500000.0, 'svm': 3400000.0, 'neural_network': 3600000.0}
+
+
+class FakeCompletions:
+    """Stand-in for the OpenAI chat completions endpoint."""
+
+    def __init__(self, latency, blocking):
+        self.latency = latency
+        self.blocking = blocking
+
+    async def create(self, **kwargs):
+        if self.blocking:
+            # Reproduces the previous synchronous client: the event loop is frozen while waiting
+            time.sleep(self.latency)
+        else:
+            await asyncio.sleep(self.latency)
+        message = SimpleNamespace(content=json.dumps(FAKE_DETAILS))
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)])
+
+
+class FakeOpenAI:
+    """Stand-in for the OpenAI client."""
+
+    def __init__(self, latency, blocking):
+        self.chat = SimpleNamespace(completions=FakeCompletions(latency, blocking))
+
+    async def close(self):
+        pass
+
+
+class FakeResponse:
+    """Stand-in for an HTTP response from SkyPrice."""
+
+    status_code = 200
+
+    def raise_for_status(self):
+        return self
+
+    def json(self):
+        return dict(FAKE_PREDICTION)
+
+
+class FakeHTTPClient:
+    """Stand-in for the SkyPrice HTTP client."""
+
+    def __init__(self, latency, blocking):
+        self.latency = latency
+        self.blocking = blocking
+
+    async def post(self, url, json=None, **kwargs):
+        if self.blocking:
+            # Reproduces the previous requests.post call
+            time.sleep(self.latency)
+        else:
+            await asyncio.sleep(self.latency)
+        return FakeResponse()
+
+    async def aclose(self):
+        pass
+
+
+class FakeMessage:
+    """Minimal Telegram message that records the replies instead of sending them."""
+
+    def __init__(self, text, user_id):
+        self.text = text
+        self.from_user = SimpleNamespace(id=user_id, first_name=f'bench-{user_id}')
+        self.replies = []
+
+    async def reply_text(self, text, **kwargs):
+        self.replies.append(text)
+
+
+def build_update(index):
+    """Build a synthetic update carrying a valuation request."""
+    message = FakeMessage(
+        'el departamento tiene 100 m² de terreno, 80 m² de construcción, 2 habitaciones, 1 baño, '
+        f'1 estacionamiento, 10 años de antigüedad y está en la alcaldía Benito Juárez #{index}',
+        index,
+    )
+    return SimpleNamespace(message=message)
+
+
+async def run_scenario(name, messages, concurrency, llm_latency, api_latency, blocking):
+    """Process the synthetic updates and return the scenario results."""
+    skyprice_bot.client = FakeOpenAI(llm_latency, blocking)
+    skyprice_bot.http_client = FakeHTTPClient(api_latency, blocking)
+    skyprice_bot.extraction_cache.invalidate()
+    skyprice_bot.prediction_cache.invalidate()
+    # Measure the backend round-trips, not the local fast path
+    skyprice_bot.parse_apartment_details = lambda text: dict.fromkeys(skyprice_bot.APARTMENT_FIELDS)
+
+    processor = SimpleUpdateProcessor(concurrency)
+    await processor.initialize()
+
+    updates = [build_update(i) for i in range(messages)]
+    latencies = []
+
+    async def handle(update):
+        started = time.perf_counter()
+        context = SimpleNamespace(user_data={})
+        await skyprice_bot.handle_message(update, context)
+        latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(processor.process_update(update, handle(update)) for update in updates))
+    elapsed = time.perf_counter() - started
+    await processor.shutdown()
+
+    # Every message must have produced a price estimate
+    completed = sum(1 for update in updates if any('💰' in reply for reply in update.message.replies))
+    latencies.sort()
+    return {
+        'scenario': name,
+        'messages': messages,
+        'completed': completed,
+        'concurrency': concurrency,
+        'elapsed_s': round(elapsed, 3),
+        'throughput_msg_s': round(messages / elapsed, 2),
+        'p50_s': round(latencies[len(latencies) // 2], 3),
+        'max_s': round(latencies[-1], 3),
+    }
+
+
+async def run(args):
+    """Run the blocking (before) and non-blocking (after) scenarios."""
+    results = [
+        await run_scenario('blocking-clients', args.messages, args.concurrency, args.llm_latency, args.api_latency, True),
+        await run_scenario('async-clients', args.messages, args.concurrency, args.llm_latency, args.api_latency, False),
+    ]
+    for result in results:
+        print(json.dumps(result))
+    speedup = results[1]['throughput_msg_s'] / results[0]['throughput_msg_s']
+    print(json.dumps({'speedup': round(speedup, 2)}))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Benchmark handle_message throughput against stubbed backends.')
+    parser.add_argument('--messages', type=int, default=64, help='Number of synthetic valuation messages.')
+    parser.add_argument('--concurrency', type=int, default=skyprice_bot.MAX_CONCURRENT_UPDATES, help='Concurrent update limit.')
+    parser.add_argument('--llm-latency', type=float, default=0.5, help='Simulated OpenAI latency in seconds.')
+    parser.add_argument('--api-latency', type=float, default=0.2, help='Simulated SkyPrice latency in seconds.')
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+    asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+# @Author: Humberto Alejandro Ortega Alcocer
+# @Date: 2024-Junio-24
+# @Description: Simula usuarios escribiendo consultas inline tecla por tecla y mide respuestas, llamadas al LLM canceladas y aciertos de caché.
+# @Usage: python benchmarks/bench_inline.py [--users 20] [--keystroke-interval 0.12] [--debounce 0.4] [--deadline 8]
+# @License: MIT
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+
+# Allow running the benchmark from the repository root without a real API key
+os.environ.setdefault('OPENAI_API_KEY', 'benchmark')
+os.environ.setdefault('SKYPRICE_EXTRACTION_CACHE_PATH', '')
+os.environ.setdefault('SKYPRICE_STATE_PATH', '')
+os.environ.setdefault('SKYPRICE_COMPARABLES_PATH', '')
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+import logging
+
+import httpx
+from openai import AsyncOpenAI
+from telegram import Update
+
+import skyprice_bot
+from fake_backends import FakeOpenAI, FakeSkyPrice, FakeTelegram, synthetic_inline_query
+from skyprice_batch import percentile
+
+# Anuncio sin antigüedad: el extractor local no lo resuelve y cada consulta completa llega al LLM
+LISTING = 'Depto de {size} m2 con 2 recámaras, 1 baño y 1 estacionamiento en Narvarte, muy bien ubicado'
+
+# Escenarios: sin debounce ni caché (cada tecla inicia una valuación) contra la configuración dada
+SCENARIOS = ('no-debounce', 'debounced')
+
+class Harness:
+    """Application with the real handlers against fake Telegram, OpenAI and SkyPrice servers."""
+
+    def __init__(self, args):
+        self.args = args
+        self.next_update_id = 1
+        self.next_user_id = 1000
+        self.sent = {}
+
+    async def start(self) -> None:
+        args = self.args
+        self.telegram = await FakeTelegram().start()
+        self.openai = await FakeOpenAI(latency=args.llm_latency, token_latency=args.llm_token_latency).start()
+        self.skyprice = await FakeSkyPrice(latency=args.api_latency).start()
+        skyprice_bot.client = AsyncOpenAI(api_key='benchmark', base_url=f'{self.openai.url}/v1', max_retries=0)
+        skyprice_bot.http_client = httpx.AsyncClient(timeout=10.0)
+        skyprice_bot.SKYPRICE_API_URL = f'{self.skyprice.url}/predict'
+        skyprice_bot.TELEGRAM_API_BASE_URL = f'{self.telegram.url}/bot'
+        skyprice_bot.TELEGRAM_TOKEN = '123:benchmark'
+        skyprice_bot.INLINE_MIN_LENGTH = args.min_length
+        self.application = skyprice_bot.build_application()
+        await self.application.initialize()
+        await self.application.start()
+
+    async def stop(self) -> None:
+        await self.application.stop()
+        await self.application.shutdown()
+        await skyprice_bot.close_clients(self.application)
+        for server in (self.telegram, self.openai, self.skyprice):
+            await server.stop()
+
+    async def inject(self, user_id: int, query: str) -> str:
+        update_id, self.next_update_id = self.next_update_id, self.next_update_id + 1
+        update = Update.de_json(synthetic_inline_query(update_id, user_id, query), self.application.bot)
+        self.sent[str(update_id)] = time.perf_counter()
+        await self.application.update_queue.put(update)
+        return str(update_id)
+
+    async def type_listing(self, user_id: int, text: str, rng: random.Random) -> list:
+        """Type the listing one key at a time, pause, then delete and retype its last word; returns the query ids."""
+        cut = text.rstrip().rfind(' ')
+        query_ids = []
+        for lengths in (range(self.args.min_length, len(text) + 1), [*range(len(text) - 1, cut, -1), *range(cut + 1, len(text) + 1)]):
+            for length in lengths:
+                query_ids.append(await self.inject(user_id, text[:length]))
+                await asyncio.sleep(self.args.keystroke_interval * rng.uniform(0.5, 1.5))
+            # Pausa tras escribir el anuncio completo: la consulta se valúa y las repetidas salen de la caché
+            await asyncio.sleep(self.args.pause)
+        return query_ids
+
+    async def run_scenario(self, name: str) -> dict:
+        args = self.args
+        coordinator = skyprice_bot.inline_coordinator
+        coordinator.debounce = 0.0 if name == 'no-debounce' else args.debounce
+        coordinator.ttl = 0.0 if name == 'no-debounce' else args.cache_ttl
+        coordinator.deadline = args.deadline
+        coordinator._entries.clear()
+        # Cada escenario empieza sin extracciones ni predicciones en caché
+        skyprice_bot.extraction_cache.invalidate()
+        skyprice_bot.prediction_cache.invalidate()
+        before = dict(coordinator.stats())
+        completions, cancelled = self.openai.completions, self.openai.streams_cancelled
+        skyprice_requests = self.skyprice.requests
+
+        rng = random.Random(args.seed)
+        users = list(range(self.next_user_id, self.next_user_id + args.users))
+        self.next_user_id += args.users
+        started = time.perf_counter()
+        typed = await asyncio.gather(*(
+            self.type_listing(user_id, LISTING.format(size=60 + index), rng) for index, user_id in enumerate(users)
+        ))
+        # Espera la respuesta a la última consulta de cada usuario (o el plazo)
+        finals = [query_ids[-1] for query_ids in typed]
+        wait_until = time.perf_counter() + args.deadline + 2.0
+        while time.perf_counter() < wait_until and not all(query_id in self.telegram.inline_answers for query_id in finals):
+            await asyncio.sleep(0.05)
+        elapsed = time.perf_counter() - started
+
+        query_ids = [query_id for ids in typed for query_id in ids]
+        answered = [query_id for query_id in query_ids if query_id in self.telegram.inline_answers]
+        latencies = [self.telegram.inline_answers[query_id][1] - self.sent[query_id] for query_id in answered]
+        final_latencies = [self.telegram.inline_answers[query_id][1] - self.sent[query_id] for query_id in finals if query_id in self.telegram.inline_answers]
+        final_titles = [self.telegram.inline_answers[query_id][0][0]['title'] for query_id in finals if query_id in self.telegram.inline_answers]
+        after = coordinator.stats()
+        return {
+            'scenario': name,
+            'users': args.users,
+            'queries': len(query_ids),
+            'answered': len(answered),
+            'final_prices': sum(title.startswith('💰') for title in final_titles),
+            'elapsed_s': round(elapsed, 3),
+            'answer_p50_s': round(percentile(latencies, 0.5), 4) if latencies else None,
+            'answer_p95_s': round(percentile(latencies, 0.95), 4) if latencies else None,
+            # La última consulta repite el anuncio completo, ya valuado durante la pausa
+            'final_answer_p50_s': round(percentile(final_latencies, 0.5), 4) if final_latencies else None,
+            'llm_calls': self.openai.completions - completions,
+            'llm_streams_cancelled': self.openai.streams_cancelled - cancelled,
+            'skyprice_requests': self.skyprice.requests - skyprice_requests,
+            **{key: after.get(key, 0) - before.get(key, 0) for key in ('cancelled', 'superseded', 'cached', 'complete', 'partial', 'error')},
+        }
+
+async def run(args) -> list:
+    harness = Harness(args)
+    await harness.start()
+    results = []
+    try:
+        for name in args.scenarios:
+            results.append(await harness.run_scenario(name))
+            print(json.dumps(results[-1], ensure_ascii=False))
+    finally:
+        await harness.stop()
+    return results
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Simulate users typing inline queries against local fake Telegram, OpenAI and SkyPrice servers.')
+    parser.add_argument('--scenarios', nargs='+', default=list(SCENARIOS), choices=list(SCENARIOS), help='Scenarios to run.')
+    parser.add_argument('--users', type=int, default=20, help='Users typing at the same time.')
+    parser.add_argument('--keystroke-interval', type=float, default=0.12, help='Mean seconds between keystrokes.')
+    parser.add_argument('--pause', type=float, default=1.5, help='Seconds each user pauses after typing the whole listing.')
+    parser.add_argument('--min-length', type=int, default=60, help='Bot minimum query length (typing starts there).')
+    parser.add_argument('--debounce', type=float, default=skyprice_bot.INLINE_DEBOUNCE, help='Debounce of the debounced scenario in seconds.')
+    parser.add_argument('--cache-ttl', type=float, default=skyprice_bot.INLINE_CACHE_TTL, help='Inline cache TTL of the debounced scenario in seconds.')
+    parser.add_argument('--deadline', type=float, default=skyprice_bot.INLINE_DEADLINE, help='Inline answer deadline in seconds.')
+    parser.add_argument('--llm-latency', type=float, default=0.3, help='Fake OpenAI latency in seconds.')
+    parser.add_argument('--llm-token-latency', type=float, default=0.02, help='Fake OpenAI delay between streamed chunks in seconds.')
+    parser.add_argument('--api-latency', type=float, default=0.1, help='Fake SkyPrice latency in seconds.')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the keystroke timing.')
+    args = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+    asyncio.run(run(args))
+
+if __name__ == '__main__':
+    main()
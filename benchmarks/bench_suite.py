@@ -0,0 +1,341 @@
+# @Author: Humberto Alejandro Ortega Alcocer
+# @Date: 2024-Junio-24
+# @Description: Suite de benchmarks de extremo a extremo: inyecta actualizaciones en la Application contra Telegram, OpenAI y SkyPrice simulados.
+# @Usage: python benchmarks/bench_suite.py [--updates 200] [--scenarios cache-cold cache-warm] [--output results.json] [--compare baseline.json]
+# @License: MIT
+import argparse
+import asyncio
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+import zlib
+
+# Allow running the benchmark from the repository root without a real API key
+os.environ.setdefault('OPENAI_API_KEY', 'benchmark')
+os.environ.setdefault('SKYPRICE_EXTRACTION_CACHE_PATH', '')
+os.environ.setdefault('SKYPRICE_STATE_PATH', '')
+os.environ.setdefault('SKYPRICE_COMPARABLES_PATH', '')
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+import logging
+
+import httpx
+from openai import AsyncOpenAI
+from telegram import Update
+
+import skyprice_bot
+import skyprice_logging
+from fake_backends import FakeOpenAI, FakeSkyPrice, FakeTelegram, default_llm_details, synthetic_update
+from skyprice_batch import percentile
+from skyprice_metrics import TraceIdFilter
+
+# Mensajes que requieren al LLM y mensajes que resuelve el extractor local
+LLM_TEXT = 'Anuncio {index}: depa bonito y luminoso, pregunta por él'
+FAST_PATH_TEXT = '{size} m2, 2 recámaras, 1 baño, 1 estacionamiento, 10 años, Benito Juárez'
+# Mensaje de un agente con cinco anuncios que requieren al LLM
+MULTI_LISTING_TEXT = 'Opciones del anuncio {index}:\n' + '\n'.join(f'{number}. Depa de {{size}}{number} m2 con 2 recámaras, muy iluminado' for number in range(1, 6))
+
+def invalid_municipality_details(text: str, model: str = None) -> dict:
+    """LLM answer with a municipality (and coordinates) outside CDMX."""
+    return dict(default_llm_details(text), Municipality='Gotham', Lat=40.7128, Lng=-74.0060)
+
+def out_of_range_details(text: str, model: str = None) -> dict:
+    """LLM answer whose first field exceeds its limit (a streamed extraction can stop there)."""
+    return dict(default_llm_details(text), Size_Terrain=50000)
+
+def weak_first_tier_details(text: str, model: str = None) -> dict:
+    """LLM answer where every model but the last tier misses the rooms of one message in four."""
+    details = default_llm_details(text)
+    if model != skyprice_bot.EXTRACTION_TIERS[-1][0] and zlib.crc32(text.encode('utf-8')) % 4 == 0:
+        details['Rooms'] = None
+    return details
+
+def rooms_when_mentioned_details(text: str, model: str = None) -> dict:
+    """LLM answer that only knows the rooms once the user mentions them."""
+    return dict(default_llm_details(text.split('\n')[0]), Rooms=3 if 'recamaras' in text or 'recámaras' in text else None)
+
+# Escenarios: textos, respuesta del LLM, latencia de SkyPrice y resultado esperado
+SCENARIOS = {
+    'cache-cold': {'text': LLM_TEXT, 'expect': 'price'},
+    'cache-warm': {'text': LLM_TEXT, 'expect': 'price', 'warm': True},
+    'fast-path': {'text': FAST_PATH_TEXT, 'expect': 'price'},
+    'invalid-municipality': {'text': LLM_TEXT, 'expect': 'error', 'respond': invalid_municipality_details},
+    'out-of-range': {'text': LLM_TEXT, 'expect': 'error', 'respond': out_of_range_details},
+    'follow-up': {'text': LLM_TEXT, 'expect': 'price', 'respond': rooms_when_mentioned_details, 'follow_up': '3 recámaras'},
+    'cascade': {'text': LLM_TEXT, 'expect': 'price', 'respond': weak_first_tier_details},
+    'spam': {'text': LLM_TEXT, 'expect': 'price', 'spam': True},
+    'multi-listing': {'text': MULTI_LISTING_TEXT, 'expect': 'price'},
+    # SkyPrice caído: fallan las primeras solicitudes, luego el circuit breaker responde con la estimación local
+    'upstream-timeout': {'text': LLM_TEXT, 'expect': ('error', 'fallback'), 'skyprice_timeout': True},
+    'api-outage': {'text': LLM_TEXT, 'expect': ('error', 'fallback'), 'skyprice_outage': True},
+}
+
+class Harness:
+    """Runs the real Application against the fake backends and tracks each update's final reply."""
+
+    def __init__(self, args):
+        self.args = args
+        self.injected = {}
+        self.finished = {}
+        self.all_finished = asyncio.Event()
+        self.next_chat_id = 1000
+        self.next_update_id = 1
+        self.texts = {}
+        self.follow_up = None
+        self.notices = {'queued': 0, 'shed': 0}
+
+    async def start(self) -> None:
+        args = self.args
+        self.telegram = await FakeTelegram(latency=args.telegram_latency, error_rate=args.telegram_error_rate).start()
+        self.openai = await FakeOpenAI(
+            latency=args.llm_latency, error_rate=args.llm_error_rate, token_latency=args.llm_token_latency,
+            model_latency={model: float(latency) for model, _, latency in (item.partition(':') for item in args.llm_model_latency)},
+        ).start()
+        self.skyprice = await FakeSkyPrice(latency=args.api_latency, error_rate=args.api_error_rate).start()
+        self.telegram.on_message = self.on_message
+
+        skyprice_bot.client = AsyncOpenAI(api_key='benchmark', base_url=f'{self.openai.url}/v1', max_retries=0)
+        skyprice_bot.http_client = httpx.AsyncClient(timeout=args.api_timeout, limits=httpx.Limits(max_connections=args.concurrency))
+        skyprice_bot.SKYPRICE_API_URL = f'{self.skyprice.url}/predict'
+        skyprice_bot.TELEGRAM_API_BASE_URL = f'{self.telegram.url}/bot'
+        skyprice_bot.TELEGRAM_TOKEN = '123:benchmark'
+        skyprice_bot.MAX_CONCURRENT_UPDATES = args.concurrency
+        skyprice_bot.update_scheduler.max_queued_per_key = args.user_queue_limit
+        skyprice_bot.update_scheduler.max_wait = args.max_queue_wait
+        skyprice_bot.openai_rate_limiter.rate = args.openai_rpm / 60
+        skyprice_bot.openai_token_limiter.rate = args.openai_tpm / 60
+        skyprice_bot.openai_token_limiter.burst = max(1, int(args.openai_tpm / 6))
+        skyprice_bot.RESPONSE_MODE = args.response_mode
+        skyprice_bot.EXTRACTION_STREAM = args.extraction == 'stream'
+        if args.max_listings is not None:
+            skyprice_bot.MAX_LISTINGS = args.max_listings
+        if args.follow_up_timeout is not None:
+            skyprice_bot.FOLLOW_UP_TIMEOUT = args.follow_up_timeout
+        if args.extraction_models:
+            skyprice_bot.EXTRACTION_TIERS = skyprice_bot.parse_extraction_tiers(args.extraction_models)
+        self.application = skyprice_bot.build_application()
+        await self.application.initialize()
+        await self.application.start()
+
+    async def stop(self) -> None:
+        await self.application.stop()
+        await self.application.shutdown()
+        await skyprice_bot.close_clients(self.application)
+        for server in (self.telegram, self.openai, self.skyprice):
+            await server.stop()
+
+    def telegram_calls(self) -> int:
+        return self.telegram.calls.get('sendMessage', 0) + self.telegram.calls.get('editMessageText', 0)
+
+    def on_message(self, chat_id, method, text) -> None:
+        if text.startswith('⏳'):
+            self.notices['queued'] += 1
+            return
+        # Si el bot pide datos faltantes se responden en la conversación o, sin seguimiento,
+        # reenviando la descripción completa con el dato agregado
+        if self.follow_up and chat_id in self.texts and (text.startswith('❓') or 'no pude extraer los siguientes detalles' in text):
+            original = self.texts.pop(chat_id)
+            reply = self.follow_up if skyprice_bot.FOLLOW_UP_TIMEOUT > 0 else f'{original}\n{self.follow_up}'
+            asyncio.ensure_future(self.inject(chat_id, reply))
+            return
+        # En modo edit el precio llega al final del mensaje editado
+        if text.startswith('🚦'):
+            self.notices['shed'] += 1
+        if chat_id in self.injected and chat_id not in self.finished and ('💰' in text or text.startswith(('❌', '🚦'))):
+            outcome = ('fallback' if '≈' in text else 'price') if '💰' in text else 'shed' if text.startswith('🚦') else 'error'
+            self.finished[chat_id] = (time.perf_counter(), outcome)
+            if len(self.finished) == len(self.injected):
+                self.all_finished.set()
+
+    async def replay(self, texts) -> None:
+        """Inject one update per text (each from a new chat) and wait for every final reply."""
+        self.injected.clear()
+        self.finished.clear()
+        self.all_finished.clear()
+        for text in texts:
+            chat_id, self.next_chat_id = self.next_chat_id, self.next_chat_id + 1
+            self.injected[chat_id] = time.perf_counter()
+            self.texts[chat_id] = text
+            await self.inject(chat_id, text)
+            if self.args.rate:
+                await asyncio.sleep(1 / self.args.rate)
+        try:
+            await asyncio.wait_for(self.all_finished.wait(), self.args.scenario_timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def inject(self, chat_id: int, text: str) -> None:
+        update = Update.de_json(synthetic_update(self.next_update_id, chat_id, text), self.application.bot)
+        self.next_update_id += 1
+        await self.application.update_queue.put(update)
+
+    async def run_scenario(self, name: str) -> dict:
+        scenario, args = SCENARIOS[name], self.args
+        skyprice_bot.extraction_cache.invalidate()
+        skyprice_bot.prediction_cache.invalidate()
+        self.openai.respond = scenario.get('respond', default_llm_details)
+        self.follow_up = scenario.get('follow_up')
+        self.skyprice.latency = args.api_timeout + 0.5 if scenario.get('skyprice_timeout') else args.api_latency
+        self.skyprice.error_rate = 1.0 if scenario.get('skyprice_outage') else args.api_error_rate
+        skyprice_bot.skyprice_breaker.reset()
+        # El tamaño distinto por anuncio evita que la caché de predicciones agrupe anuncios entre sí
+        texts = [scenario['text'].format(index=index, size=40 + index % 400) for index in range(args.updates)]
+        if scenario.get('warm'):
+            await self.replay(texts)
+        if scenario.get('spam'):
+            # Un solo chat envía tantos mensajes como el resto de los usuarios juntos, todos de golpe
+            spam_chat, self.next_chat_id = self.next_chat_id, self.next_chat_id + 1
+            for index in range(args.updates):
+                await self.inject(spam_chat, scenario['text'].format(index=f'spam-{index}'))
+
+        llm_calls, api_calls = self.openai.requests, self.skyprice.requests
+        hedged, breaker_rejected = skyprice_bot.skyprice_hedging.hedged, skyprice_bot.skyprice_breaker.rejected
+        llm_events, llm_cancelled = self.openai.events_sent, self.openai.streams_cancelled
+        llm_models, llm_cost = dict(self.openai.models), skyprice_bot.extraction_cost_usd_total.total()
+        telegram_calls = self.telegram_calls()
+        notices = dict(self.notices)
+        if tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+        started = time.perf_counter()
+        await self.replay(texts)
+        elapsed = time.perf_counter() - started
+        peak_traced = tracemalloc.get_traced_memory()[1] if tracemalloc.is_tracing() else None
+
+        latencies = [finished_at - self.injected[chat_id] for chat_id, (finished_at, _) in self.finished.items()]
+        outcomes = [outcome for _, outcome in self.finished.values()]
+        expect = scenario['expect'] if isinstance(scenario['expect'], tuple) else (scenario['expect'],)
+        return {
+            'scenario': name,
+            'updates': args.updates,
+            'completed': len(self.finished),
+            'expected_outcome': sum(outcome in expect for outcome in outcomes),
+            'fallbacks': outcomes.count('fallback'),
+            'elapsed_s': round(elapsed, 3),
+            'throughput_updates_s': round(len(self.finished) / elapsed, 2) if elapsed else 0.0,
+            'p50_s': round(percentile(latencies, 0.50), 4),
+            'p95_s': round(percentile(latencies, 0.95), 4),
+            'p99_s': round(percentile(latencies, 0.99), 4),
+            'llm_calls': self.openai.requests - llm_calls,
+            'llm_stream_events': self.openai.events_sent - llm_events,
+            'llm_streams_cancelled': self.openai.streams_cancelled - llm_cancelled,
+            'llm_calls_by_model': {model: calls - llm_models.get(model, 0) for model, calls in self.openai.models.items() if calls > llm_models.get(model, 0)},
+            'llm_cost_usd': round(skyprice_bot.extraction_cost_usd_total.total() - llm_cost, 6),
+            'skyprice_calls': self.skyprice.requests - api_calls,
+            'skyprice_hedged': skyprice_bot.skyprice_hedging.hedged - hedged,
+            'breaker_rejected': skyprice_bot.skyprice_breaker.rejected - breaker_rejected,
+            'telegram_calls': self.telegram_calls() - telegram_calls,
+            'queued_notices': self.notices['queued'] - notices['queued'],
+            'shed_notices': self.notices['shed'] - notices['shed'],
+            'peak_traced_mb': round(peak_traced / 2 ** 20, 2) if peak_traced is not None else None,
+            'max_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        }
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+def compare(results: dict, baseline: dict, tolerance: float) -> bool:
+    """Print the change of each scenario against a baseline run; False if any regressed beyond tolerance."""
+    previous = {scenario['scenario']: scenario for scenario in baseline['scenarios']}
+    ok = True
+    for scenario in results['scenarios']:
+        before = previous.get(scenario['scenario'])
+        if before is None:
+            continue
+        throughput_change = scenario['throughput_updates_s'] / before['throughput_updates_s'] - 1 if before['throughput_updates_s'] else 0.0
+        p95_change = scenario['p95_s'] / before['p95_s'] - 1 if before['p95_s'] else 0.0
+        regressed = throughput_change < -tolerance or p95_change > tolerance
+        ok = ok and not regressed
+        print(json.dumps({
+            'compare': scenario['scenario'], 'baseline_revision': baseline['meta']['revision'],
+            'throughput_change': round(throughput_change, 3), 'p95_change': round(p95_change, 3), 'regressed': regressed,
+        }))
+    return ok
+
+async def run(args) -> dict:
+    if args.trace_memory:
+        tracemalloc.start()
+    harness = Harness(args)
+    await harness.start()
+    scenarios = []
+    try:
+        for name in args.scenarios:
+            scenarios.append(await harness.run_scenario(name))
+            print(json.dumps(scenarios[-1]))
+    finally:
+        await harness.stop()
+        if args.trace_memory:
+            tracemalloc.stop()
+    return {
+        'meta': {
+            'revision': git_revision(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'python': platform.python_version(),
+            'cpu_count': os.cpu_count(),
+            'parameters': {key: value for key, value in vars(args).items() if key not in ('output', 'compare')},
+        },
+        'scenarios': scenarios,
+    }
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='End-to-end benchmark suite against local fake Telegram, OpenAI and SkyPrice servers.')
+    parser.add_argument('--scenarios', nargs='+', default=list(SCENARIOS), choices=list(SCENARIOS), help='Scenarios to run.')
+    parser.add_argument('--updates', type=int, default=200, help='Updates injected per scenario.')
+    parser.add_argument('--rate', type=float, default=0.0, help='Injection rate in updates/s (0 = all at once).')
+    parser.add_argument('--concurrency', type=int, default=32, help='Concurrent updates processed by the application.')
+    parser.add_argument('--llm-latency', type=float, default=0.5, help='Fake OpenAI latency in seconds.')
+    parser.add_argument('--llm-token-latency', type=float, default=0.01, help='Fake OpenAI delay between streamed chunks in seconds.')
+    parser.add_argument('--extraction', choices=['stream', 'blocking'], default='stream', help='Stream the LLM extraction or wait for the whole completion.')
+    parser.add_argument('--llm-model-latency', nargs='*', default=['gpt-4o-mini:0', 'gpt-4o:0.3'], metavar='MODEL:SECONDS',
+                        help='Extra fake OpenAI latency per model, on top of --llm-latency.')
+    parser.add_argument('--extraction-models', help='Extraction tiers ("model:max_tokens,..."); defaults to the bot configuration.')
+    parser.add_argument('--follow-up-timeout', type=float, help='Bot follow-up timeout (0 = users resend the whole description).')
+    parser.add_argument('--max-listings', type=int, help='Bot maximum listings valued per message (1 = one apartment per message).')
+    parser.add_argument('--openai-rpm', type=float, default=0.0, help='Bot OpenAI requests-per-minute budget (0 = unlimited).')
+    parser.add_argument('--openai-tpm', type=float, default=0.0, help='Bot OpenAI tokens-per-minute budget (0 = unlimited).')
+    parser.add_argument('--user-queue-limit', type=int, default=5, help='Updates a chat may have waiting before the rest are shed.')
+    parser.add_argument('--max-queue-wait', type=float, default=30.0, help='Seconds of OpenAI budget backlog before new updates are shed.')
+    parser.add_argument('--llm-error-rate', type=float, default=0.0, help='Fraction of fake OpenAI requests answering 503.')
+    parser.add_argument('--api-latency', type=float, default=0.1, help='Fake SkyPrice latency in seconds.')
+    parser.add_argument('--api-error-rate', type=float, default=0.0, help='Fraction of fake SkyPrice requests answering 503.')
+    parser.add_argument('--api-timeout', type=float, default=1.0, help='SkyPrice client timeout in seconds (upstream-timeout exceeds it).')
+    parser.add_argument('--response-mode', choices=['messages', 'edit'], default='messages', help='Bot response mode.')
+    parser.add_argument('--telegram-latency', type=float, default=0.0, help='Fake Telegram latency in seconds.')
+    parser.add_argument('--telegram-error-rate', type=float, default=0.0, help='Fraction of fake Telegram requests answering 503.')
+    parser.add_argument('--scenario-timeout', type=float, default=120.0, help='Maximum seconds to wait for a scenario.')
+    parser.add_argument('--log', choices=['off', 'text', 'json'], default='off', help='Keep the bot logging on (written to /dev/null) to measure its overhead.')
+    parser.add_argument('--log-sample-rate', type=float, default=0.01, help='Fraction of payload log records kept with --log.')
+    parser.add_argument('--trace-memory', action='store_true', help='Report the per-scenario peak of Python allocations (tracemalloc, ~4x slower).')
+    parser.add_argument('--output', help='Write the results as JSON to this file.')
+    parser.add_argument('--compare', help='Baseline results (JSON) to compare against.')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='Allowed relative regression when comparing.')
+    args = parser.parse_args()
+
+    if args.log == 'off':
+        logging.disable(logging.INFO)
+    else:
+        # Registros completos (con el muestreo de payloads configurado) hacia /dev/null, para medir su costo
+        devnull = open(os.devnull, 'w', encoding='utf-8')
+        skyprice_logging.setup_logging(
+            json_format=args.log == 'json', sample_rate=args.log_sample_rate, filters=[TraceIdFilter()], stream=devnull,
+        )
+    results = asyncio.run(run(args))
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            json.dump(results, file, indent=2)
+    ok = all(scenario['expected_outcome'] == scenario['updates'] for scenario in results['scenarios'])
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as file:
+            ok = compare(results, json.load(file), args.tolerance) and ok
+    sys.exit(0 if ok else 1)
+
+if __name__ == '__main__':
+    main()
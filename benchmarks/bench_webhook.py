@@ -0,0 +1,150 @@
+# @Author: Humberto Alejandro Ortega Alcocer
+# @Date: 2024-Junio-24
+# @Description: Prueba de carga del modo webhook: reproduce actualizaciones sintéticas contra 1, 2 y 4 workers.
+# @Usage: python benchmarks/bench_webhook.py [--workers 1 2 4] [--chats 50] [--messages 4] [--latency 0.02]
+# @License: MIT
+import argparse
+import asyncio
+import json
+import os
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+from fake_backends import FakeSkyPrice, FakeTelegram, synthetic_update
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# Mensaje que el fast path resuelve sin LLM; el tamaño codifica el número de secuencia del chat
+MESSAGE_TEMPLATE = '{size} m2, 2 recámaras, 1 baño, 1 estacionamiento, 10 años, Benito Juárez'
+SIZE_OFFSET = 40
+SIZE_RE = re.compile(r'Tamaño del terreno: (\d+)m²')
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+async def wait_healthy(url: str, process: subprocess.Popen, timeout: float = 60.0) -> None:
+    """Poll /healthz until the bot answers."""
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                raise RuntimeError(f'Bot exited with code {process.returncode}')
+            try:
+                if (await client.get(f'{url}/healthz')).status_code == 200:
+                    return
+            except httpx.TransportError:
+                pass
+            await asyncio.sleep(0.2)
+    raise TimeoutError('Bot did not become healthy')
+
+async def run_scenario(workers, args, telegram, skyprice):
+    """Start the bot with the given workers, replay the updates and wait for every reply."""
+    telegram.sent.clear()
+    expected = args.chats * args.messages
+    done = asyncio.Event()
+    prices = [0]
+
+    def on_message(chat_id, method, text):
+        if text.startswith('💰'):
+            prices[0] += 1
+            if prices[0] == expected:
+                done.set()
+
+    telegram.on_message = on_message
+    port = free_port()
+    state_dir = tempfile.mkdtemp(prefix='skyprice-bench-')
+    env = dict(
+        os.environ,
+        OPENAI_API_KEY='benchmark',
+        TELEGRAM_TOKEN='123:benchmark',
+        TELEGRAM_API_BASE_URL=f'{telegram.url}/bot',
+        SKYPRICE_API_URL=f'{skyprice.url}/predict',
+        SKYPRICE_EXTRACTION_CACHE_PATH='',
+        SKYPRICE_PREDICTION_CACHE_TTL='0',
+        SKYPRICE_STATE_PATH=os.path.join(state_dir, 'state.sqlite3'),
+        SKYPRICE_COMPARABLES_PATH=os.path.join(state_dir, 'comparables.sqlite3'),
+        # Every message of a chat must be processed to check the ordering
+        SKYPRICE_USER_QUEUE_LIMIT=str(args.messages),
+    )
+    process = subprocess.Popen(
+        [sys.executable, 'skyprice_bot.py', 'webhook', '--workers', str(workers), '--host', '127.0.0.1', '--port', str(port)],
+        cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    url = f'http://127.0.0.1:{port}'
+    try:
+        await wait_healthy(url, process)
+        updates = [
+            synthetic_update(sequence * args.chats + chat + 1, 1000 + chat, MESSAGE_TEMPLATE.format(size=SIZE_OFFSET + sequence))
+            for sequence in range(args.messages) for chat in range(args.chats)
+        ]
+        async with httpx.AsyncClient(limits=httpx.Limits(max_connections=args.connections)) as client:
+            started = time.perf_counter()
+            # Telegram entrega las actualizaciones de un chat en orden; simulamos eso por ronda
+            for start in range(0, len(updates), args.chats):
+                responses = await asyncio.gather(*(client.post(f'{url}/telegram', json=update) for update in updates[start:start + args.chats]))
+                if any(response.status_code != 200 for response in responses):
+                    raise RuntimeError('Webhook rejected an update')
+            await asyncio.wait_for(done.wait(), args.timeout)
+            elapsed = time.perf_counter() - started
+    finally:
+        process.terminate()
+        process.wait(30)
+
+    out_of_order = 0
+    for chat_id, messages in telegram.sent.items():
+        sizes = [int(match.group(1)) for _, text, _ in messages for match in [SIZE_RE.search(text)] if match]
+        out_of_order += sizes != sorted(sizes)
+    return {
+        'workers': workers,
+        'updates': expected,
+        'elapsed_s': round(elapsed, 3),
+        'updates_per_s': round(expected / elapsed, 1),
+        'chats_out_of_order': out_of_order,
+    }
+
+async def run(args):
+    telegram = await FakeTelegram().start()
+    skyprice = await FakeSkyPrice(latency=args.latency).start()
+    results = []
+    try:
+        for workers in args.workers:
+            results.append(await run_scenario(workers, args, telegram, skyprice))
+            print(json.dumps(results[-1]))
+    finally:
+        await telegram.stop()
+        await skyprice.stop()
+
+    baseline = results[0]
+    for result in results[1:]:
+        speedup = result['updates_per_s'] / baseline['updates_per_s']
+        result['speedup'] = round(speedup, 2)
+        result['scaling_efficiency'] = round(speedup / (result['workers'] / baseline['workers']), 2)
+    summary = {
+        'cpu_count': os.cpu_count(),
+        'scaling': [{key: result.get(key) for key in ('workers', 'speedup', 'scaling_efficiency')} for result in results[1:]],
+        'ok': all(result['chats_out_of_order'] == 0 for result in results),
+    }
+    print(json.dumps(summary))
+    return summary['ok']
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Load test the webhook mode with several worker counts.')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4], help='Worker counts to compare.')
+    parser.add_argument('--chats', type=int, default=50, help='Distinct chats sending messages.')
+    parser.add_argument('--messages', type=int, default=4, help='Messages per chat.')
+    parser.add_argument('--connections', type=int, default=50, help='Concurrent connections to the webhook.')
+    parser.add_argument('--latency', type=float, default=0.02, help='Fake SkyPrice latency in seconds.')
+    parser.add_argument('--timeout', type=float, default=120.0, help='Seconds to wait for every reply.')
+    args = parser.parse_args()
+    sys.exit(0 if asyncio.run(run(args)) else 1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,194 @@
+# @Author: Humberto Alejandro Ortega Alcocer
+# @Date: 2024-Junio-24
+# @Description: Evaluación de exactitud del extractor local (fast path) contra un corpus etiquetado y, opcionalmente, contra el LLM y la cascada de modelos.
+# @Usage: python benchmarks/eval_extraction.py [--corpus benchmarks/corpus/extraction.jsonl] [--llm] [--cascade [gpt-4o-mini:300,gpt-4o:600]]
+# @License: MIT
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import logging
+
+from skyprice_cache import normalize_text
+from skyprice_parser import parse_apartment_details
+
+# Campos calificados (Lat/Lng dependen del geocodificador y no se etiquetan)
+GRADED_FIELDS = ['Size_Terrain', 'Size_Construction', 'Rooms', 'Bathrooms', 'Parking', 'Age', 'Municipality']
+
+# Corpus etiquetado por defecto
+DEFAULT_CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'corpus', 'extraction.jsonl')
+
+
+def load_corpus(path):
+    """Load the labeled corpus, resolving construction years into ages."""
+    rows = []
+    with open(path, encoding='utf-8') as corpus:
+        for line in corpus:
+            if not line.strip():
+                continue
+            row = json.loads(line)
+            age = row['expected'].get('Age')
+            if isinstance(age, dict):
+                row['expected']['Age'] = datetime.date.today().year - age['built']
+            rows.append(row)
+    return rows
+
+
+def same_value(expected, actual):
+    """Compare an extracted value with its label."""
+    if expected is None or actual is None:
+        return expected is None and actual is None
+    if isinstance(expected, str):
+        return normalize_text(expected) == normalize_text(str(actual))
+    try:
+        return abs(float(expected) - float(actual)) < 1e-6
+    except (TypeError, ValueError):
+        return False
+
+
+def score(rows, predictions, latencies):
+    """Compute field-level accuracy, coverage and precision for one extractor."""
+    report = {'messages': len(rows), 'fields': {}}
+    exact = 0
+    for field in GRADED_FIELDS:
+        correct = resolved = resolved_correct = 0
+        for row, prediction in zip(rows, predictions):
+            expected = row['expected'][field]
+            actual = prediction.get(field)
+            correct += same_value(expected, actual)
+            if actual is not None:
+                resolved += 1
+                resolved_correct += same_value(expected, actual)
+        report['fields'][field] = {
+            'accuracy': round(correct / len(rows), 3),
+            'coverage': round(resolved / len(rows), 3),
+            'precision': round(resolved_correct / resolved, 3) if resolved else None,
+        }
+    for row, prediction in zip(rows, predictions):
+        exact += all(same_value(row['expected'][field], prediction.get(field)) for field in GRADED_FIELDS)
+    report['exact_match'] = round(exact / len(rows), 3)
+    latencies = sorted(latencies)
+    report['latency_ms'] = {
+        'p50': round(latencies[len(latencies) // 2] * 1000, 3),
+        'max': round(latencies[-1] * 1000, 3),
+    }
+    return report
+
+
+def run_fast_path(rows):
+    """Run the local extractor over the corpus."""
+    predictions, latencies = [], []
+    for row in rows:
+        started = time.perf_counter()
+        predictions.append(parse_apartment_details(row['text']))
+        latencies.append(time.perf_counter() - started)
+    report = score(rows, predictions, latencies)
+    report['full_resolution_rate'] = round(
+        sum(all(prediction[field] is not None for field in prediction) for prediction in predictions) / len(rows), 3
+    )
+    return report, predictions
+
+
+async def run_llm(rows):
+    """Run the LLM extraction (without cache or fast path) over the corpus."""
+    import skyprice_bot
+
+    predictions, latencies = [], []
+    for row in rows:
+        started = time.perf_counter()
+        try:
+            predictions.append(await skyprice_bot.request_llm_details(row['text'], skyprice_bot.APARTMENT_FIELDS))
+        except Exception as e:
+            logging.warning("LLM extraction failed: %s", e)
+            predictions.append({})
+        latencies.append(time.perf_counter() - started)
+    return score(rows, predictions, latencies), predictions
+
+
+async def run_cascade(rows, spec=None):
+    """Run the fast path plus each model tier alone and then the whole cascade over the corpus.
+
+    Reports, per configuration, the accuracy, the latency, the estimated cost and the share of
+    LLM extractions that escalated past the first tier.
+    """
+    import skyprice_bot
+
+    tiers = skyprice_bot.parse_extraction_tiers(spec) if spec else skyprice_bot.EXTRACTION_TIERS
+    configurations = [[tier] for tier in tiers] + ([tiers] if len(tiers) > 1 else [])
+    reports = []
+    for configuration in configurations:
+        predictions, latencies, tiers_used = [], [], []
+        cost = skyprice_bot.extraction_cost_usd_total.total()
+        for row in rows:
+            parsed = parse_apartment_details(row['text'])
+            fields = [field for field in skyprice_bot.APARTMENT_FIELDS if parsed[field] is None]
+            started = time.perf_counter()
+            if not fields:
+                prediction, tier = parsed, None
+            else:
+                try:
+                    prediction, tier = await skyprice_bot.request_cascade_details(row['text'], fields, parsed, configuration)
+                except skyprice_bot.ExtractionAborted as e:
+                    prediction, tier = e.details.__dict__, len(configuration) - 1
+                except Exception as e:
+                    logging.warning("LLM extraction failed: %s", e)
+                    prediction, tier = {}, len(configuration) - 1
+            latencies.append(time.perf_counter() - started)
+            predictions.append(prediction)
+            tiers_used.append(tier)
+        report = score(rows, predictions, latencies)
+        llm_tiers = [tier for tier in tiers_used if tier is not None]
+        llm_latencies = sorted(latency for latency, tier in zip(latencies, tiers_used) if tier is not None)
+        report['models'] = [model for model, _ in configuration]
+        report['llm_messages'] = len(llm_tiers)
+        if llm_latencies:
+            report['llm_latency_ms'] = {
+                'p50': round(llm_latencies[len(llm_latencies) // 2] * 1000, 3),
+                'max': round(llm_latencies[-1] * 1000, 3),
+            }
+        report['escalation_rate'] = round(sum(tier > 0 for tier in llm_tiers) / len(llm_tiers), 3) if llm_tiers else 0.0
+        report['cost_usd'] = round(skyprice_bot.extraction_cost_usd_total.total() - cost, 6)
+        reports.append(report)
+    return reports
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Evaluate the fast-path extractor against a labeled corpus.')
+    parser.add_argument('--corpus', default=DEFAULT_CORPUS, help='Labeled JSONL corpus.')
+    parser.add_argument('--llm', action='store_true', help='Also evaluate the LLM path (requires OPENAI_API_KEY).')
+    parser.add_argument('--cascade', nargs='?', const='', metavar='TIERS',
+                        help='Also evaluate each model tier and the cascade ("model:max_tokens,..."; requires OPENAI_API_KEY).')
+    parser.add_argument('--errors', action='store_true', help='Print the fast-path mismatches.')
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+    rows = load_corpus(args.corpus)
+    fast_path_report, fast_path_predictions = run_fast_path(rows)
+    print(json.dumps({'extractor': 'fast-path', **fast_path_report}))
+
+    if args.errors:
+        for row, prediction in zip(rows, fast_path_predictions):
+            mismatches = {
+                field: {'expected': row['expected'][field], 'actual': prediction.get(field)}
+                for field in GRADED_FIELDS if not same_value(row['expected'][field], prediction.get(field))
+            }
+            if mismatches:
+                print(json.dumps({'text': row['text'], 'mismatches': mismatches}, ensure_ascii=False))
+
+    if args.llm:
+        llm_report, _ = asyncio.run(run_llm(rows))
+        print(json.dumps({'extractor': 'llm', **llm_report}))
+
+    if args.cascade is not None:
+        for report in asyncio.run(run_cascade(rows, args.cascade)):
+            print(json.dumps({'extractor': 'cascade' if len(report['models']) > 1 else 'tier', **report}))
+
+
+if __name__ == '__main__':
+    main()
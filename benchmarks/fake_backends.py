@@ -0,0 +1,305 @@
+# @Author: Humberto Alejandro Ortega Alcocer
+# @Date: 2024-Junio-24
+# @Description: Servidores HTTP locales que simulan las APIs externas del bot para benchmarks (sin dependencias adicionales).
+# @License: MIT
+import asyncio
+import json
+import random
+import re
+import time
+import zlib
+from typing import Optional
+from urllib.parse import parse_qsl
+
+
+def fake_price(details: dict) -> dict:
+    """Deterministic stand-in for the SkyPrice models."""
+    base = (
+        18000 * float(details['Size_Construction'])
+        + 4000 * float(details['Size_Terrain'])
+        + 150000 * float(details['Rooms'])
+        + 120000 * float(details['Bathrooms'])
+        + 90000 * float(details['Parking'])
+        - 15000 * float(details['Age'])
+    )
+    return {'random_forest': round(base, 2), 'svm': round(base * 0.97, 2), 'neural_network': round(base * 1.03, 2)}
+
+
+class EventStream:
+    """Payload sent as server-sent events, one every ``interval`` seconds, ending with ``[DONE]``."""
+
+    def __init__(self, events: list, interval: float = 0.0):
+        self.events = events
+        self.interval = interval
+
+
+class FakeHTTPServer:
+    """Minimal HTTP/1.1 JSON server on asyncio streams with keep-alive support.
+
+    Subclasses implement ``handle(method, path, body)`` returning ``(status, payload)``; an
+    ``EventStream`` payload is streamed and stops early if the client disconnects.
+    ``latency`` seconds are added to every request, and ``error_rate`` of them answer 503.
+    """
+
+    def __init__(self, latency: float = 0.0, error_rate: float = 0.0, seed: int = 0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.requests = 0
+        self.errors = 0
+        self.events_sent = 0
+        self.streams_cancelled = 0
+        self.random = random.Random(seed)
+        self.server: Optional[asyncio.AbstractServer] = None
+        self.port = None
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.port}'
+
+    async def start(self) -> 'FakeHTTPServer':
+        self.server = await asyncio.start_server(self._serve, '127.0.0.1', 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self) -> None:
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+
+    async def handle(self, method: str, path: str, body):
+        raise NotImplementedError
+
+    async def _stream(self, reader, writer, stream: EventStream) -> bool:
+        """Send the events with chunked encoding; False if the client went away first."""
+        writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nTransfer-Encoding: chunked\r\n\r\n')
+        started = time.perf_counter()
+        for index, event in enumerate([json.dumps(event) for event in stream.events] + ['[DONE]']):
+            # Plazos absolutos para que los retrasos de cada evento no se acumulen
+            if stream.interval:
+                await asyncio.sleep(max(0.0, started + index * stream.interval - time.perf_counter()))
+            if reader.at_eof() or writer.is_closing():
+                self.streams_cancelled += 1
+                return False
+            data = f'data: {event}\n\n'.encode('utf-8')
+            writer.write(f'{len(data):x}\r\n'.encode('latin-1') + data + b'\r\n')
+            await writer.drain()
+            self.events_sent += 1
+        writer.write(b'0\r\n\r\n')
+        await writer.drain()
+        return True
+
+    async def _serve(self, reader, writer) -> None:
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode('latin-1').split(' ', 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                raw_body = await reader.readexactly(int(headers.get('content-length', 0)))
+                if not raw_body:
+                    body = None
+                elif headers.get('content-type', '').startswith('application/x-www-form-urlencoded'):
+                    body = dict(parse_qsl(raw_body.decode('utf-8')))
+                else:
+                    body = json.loads(raw_body)
+
+                self.requests += 1
+                if self.latency:
+                    await asyncio.sleep(self.latency)
+                if self.error_rate and self.random.random() < self.error_rate:
+                    self.errors += 1
+                    status, payload = 503, {'error': 'unavailable'}
+                else:
+                    status, payload = await self.handle(method, path, body)
+
+                if isinstance(payload, EventStream):
+                    if not await self._stream(reader, writer, payload):
+                        break
+                    continue
+                data = json.dumps(payload).encode('utf-8')
+                writer.write(
+                    f'HTTP/1.1 {status} {"OK" if status == 200 else "Error"}\r\n'
+                    f'Content-Type: application/json\r\nContent-Length: {len(data)}\r\n\r\n'.encode('latin-1') + data
+                )
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+
+class FakeSkyPrice(FakeHTTPServer):
+    """Local stand-in for the SkyPrice API with single (/predict) and batch (/predict/batch) endpoints."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.batch_requests = 0
+        self.predicted = 0
+
+    async def handle(self, method, path, body):
+        if path == '/predict':
+            self.predicted += 1
+            return 200, fake_price(body)
+        if path == '/predict/batch':
+            self.batch_requests += 1
+            self.predicted += len(body)
+            return 200, [fake_price(item) for item in body]
+        return 404, {'error': 'not found'}
+
+
+# Encabezado de cada anuncio cuando el bot extrae varios en una sola llamada
+LISTING_HEADER_RE = re.compile(r'(?:^|\n\n)Listing \d+:\n')
+
+class FakeOpenAI(FakeHTTPServer):
+    """Local stand-in for the OpenAI chat completions API answering with apartment details.
+
+    ``respond(text, model)`` builds the details for a user message; by default every message
+    gets a valid Benito Juárez apartment whose size depends on the text (so predictions differ).
+    A request with numbered listings ("Listing N:") gets ``{"listings": [...]}`` with one
+    answer per listing. A JSON schema ``response_format`` limits the answer to its properties, in order, and
+    streamed requests get ``chunk_size`` characters every ``token_latency`` seconds.
+    ``model_latency`` adds a per-model delay; usage is reported at ~4 characters per token.
+    """
+
+    def __init__(self, *args, respond=None, token_latency: float = 0.0, chunk_size: int = 4, model_latency=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.respond = respond or default_llm_details
+        self.token_latency = token_latency
+        self.chunk_size = chunk_size
+        self.model_latency = model_latency or {}
+        self.completions = 0
+        self.models = {}
+
+    async def handle(self, method, path, body):
+        if not path.endswith('/chat/completions'):
+            return 404, {'error': {'message': 'not found'}}
+        self.completions += 1
+        model = body['model']
+        self.models[model] = self.models.get(model, 0) + 1
+        if self.model_latency.get(model):
+            await asyncio.sleep(self.model_latency[model])
+        prompt = ''.join(
+            message['content'] if isinstance(message['content'], str) else ''.join(part.get('text', '') for part in message['content'])
+            for message in body['messages']
+        )
+        content = body['messages'][-1]['content']
+        text = content if isinstance(content, str) else ''.join(part.get('text', '') for part in content)
+        schema = (body.get('response_format') or {}).get('json_schema', {}).get('schema')
+        listings = LISTING_HEADER_RE.split(text)[1:]
+        if listings:
+            # Varios anuncios numerados: una respuesta por anuncio dentro de {"listings": [...]}
+            properties = schema['properties']['listings']['items']['properties'] if schema is not None else None
+            answers = [self.respond(listing, model) for listing in listings]
+            if properties is not None:
+                answers = [{field: answer.get(field) for field in properties} for answer in answers]
+            answer = json.dumps({'listings': answers}, ensure_ascii=False)
+        else:
+            details = self.respond(text, model)
+            if schema is not None:
+                details = {field: details.get(field) for field in schema['properties']}
+            answer = json.dumps(details, ensure_ascii=False)
+        header = {'id': f'chatcmpl-{self.completions}', 'created': int(time.time()), 'model': model}
+        usage = {'prompt_tokens': len(prompt) // 4, 'completion_tokens': len(answer) // 4 + 1}
+        usage['total_tokens'] = usage['prompt_tokens'] + usage['completion_tokens']
+        if body.get('stream'):
+            deltas = [{'role': 'assistant', 'content': ''}] + [
+                {'content': answer[start:start + self.chunk_size]} for start in range(0, len(answer), self.chunk_size)
+            ]
+            events = [dict(header, object='chat.completion.chunk', choices=[{'index': 0, 'delta': delta, 'finish_reason': None}]) for delta in deltas]
+            events.append(dict(header, object='chat.completion.chunk', choices=[{'index': 0, 'delta': {}, 'finish_reason': 'stop'}]))
+            if (body.get('stream_options') or {}).get('include_usage'):
+                events.append(dict(header, object='chat.completion.chunk', choices=[], usage=usage))
+            return 200, EventStream(events, self.token_latency)
+        # Sin streaming la respuesta llega cuando termina la generación completa
+        await asyncio.sleep(self.token_latency * -(-len(answer) // self.chunk_size))
+        return 200, dict(
+            header, object='chat.completion',
+            choices=[{'index': 0, 'finish_reason': 'stop', 'message': {'role': 'assistant', 'content': answer}}],
+            usage=usage,
+        )
+
+
+def default_llm_details(text: str, model: Optional[str] = None) -> dict:
+    """Valid apartment details derived deterministically from the message text."""
+    size = 40 + zlib.crc32(text.encode('utf-8')) % 200
+    return {
+        'Size_Terrain': size, 'Size_Construction': size, 'Rooms': 2, 'Bathrooms': 1, 'Parking': 1, 'Age': 10,
+        'Lat': 19.3727, 'Lng': -99.1564, 'Municipality': 'Benito Juárez',
+    }
+
+
+class FakeTelegram(FakeHTTPServer):
+    """Local stand-in for the Telegram Bot API that records every message sent or edited per chat
+    and the results of every inline query answered."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.sent = {}
+        self.calls = {}
+        self.message_id = 0
+        self.on_message = None
+        self.inline_answers = {}
+
+    async def handle(self, method, path, body):
+        api_method = path.rsplit('/', 1)[-1]
+        self.calls[api_method] = self.calls.get(api_method, 0) + 1
+        body = body or {}
+        if api_method == 'getMe':
+            return 200, {'ok': True, 'result': {'id': 1, 'is_bot': True, 'first_name': 'SkyPrice', 'username': 'skyprice_bench_bot'}}
+        if api_method in ('sendMessage', 'editMessageText'):
+            chat_id = int(body['chat_id'])
+            self.sent.setdefault(chat_id, []).append((api_method, body.get('text', ''), time.perf_counter()))
+            if self.on_message is not None:
+                self.on_message(chat_id, api_method, body.get('text', ''))
+            if api_method == 'sendMessage':
+                self.message_id += 1
+                message_id = self.message_id
+            else:
+                message_id = int(body['message_id'])
+            return 200, {'ok': True, 'result': {
+                'message_id': message_id, 'date': int(time.time()), 'text': body.get('text', ''),
+                'chat': {'id': chat_id, 'type': 'private'},
+            }}
+        if api_method == 'answerInlineQuery':
+            results = body.get('results') or []
+            if isinstance(results, str):
+                results = json.loads(results)
+            self.inline_answers[body['inline_query_id']] = (results, time.perf_counter())
+            return 200, {'ok': True, 'result': True}
+        if api_method in ('setWebhook', 'deleteWebhook', 'sendChatAction'):
+            return 200, {'ok': True, 'result': True}
+        return 200, {'ok': False, 'error_code': 404, 'description': f'Unknown method {api_method}'}
+
+
+def synthetic_update(update_id: int, chat_id: int, text: str) -> dict:
+    """Build the JSON of a Telegram update carrying a private text message."""
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private', 'first_name': f'bench-{chat_id}'},
+            'from': {'id': chat_id, 'is_bot': False, 'first_name': f'bench-{chat_id}'},
+            'text': text,
+        },
+    }
+
+
+def synthetic_inline_query(update_id: int, user_id: int, query: str) -> dict:
+    """Build the JSON of a Telegram update carrying an inline query."""
+    return {
+        'update_id': update_id,
+        'inline_query': {
+            'id': str(update_id),
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f'bench-{user_id}'},
+            'query': query,
+            'offset': '',
+        },
+    }
@@ -0,0 +1,415 @@
+# @Author: Humberto Alejandro Ortega Alcocer
+# @Date: 2024-Junio-24
+# @Description: Reproduce valuaciones grabadas contra dos versiones del pipeline y compara la exactitud por campo y la latencia.
+# @Usage: python benchmarks/replay.py grabaciones/ [--baseline HEAD~1] [--candidate .] [--processes 4] [--openai recorded|live] [--skyprice recorded|stub]
+# @License: MIT
+import argparse
+import asyncio
+import contextvars
+import io
+import json
+import os
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+from types import SimpleNamespace
+
+# Sin importaciones del bot a nivel de módulo: cada worker importa el de la versión que reproduce
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.join(BENCHMARKS, '..')
+
+# Campos comparados; Lat/Lng con tolerancia (--coordinate-tolerance)
+COORDINATE_FIELDS = ['Lat', 'Lng']
+
+# Configuración de los workers: sin cachés, estado, grabación, límites ni solicitudes duplicadas
+WORKER_ENV = {
+    'SKYPRICE_EXTRACTION_CACHE_PATH': '',
+    'SKYPRICE_EXTRACTION_CACHE_MEMORY_SIZE': '0',
+    'SKYPRICE_PREDICTION_CACHE_TTL': '0',
+    'SKYPRICE_STATE_PATH': '',
+    'SKYPRICE_COMPARABLES_PATH': '',
+    'SKYPRICE_RECORD_DIR': '',
+    'SKYPRICE_BATCH_API_URL': '',
+    'SKYPRICE_OPENAI_RATE_LIMIT': '0',
+    'SKYPRICE_OPENAI_RPM': '0',
+    'SKYPRICE_OPENAI_TPM': '0',
+    'SKYPRICE_API_RATE_LIMIT': '0',
+    'SKYPRICE_API_HEDGE_QUANTILE': '0',
+}
+
+# Estado del registro que se reproduce en la tarea actual
+current_replay = contextvars.ContextVar('replay', default=None)
+
+# --- Worker: backends grabados o simulados ---------------------------------------------------
+
+def requested_fields(request: dict, apartment_fields: list) -> list:
+    """Return the fields a chat completion request asks for (every field without a JSON schema)."""
+    schema = ((request.get('response_format') or {}).get('json_schema') or {}).get('schema') or {}
+    return list(schema.get('properties') or apartment_fields)
+
+class RecordedStream:
+    """Chat completion stream that sends a recorded answer in small chunks, then the usage."""
+
+    def __init__(self, content: str, seconds: float, chunk_size: int = 16):
+        self.chunks = [content[start:start + chunk_size] for start in range(0, len(content), chunk_size)]
+        self.seconds = seconds
+        self.usage = SimpleNamespace(prompt_tokens=0, completion_tokens=len(content) // 4 + 1)
+
+    async def __aiter__(self):
+        for chunk in self.chunks:
+            await asyncio.sleep(self.seconds / len(self.chunks))
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=chunk))], usage=None)
+        yield SimpleNamespace(choices=[], usage=self.usage)
+
+    async def close(self) -> None:
+        pass
+
+class RecordedCompletions:
+    """Answer each extraction with the next LLM answer recorded for the message.
+
+    When the version under test makes a call that was not recorded, the answer is stubbed
+    from the reference details (``stub_seconds`` late) and counted as such.
+    """
+
+    def __init__(self, apartment_fields: list, latency: bool, stub_seconds: float):
+        self.apartment_fields = apartment_fields
+        self.latency = latency
+        self.stub_seconds = stub_seconds
+
+    async def create(self, stream: bool = False, stream_options=None, **request):
+        state = current_replay.get()
+        state['llm_calls'] += 1
+        recorded = state['record'].get('llm') or []
+        if state['llm_index'] < len(recorded):
+            event = recorded[state['llm_index']]
+            state['llm_index'] += 1
+            content, seconds = event['content'], event.get('ms', 0.0) / 1000
+        else:
+            state['llm_stubbed'] += 1
+            reference = state['reference'] or {}
+            content = json.dumps({field: reference.get(field) for field in requested_fields(request, self.apartment_fields)}, ensure_ascii=False)
+            seconds = self.stub_seconds
+        seconds = seconds if self.latency else 0.0
+        if stream:
+            return RecordedStream(content, seconds)
+        await asyncio.sleep(seconds)
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=content))],
+            usage=SimpleNamespace(prompt_tokens=0, completion_tokens=len(content) // 4 + 1),
+        )
+
+class RecordedOpenAI:
+    """Stand-in for AsyncOpenAI serving recorded answers."""
+
+    def __init__(self, *args, **kwargs):
+        self.chat = SimpleNamespace(completions=RecordedCompletions(*args, **kwargs))
+
+    async def close(self) -> None:
+        pass
+
+class RecordedResponse:
+    """Minimal httpx response with a JSON body."""
+
+    def __init__(self, payload):
+        self.status_code = 200
+        self.payload = payload
+
+    def raise_for_status(self) -> None:
+        pass
+
+    def json(self):
+        return self.payload
+
+def same_request(recorded: dict, sent: dict) -> bool:
+    return all(recorded.get(field) == value for field, value in sent.items())
+
+class RecordedSkyPrice:
+    """Stand-in for the SkyPrice HTTP client: the recorded prediction for the same details, or a stub."""
+
+    def __init__(self, use_recorded: bool, latency: bool, stub_seconds: float):
+        self.use_recorded = use_recorded
+        self.latency = latency
+        self.stub_seconds = stub_seconds
+
+    async def post(self, url: str, json=None):
+        from fake_backends import fake_price
+        state = current_replay.get()
+        state['skyprice_calls'] += 1
+        if isinstance(json, list):
+            await asyncio.sleep(self.stub_seconds if self.latency else 0.0)
+            return RecordedResponse([fake_price(details) for details in json])
+        for event in (state['record'].get('skyprice') or []) if self.use_recorded else []:
+            if event.get('prediction') and not event.get('fallback') and same_request(event['details'], json):
+                prediction = event['prediction']
+                await asyncio.sleep(event.get('ms', 0.0) / 1000 if self.latency else 0.0)
+                return RecordedResponse({
+                    'random_forest': prediction['Random_Forest'], 'svm': prediction['SVM'], 'neural_network': prediction['Neural_Network'],
+                })
+        state['skyprice_stubbed'] += 1
+        await asyncio.sleep(self.stub_seconds if self.latency else 0.0)
+        return RecordedResponse(fake_price(json))
+
+    async def aclose(self) -> None:
+        pass
+
+async def replay_records(bot, records: list, concurrency: int) -> list:
+    """Run every record through ``value_listing`` with at most ``concurrency`` in flight."""
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def replay(record: dict) -> dict:
+        async with semaphore:
+            state = {
+                'record': record, 'reference': record.get('reference'), 'llm_index': 0, 'llm_calls': 0, 'llm_stubbed': 0,
+                'skyprice_calls': 0, 'skyprice_stubbed': 0, 'extraction_s': 0.0, 'prediction_s': 0.0,
+            }
+            current_replay.set(state)
+            started = time.perf_counter()
+            result = await bot.value_listing(record['text'])
+            elapsed = time.perf_counter() - started
+        return {
+            'index': record['index'], 'status': result['status'], 'details': result['details'], 'prediction': result['prediction'],
+            'ms': elapsed * 1000, 'extraction_ms': state['extraction_s'] * 1000, 'prediction_ms': state['prediction_s'] * 1000,
+            **{key: state[key] for key in ('llm_calls', 'llm_stubbed', 'skyprice_calls', 'skyprice_stubbed')},
+        }
+
+    # Cada registro corre en su propia tarea, así que su estado no se mezcla con el de los demás
+    return await asyncio.gather(*(asyncio.ensure_future(replay(record)) for record in records))
+
+def timed_stage(function, key: str):
+    """Wrap a pipeline coroutine function to add its duration to the replay state."""
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await function(*args, **kwargs)
+        finally:
+            state = current_replay.get()
+            if state is not None:
+                state[key] += time.perf_counter() - started
+    return wrapper
+
+def run_worker(args) -> None:
+    """Replay a chunk of records with the bot of ``args.worker`` and print one result per line."""
+    sys.path.insert(0, os.path.abspath(args.worker))
+    import logging
+    logging.disable(logging.CRITICAL)
+    import skyprice_bot
+
+    latency = args.backend_latency == 'recorded'
+    if args.openai == 'recorded':
+        skyprice_bot.client = RecordedOpenAI(skyprice_bot.APARTMENT_FIELDS, latency, args.llm_stub_ms / 1000)
+    if args.skyprice != 'live':
+        skyprice_bot.http_client = RecordedSkyPrice(args.skyprice == 'recorded', latency, args.skyprice_stub_ms / 1000)
+    # value_listing busca estas funciones en el módulo al llamarlas, así que se pueden envolver
+    skyprice_bot.extract_apartment_details = timed_stage(skyprice_bot.extract_apartment_details, 'extraction_s')
+    skyprice_bot.predict_price = timed_stage(skyprice_bot.predict_price, 'prediction_s')
+
+    with open(args.input, encoding='utf-8') as chunk:
+        records = [json.loads(line) for line in chunk]
+    for result in asyncio.run(replay_records(skyprice_bot, records, args.concurrency)):
+        print(json.dumps(result, ensure_ascii=False))
+
+# --- Coordinador: versiones, procesos y reporte -----------------------------------------------
+
+def checkout(revision: str, directory: str) -> str:
+    """Return the source tree of a version: a directory as is, or a git revision extracted into ``directory``."""
+    if os.path.isdir(revision):
+        return os.path.abspath(revision)
+    archive = subprocess.run(['git', '-C', ROOT, 'archive', '--format=tar', revision], check=True, capture_output=True).stdout
+    with tarfile.open(fileobj=io.BytesIO(archive)) as tar:
+        tar.extractall(directory)
+    return directory
+
+def load_records(paths: list, limit: int) -> list:
+    """Load recordings (or a labeled corpus) and attach the reference details of each record."""
+    from skyprice_recorder import read_records
+    records = []
+    for record in read_records(paths):
+        if not record.get('text') or (limit and len(records) >= limit):
+            continue
+        # Un corpus etiquetado trae ``expected``; una grabación, los detalles que produjo el bot
+        record['reference'] = record.get('expected') or (record.get('extraction') or {}).get('details')
+        record['index'] = len(records)
+        records.append(record)
+    return records
+
+def median_recorded_ms(records: list, kind: str) -> float:
+    latencies = sorted(event['ms'] for record in records for event in record.get(kind) or [] if 'ms' in event)
+    return latencies[len(latencies) // 2] if latencies else 0.0
+
+async def run_version(tree: str, records: list, args, llm_stub_ms: float, skyprice_stub_ms: float) -> list:
+    """Replay the records with the pipeline in ``tree``, split across ``args.processes`` worker processes."""
+    env = dict(os.environ, PYTHONPATH=tree, **WORKER_ENV)
+    if args.openai == 'recorded':
+        env.setdefault('OPENAI_API_KEY', 'replay')
+    with tempfile.TemporaryDirectory(prefix='skyprice-replay-') as directory:
+        commands = []
+        for worker in range(min(args.processes, len(records))):
+            path = os.path.join(directory, f'chunk-{worker}.jsonl')
+            with open(path, 'w', encoding='utf-8') as chunk:
+                for record in records[worker::args.processes]:
+                    chunk.write(json.dumps(record, ensure_ascii=False) + '\n')
+            commands.append([
+                sys.executable, os.path.abspath(__file__), '--worker', tree, '--input', path, '--openai', args.openai,
+                '--skyprice', args.skyprice, '--backend-latency', args.backend_latency, '--concurrency', str(args.concurrency),
+                '--llm-stub-ms', str(llm_stub_ms), '--skyprice-stub-ms', str(skyprice_stub_ms),
+            ])
+
+        async def run(command: list) -> list:
+            process = await asyncio.create_subprocess_exec(
+                *command, cwd=tree, env=env, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+            )
+            stdout, stderr = await process.communicate()
+            if process.returncode:
+                raise RuntimeError(f'Replay worker failed for {tree}:\n{stderr.decode("utf-8", "replace")[-2000:]}')
+            return [json.loads(line) for line in stdout.decode('utf-8').splitlines() if line.startswith('{')]
+
+        chunks = await asyncio.gather(*(run(command) for command in commands))
+    return sorted((result for chunk in chunks for result in chunk), key=lambda result: result['index'])
+
+def field_correct(field: str, expected, actual, coordinate_tolerance: float) -> bool:
+    from eval_extraction import same_value
+    if field in COORDINATE_FIELDS and expected is not None and actual is not None:
+        return abs(float(expected) - float(actual)) <= coordinate_tolerance
+    return same_value(expected, actual)
+
+def graded_fields(records: list) -> list:
+    from eval_extraction import GRADED_FIELDS
+    return GRADED_FIELDS + [field for field in COORDINATE_FIELDS if any(field in (record['reference'] or {}) for record in records)]
+
+def latency_summary(samples: list) -> dict:
+    from skyprice_batch import percentile
+    return {name: round(percentile(samples, fraction), 3) for name, fraction in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99), ('max', 1.0))}
+
+def score_version(name: str, records: list, results: list, fields: list, args, elapsed: float) -> dict:
+    """Field-level accuracy against the references, statuses, backend calls and latency distributions."""
+    report = {'version': name, 'records': len(results), 'elapsed_s': round(elapsed, 3), 'fields': {}}
+    referenced = [(record, result) for record, result in zip(records, results) if record['reference']]
+    for field in fields:
+        graded = [(record, result) for record, result in referenced if field in record['reference']]
+        correct = sum(
+            field_correct(field, record['reference'][field], (result['details'] or {}).get(field), args.coordinate_tolerance)
+            for record, result in graded
+        )
+        report['fields'][field] = round(correct / len(graded), 4) if graded else None
+    report['exact_match'] = round(sum(
+        all(field_correct(field, record['reference'][field], (result['details'] or {}).get(field), args.coordinate_tolerance)
+            for field in fields if field in record['reference'])
+        for record, result in referenced
+    ) / len(referenced), 4) if referenced else None
+    statuses = {}
+    for result in results:
+        statuses[result['status']] = statuses.get(result['status'], 0) + 1
+    report['statuses'] = statuses
+    for key in ('llm_calls', 'llm_stubbed', 'skyprice_calls', 'skyprice_stubbed'):
+        report[key] = sum(result[key] for result in results)
+    for key in ('ms', 'extraction_ms', 'prediction_ms'):
+        report['latency_' + key] = latency_summary([result[key] for result in results])
+    return report
+
+def diff_versions(records: list, baseline: list, candidate: list, fields: list, args) -> dict:
+    """Count, per field, the records whose value changed and how many of them were fixed or broken."""
+    diff = {'fields': {}, 'status_changes': 0, 'examples': []}
+    for field in fields:
+        changed = fixed = broken = 0
+        for record, before, after in zip(records, baseline, candidate):
+            old, new = (before['details'] or {}).get(field), (after['details'] or {}).get(field)
+            if field_correct(field, old, new, args.coordinate_tolerance):
+                continue
+            changed += 1
+            if record['reference'] and field in record['reference']:
+                was = field_correct(field, record['reference'][field], old, args.coordinate_tolerance)
+                now = field_correct(field, record['reference'][field], new, args.coordinate_tolerance)
+                fixed += now and not was
+                broken += was and not now
+        diff['fields'][field] = {'changed': changed, 'fixed': fixed, 'broken': broken}
+    for record, before, after in zip(records, baseline, candidate):
+        diff['status_changes'] += before['status'] != after['status']
+        changes = {
+            field: {'baseline': (before['details'] or {}).get(field), 'candidate': (after['details'] or {}).get(field),
+                    'reference': (record['reference'] or {}).get(field)}
+            for field in fields
+            if not field_correct(field, (before['details'] or {}).get(field), (after['details'] or {}).get(field), args.coordinate_tolerance)
+        }
+        if (changes or before['status'] != after['status']) and len(diff['examples']) < args.diffs:
+            diff['examples'].append({'text': record['text'], 'status': [before['status'], after['status']], 'fields': changes})
+    return diff
+
+def regressions(baseline: dict, candidate: dict, args) -> list:
+    """Return the fields whose accuracy dropped and the latencies that grew beyond the tolerances."""
+    found = []
+    for field, accuracy in candidate['fields'].items():
+        before = baseline['fields'].get(field)
+        if accuracy is not None and before is not None and before - accuracy > args.tolerance:
+            found.append(f'{field} accuracy {before} -> {accuracy}')
+    for key in ('latency_ms', 'latency_extraction_ms'):
+        before, after = baseline[key]['p90'], candidate[key]['p90']
+        # Diferencias de menos de --latency-floor-ms son ruido del planificador, no regresiones
+        if before and after - before > args.latency_floor_ms and (after - before) / before > args.latency_tolerance:
+            found.append(f'{key} p90 {before} -> {after}')
+    return found
+
+async def compare(args) -> bool:
+    sys.path.insert(0, ROOT)
+    records = load_records(args.recordings, args.limit)
+    if not records:
+        raise SystemExit('No records to replay')
+    fields = graded_fields(records)
+    llm_stub_ms, skyprice_stub_ms = median_recorded_ms(records, 'llm'), median_recorded_ms(records, 'skyprice')
+
+    with tempfile.TemporaryDirectory(prefix='skyprice-baseline-') as directory:
+        versions = [('candidate', checkout(args.candidate, directory))]
+        if args.baseline:
+            versions.insert(0, ('baseline', checkout(args.baseline, directory)))
+        reports, results = {}, {}
+        for name, tree in versions:
+            started = time.perf_counter()
+            results[name] = await run_version(tree, records, args, llm_stub_ms, skyprice_stub_ms)
+            reports[name] = score_version(name, records, results[name], fields, args, time.perf_counter() - started)
+            print(json.dumps(reports[name], ensure_ascii=False))
+
+    summary = {'records': len(records), 'openai': args.openai, 'skyprice': args.skyprice, 'processes': args.processes}
+    found = []
+    if args.baseline:
+        summary['diff'] = diff_versions(records, results['baseline'], results['candidate'], fields, args)
+        found = regressions(reports['baseline'], reports['candidate'], args)
+        summary['regressions'] = found
+    print(json.dumps(summary, ensure_ascii=False))
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as output:
+            json.dump({'summary': summary, 'versions': reports, 'results': results}, output, ensure_ascii=False, indent=2)
+    return not found
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Replay recorded valuations against two pipeline versions and compare them.')
+    parser.add_argument('recordings', nargs='*', help='Recording segments or directories (SKYPRICE_RECORD_DIR) or a labeled JSONL corpus.')
+    parser.add_argument('--baseline', default=None, help='Baseline version: a git revision or a source directory.')
+    parser.add_argument('--candidate', default=ROOT, help='Candidate version: a source directory (the working tree by default) or a git revision.')
+    parser.add_argument('--processes', type=int, default=os.cpu_count() or 1, help='Worker processes per version.')
+    parser.add_argument('--concurrency', type=int, default=8, help='Records in flight per worker.')
+    parser.add_argument('--openai', choices=['recorded', 'live'], default='recorded', help='Serve the recorded LLM answers or call OpenAI (to test prompt changes).')
+    parser.add_argument('--skyprice', choices=['recorded', 'stub', 'live'], default='recorded', help='Serve the recorded predictions, a deterministic stub or call SKYPRICE_API_URL.')
+    parser.add_argument('--backend-latency', choices=['recorded', 'none'], default='recorded', help='Replay the recorded backend latency or answer at once.')
+    parser.add_argument('--limit', type=int, default=0, help='Replay at most this many records (0 = all).')
+    parser.add_argument('--coordinate-tolerance', type=float, default=0.001, help='Degrees within which Lat/Lng count as equal.')
+    parser.add_argument('--tolerance', type=float, default=0.0, help='Accuracy drop per field tolerated before failing.')
+    parser.add_argument('--latency-tolerance', type=float, default=0.2, help='Relative p90 latency growth tolerated before failing.')
+    parser.add_argument('--latency-floor-ms', type=float, default=5.0, help='Absolute p90 latency growth ignored as noise.')
+    parser.add_argument('--diffs', type=int, default=10, help='Changed records shown as examples.')
+    parser.add_argument('--output', default=None, help='Write the full report (every result) as JSON.')
+    parser.add_argument('--worker', default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--input', default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--llm-stub-ms', type=float, default=0.0, help=argparse.SUPPRESS)
+    parser.add_argument('--skyprice-stub-ms', type=float, default=0.0, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.worker:
+        run_worker(args)
+        return
+    if not args.recordings:
+        parser.error('at least one recording is required')
+    sys.exit(0 if asyncio.run(compare(args)) else 1)
+
+if __name__ == '__main__':
+    main()
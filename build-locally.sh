@@ -9,3 +9,6 @@ docker buildx build --platform linux/amd64 -t skyprice-chatbot:latest .
 # Exportar la imagen de Docker a un archivo tar.
 docker save skyprice-chatbot:latest -o skyprice-chatbot.tar
 
+
+# Construir la imagen reducida para despliegues serverless (scale-to-zero).
+docker buildx build --platform linux/amd64 -f Dockerfile.slim -t skyprice-chatbot:slim .
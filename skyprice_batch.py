@@ -0,0 +1,103 @@
+# @Author: Humberto Alejandro Ortega Alcocer
+# @Date: 2024-Junio-24
+# @Description: Agrupador de predicciones (micro-batching) que combina solicitudes concurrentes a SkyPrice en un solo request.
+# @License: MIT
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Awaitable, Callable, List
+
+from skyprice_models import ApartmentDetails, PricePrediction
+
+# Get the logger instance
+logger = logging.getLogger(__name__)
+
+def percentile(samples, fraction: float) -> float:
+    """Return the given percentile (0-1) of the samples using nearest-rank."""
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+class PredictionBatcher:
+    """Collect pending predictions for up to ``window`` seconds or ``max_batch_size`` items.
+
+    ``send_batch`` receives the list of ApartmentDetails and must return one PricePrediction
+    per item, in order. Each caller awaits only its own result; a failed batch fails every
+    caller in it.
+    """
+
+    def __init__(self, send_batch: Callable[[List[ApartmentDetails]], Awaitable[List[PricePrediction]]],
+                 window: float = 0.01, max_batch_size: int = 16, samples: int = 1024):
+        self.send_batch = send_batch
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self.batches = 0
+        self.items = 0
+        self.failed_batches = 0
+        self._pending = []
+        self._timer = None
+        self._tasks = set()
+        self._batch_sizes = deque(maxlen=samples)
+        self._added_latencies = deque(maxlen=samples)
+
+    async def predict(self, details: ApartmentDetails) -> PricePrediction:
+        """Queue the details for the next batch and wait for its prediction."""
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((details, future, time.monotonic()))
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.window, self._flush)
+        return await future
+
+    def _flush(self) -> None:
+        """Send the pending items as one batch."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._pending:
+            return
+        batch, self._pending = self._pending[:self.max_batch_size], self._pending[self.max_batch_size:]
+        if self._pending:
+            self._timer = asyncio.get_running_loop().call_later(self.window, self._flush)
+        task = asyncio.ensure_future(self._send(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _send(self, batch) -> None:
+        """Send one batch and fan the results back to the waiting callers."""
+        sent_at = time.monotonic()
+        self.batches += 1
+        self.items += len(batch)
+        self._batch_sizes.append(len(batch))
+        for _, _, enqueued_at in batch:
+            self._added_latencies.append(sent_at - enqueued_at)
+        try:
+            predictions = await self.send_batch([details for details, _, _ in batch])
+            if len(predictions) != len(batch):
+                raise ValueError(f"Batch returned {len(predictions)} predictions for {len(batch)} items")
+        except Exception as e:
+            self.failed_batches += 1
+            logger.info("Prediction batch of %s failed: %s", len(batch), e)
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future, _), prediction in zip(batch, predictions):
+            if not future.done():
+                future.set_result(prediction)
+
+    def stats(self) -> dict:
+        """Return batch counts, batch size and the latency added by waiting for the window."""
+        return {
+            'batches': self.batches,
+            'items': self.items,
+            'failed_batches': self.failed_batches,
+            'mean_batch_size': self.items / self.batches if self.batches else 0.0,
+            'max_batch_size': max(self._batch_sizes, default=0),
+            'added_latency_p50_s': percentile(self._added_latencies, 0.50),
+            'added_latency_p99_s': percentile(self._added_latencies, 0.99),
+            'pending': len(self._pending),
+        }
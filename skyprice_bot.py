@@ -1,38 +1,276 @@
 # @Author: Humberto Alejandro Ortega Alcocer
 # @Date: 2024-Abril-8
 # @Description: Bot de Telegram para la valuación de departamentos en la Ciudad de México utilizando OpenAI y la API de SkyPrice.
-# @Dependencies: python-telegram-bot, openai, requests
-# @Usage: python skyprice_bot.py
+# @Dependencies: python-telegram-bot, openai, httpx
+# @Usage: python skyprice_bot.py [polling | webhook | bulk <input> <output>]
 # @License: MIT
+import argparse
+import asyncio
 import logging
-from typing import Union
-from telegram import  Update
+import threading
+import time
+from typing import List, Optional, Union
+from telegram import  InlineQueryResultArticle, InlineQueryResultsButton, InputTextMessageContent, Update
 from telegram.ext import (
     Application,
     CommandHandler,
     ContextTypes,
     ConversationHandler,
+    InlineQueryHandler,
     MessageHandler,
     filters,
 )
-import requests
-from openai import OpenAI
-import json
+import httpx
 from dotenv import load_dotenv
 import os
 
+from skyprice_batch import PredictionBatcher
+from skyprice_cache import ExtractionCache, PredictionCache, fingerprint, normalize_text
+from skyprice_comparables import ComparablesStore
+from skyprice_geo import gazetteer
+from skyprice_inline import InlineQueryCoordinator
+from skyprice_limits import RateLimiter
+from skyprice_logging import PAYLOAD, REDACTED_FIELDS, setup_logging
+from skyprice_metrics import (
+    InstrumentedRequest,
+    MetricsServer,
+    TraceIdFilter,
+    errors_total,
+    extraction_aborts_total,
+    extraction_cost_usd_total,
+    extraction_tier_seconds,
+    extraction_tier_total,
+    extraction_tokens_total,
+    follow_ups_total,
+    registry,
+    stage,
+    traced,
+    valuations_total,
+)
+from skyprice_models import (
+    APARTMENT_FIELDS,
+    NUMERIC_FIELDS,
+    ApartmentDetails,
+    FallbackPrediction,
+    PricePrediction,
+    missing_fields,
+    validate_details,
+    validate_known_fields,
+    validate_many,
+)
+from skyprice_parser import fast_path_stats, parse_apartment_details, parse_bare_count, split_listings
+from skyprice_progress import ProgressReply, drain_pending_deliveries, send_with_retry
+from skyprice_recorder import Recorder, discard_record, record_event, record_field
+from skyprice_resilience import CircuitBreaker, CircuitOpenError, FallbackEstimator, HedgingPolicy
+from skyprice_scheduler import FairScheduler
+from skyprice_store import PreferenceStore
+from skyprice_stream import IncrementalJSONParser
+from skyprice_webhook import ChatOrderedUpdateProcessor, TimedUpdateQueue
+
 # Load environment variables
 load_dotenv()
 
-# Initialize OpenAI API key
-client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
+class LazyClient:
+    """Build a client on first use and reuse it afterwards.
+
+    Importing and configuring the HTTP clients (openai alone is most of the import time)
+    is deferred until a request needs them, so a cold start that only parses the message
+    locally never pays for it. ``close()`` and ``aclose()`` only close a client that was built.
+    """
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._instance = None
+
+    @property
+    def built(self) -> bool:
+        return self._instance is not None
+
+    def __getattr__(self, name):
+        if self._instance is None:
+            self._instance = self._factory()
+        return getattr(self._instance, name)
+
+    async def close(self) -> None:
+        if self._instance is not None:
+            await self._instance.close()
+            self._instance = None
+
+    async def aclose(self) -> None:
+        if self._instance is not None:
+            await self._instance.aclose()
+            self._instance = None
+
+class LazyStore(LazyClient):
+    """Open a SQLite-backed store on first use, so importing the bot touches no files.
+
+    Stores are also used from threads (the comparables queries and the fallback estimator),
+    so the first use is guarded by a lock. ``open_stores`` opens them in a thread when the
+    application starts, so no handler opens a database on the event loop. Until the store is opened ``stats()`` is empty and
+    ``flush()`` and ``close()`` do nothing.
+    """
+
+    def __init__(self, factory):
+        super().__init__(factory)
+        self._lock = threading.Lock()
+
+    def open(self):
+        """Return the store, opening it if needed."""
+        if self._instance is None:
+            with self._lock:
+                if self._instance is None:
+                    self._instance = self._factory()
+        return self._instance
+
+    def __getattr__(self, name):
+        return getattr(self.open(), name)
+
+    def stats(self) -> dict:
+        return self._instance.stats() if self._instance is not None else {}
+
+    def flush(self, *args, **kwargs) -> None:
+        if self._instance is not None:
+            self._instance.flush(*args, **kwargs)
+
+    def close(self) -> None:
+        if self._instance is not None:
+            self._instance.close()
+            self._instance = None
+
+def create_openai_client():
+    """Build the OpenAI client (async so extraction never blocks the event loop)."""
+    from openai import AsyncOpenAI
+    return AsyncOpenAI(api_key=os.getenv('OPENAI_API_KEY'))
+
+# Initialize OpenAI API key; the client is built on the first extraction
+client = LazyClient(create_openai_client)
 
 # SkyPrice API URL
-SKYPRICE_API_URL = 'https://api.skyprice.xyz/predict'
+SKYPRICE_API_URL = os.getenv('SKYPRICE_API_URL', 'https://api.skyprice.xyz/predict')
+
+# Optional SkyPrice batch endpoint; when set, concurrent predictions are grouped into a single request
+SKYPRICE_BATCH_API_URL = os.getenv('SKYPRICE_BATCH_API_URL', '')
+PREDICTION_BATCH_WINDOW = float(os.getenv('SKYPRICE_BATCH_WINDOW', '0.01'))
+PREDICTION_BATCH_SIZE = int(os.getenv('SKYPRICE_BATCH_SIZE', '16'))
+
+# Per-backend rate limits (requests per second, 0 = unlimited) and their burst sizes
+OPENAI_RATE_LIMIT = float(os.getenv('SKYPRICE_OPENAI_RATE_LIMIT', '0'))
+SKYPRICE_RATE_LIMIT = float(os.getenv('SKYPRICE_API_RATE_LIMIT', '0'))
+RATE_LIMIT_BURST = int(os.getenv('SKYPRICE_RATE_LIMIT_BURST', '1'))
+skyprice_rate_limiter = RateLimiter(SKYPRICE_RATE_LIMIT, RATE_LIMIT_BURST)
+
+# Resiliencia de SkyPrice: plazo por predicción, solicitud duplicada cuando la primera tarda más que el
+# percentil indicado de la latencia reciente (0 lo desactiva), circuit breaker y, con el circuito
+# abierto, estimación local de respaldo
+SKYPRICE_API_DEADLINE = float(os.getenv('SKYPRICE_API_DEADLINE', '10'))
+SKYPRICE_HEDGE_QUANTILE = float(os.getenv('SKYPRICE_API_HEDGE_QUANTILE', '0.95'))
+SKYPRICE_HEDGE_MAX_RATIO = float(os.getenv('SKYPRICE_API_HEDGE_MAX_RATIO', '0.1'))
+skyprice_hedging = HedgingPolicy(SKYPRICE_HEDGE_QUANTILE, max_ratio=SKYPRICE_HEDGE_MAX_RATIO)
+skyprice_batch_hedging = HedgingPolicy(SKYPRICE_HEDGE_QUANTILE, max_ratio=SKYPRICE_HEDGE_MAX_RATIO)
+skyprice_breaker = CircuitBreaker(
+    failure_threshold=int(os.getenv('SKYPRICE_API_BREAKER_FAILURES', '5')),
+    reset_timeout=float(os.getenv('SKYPRICE_API_BREAKER_RESET', '30')),
+)
+PREDICTION_FALLBACK = os.getenv('SKYPRICE_PREDICTION_FALLBACK', '1').lower() in ('1', 'true', 'yes')
+
+# OpenAI budgets per minute (0 = unlimited); requests per minute override SKYPRICE_OPENAI_RATE_LIMIT
+# and tokens per minute allow bursts of ten seconds' worth of tokens
+OPENAI_RPM = float(os.getenv('SKYPRICE_OPENAI_RPM', '0'))
+OPENAI_TPM = float(os.getenv('SKYPRICE_OPENAI_TPM', '0'))
+openai_rate_limiter = RateLimiter(OPENAI_RPM / 60 if OPENAI_RPM else OPENAI_RATE_LIMIT, RATE_LIMIT_BURST)
+openai_token_limiter = RateLimiter(OPENAI_TPM / 60, max(1, int(OPENAI_TPM / 6)))
+
+# Maximum number of updates processed concurrently by the Telegram application
+MAX_CONCURRENT_UPDATES = int(os.getenv('SKYPRICE_MAX_CONCURRENT_UPDATES', '32'))
+
+# Admission control: waiting updates per chat and overall, and the longest wait for the OpenAI
+# budget before new messages are turned away (0 = never shed for budget)
+USER_QUEUE_LIMIT = int(os.getenv('SKYPRICE_USER_QUEUE_LIMIT', '5'))
+MAX_QUEUED_UPDATES = int(os.getenv('SKYPRICE_MAX_QUEUED_UPDATES', '1000'))
+MAX_QUEUE_WAIT = float(os.getenv('SKYPRICE_MAX_QUEUE_WAIT', '30'))
+
+def openai_backlog() -> float:
+    """Return the seconds of OpenAI budget already committed to waiting requests."""
+    return max(openai_rate_limiter.backlog(), openai_token_limiter.backlog())
+
+update_scheduler = FairScheduler(MAX_CONCURRENT_UPDATES, per_key_limit=1, max_queued_per_key=USER_QUEUE_LIMIT,
+                                 max_queued=MAX_QUEUED_UPDATES, max_wait=MAX_QUEUE_WAIT, backlog=openai_backlog)
+
+# Pooled keep-alive HTTP client for the SkyPrice API, built on the first prediction
+http_client = LazyClient(lambda: httpx.AsyncClient(
+    timeout=httpx.Timeout(30.0, connect=5.0),
+    limits=httpx.Limits(
+        max_connections=MAX_CONCURRENT_UPDATES,
+        max_keepalive_connections=MAX_CONCURRENT_UPDATES,
+        keepalive_expiry=60.0,
+    ),
+))
 
 # Telegram bot token
 TELEGRAM_TOKEN = os.getenv('TELEGRAM_TOKEN','fake_token')
 
+# Response mode: 'messages' sends one message per stage, 'edit' edits a single message in place
+RESPONSE_MODE = os.getenv('SKYPRICE_RESPONSE_MODE', 'messages')
+PROGRESS_DELAY = float(os.getenv('SKYPRICE_PROGRESS_DELAY', '0.5'))
+PROGRESS_EDIT_INTERVAL = float(os.getenv('SKYPRICE_PROGRESS_EDIT_INTERVAL', '1.0'))
+
+# Retries (with exponential backoff) of failed Telegram sends
+TELEGRAM_SEND_RETRIES = int(os.getenv('SKYPRICE_TELEGRAM_SEND_RETRIES', '3'))
+TELEGRAM_SEND_BACKOFF = float(os.getenv('SKYPRICE_TELEGRAM_SEND_BACKOFF', '0.5'))
+
+# Longest wait at shutdown (or at the end of a serverless invocation) for final replies still being delivered
+DELIVERY_DRAIN_TIMEOUT = float(os.getenv('SKYPRICE_DELIVERY_DRAIN_TIMEOUT', '10'))
+
+# Prometheus metrics endpoint (0 disables it); webhook workers listen on consecutive ports
+METRICS_HOST = os.getenv('SKYPRICE_METRICS_HOST', '0.0.0.0')
+METRICS_PORT = int(os.getenv('SKYPRICE_METRICS_PORT', '0'))
+WORKER_INDEX = int(os.getenv('SKYPRICE_WORKER_INDEX', '0'))
+
+# Add a per-request trace id to every log line
+LOG_TRACE_IDS = os.getenv('SKYPRICE_LOG_TRACE_IDS', '').lower() in ('1', 'true', 'yes')
+
+# Log format ('text' or 'json'), fraction of verbose payload records kept and redaction of user data
+LOG_FORMAT = os.getenv('SKYPRICE_LOG_FORMAT', 'text')
+LOG_PAYLOAD_SAMPLE_RATE = float(os.getenv('SKYPRICE_LOG_PAYLOAD_SAMPLE_RATE', '0.01'))
+LOG_REDACT = os.getenv('SKYPRICE_LOG_REDACT', '1').lower() in ('1', 'true', 'yes')
+
+# Optional Bot API server (e.g. a self-hosted one); empty uses api.telegram.org
+TELEGRAM_API_BASE_URL = os.getenv('TELEGRAM_API_BASE_URL', '')
+
+# Webhook mode settings
+WEBHOOK_URL = os.getenv('SKYPRICE_WEBHOOK_URL', '')
+WEBHOOK_SECRET = os.getenv('SKYPRICE_WEBHOOK_SECRET', '')
+WEBHOOK_HOST = os.getenv('SKYPRICE_WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('SKYPRICE_WEBHOOK_PORT', '8443'))
+WEBHOOK_PATH = os.getenv('SKYPRICE_WEBHOOK_PATH', '/telegram')
+WEBHOOK_WORKERS = int(os.getenv('SKYPRICE_WEBHOOK_WORKERS', '1'))
+
+# Conversación de seguimiento: se conservan los datos parciales de una valuación incompleta durante
+# SKYPRICE_FOLLOW_UP_TIMEOUT segundos y se piden solo los campos faltantes (0 lo desactiva)
+FOLLOW_UP_TIMEOUT = float(os.getenv('SKYPRICE_FOLLOW_UP_TIMEOUT', '600'))
+AWAITING_FIELDS = 1
+PENDING_DETAILS_KEY = 'pending_details'
+
+# Mensajes con varios anuncios: se valúan juntos hasta SKYPRICE_MAX_LISTINGS por mensaje (1 lo desactiva)
+MAX_LISTINGS = int(os.getenv('SKYPRICE_MAX_LISTINGS', '10'))
+
+# Comparables: valuaciones previas devueltas por /comparables, radio (km) de las estadísticas de
+# precio por m² y distancia máxima (km) de búsqueda
+COMPARABLES_K = int(os.getenv('SKYPRICE_COMPARABLES_K', '5'))
+COMPARABLES_RADIUS_KM = float(os.getenv('SKYPRICE_COMPARABLES_RADIUS_KM', '1.0'))
+COMPARABLES_MAX_KM = float(os.getenv('SKYPRICE_COMPARABLES_MAX_KM', '5.0'))
+LAST_VALUATION_KEY = 'last_valuation'
+
+# Modo inline: segundos de espera tras la última tecla, plazo para responder (Telegram descarta las
+# respuestas tardías), vida de los resultados en caché y longitud mínima de la consulta a valuar
+INLINE_DEBOUNCE = float(os.getenv('SKYPRICE_INLINE_DEBOUNCE', '0.4'))
+INLINE_DEADLINE = float(os.getenv('SKYPRICE_INLINE_DEADLINE', '8'))
+INLINE_CACHE_TTL = float(os.getenv('SKYPRICE_INLINE_CACHE_TTL', '300'))
+INLINE_MIN_LENGTH = int(os.getenv('SKYPRICE_INLINE_MIN_LENGTH', '10'))
+
+# Alcaldías válidas, calculadas una sola vez para validar cada mensaje
+MUNICIPALITIES = frozenset(gazetteer.municipality_names())
+
 # Language dictionary
 LANGUAGE_COMMANDS = {
     'inicio': 'es',
@@ -42,47 +280,155 @@ LANGUAGE_COMMANDS = {
     'portuguese': 'pt'
 }
 
-# Enable logging
-logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
-)
-# Set higher logging level for httpx to avoid all GET and POST requests being logged
-logging.getLogger("httpx").setLevel(logging.WARNING)
+# Modelo y prompt de sistema para la extracción de detalles del departamento
+EXTRACTION_MODEL = 'gpt-4o'
+
+# Cascada de modelos "modelo:max_tokens", del más barato al más capaz; se escala al siguiente
+# nivel solo si la respuesta trae campos nulos o no pasa las validaciones
+def parse_extraction_tiers(spec: str) -> list:
+    """Parse ``"model:max_tokens,..."`` into (model, max_tokens) tiers; max_tokens defaults to 600."""
+    tiers = []
+    for tier in spec.split(','):
+        model, _, max_tokens = tier.strip().partition(':')
+        if model:
+            tiers.append((model, int(max_tokens or '600')))
+    return tiers
+
+EXTRACTION_TIERS = parse_extraction_tiers(os.getenv('SKYPRICE_EXTRACTION_MODELS', f'gpt-4o-mini:300,{EXTRACTION_MODEL}:600'))
+
+# Precio en USD por millón de tokens (entrada, salida) para estimar el costo de cada nivel
+MODEL_PRICES = {'gpt-4o': (2.50, 10.00), 'gpt-4o-mini': (0.15, 0.60), 'gpt-4.1': (2.00, 8.00), 'gpt-4.1-mini': (0.40, 1.60), 'gpt-4.1-nano': (0.10, 0.40)}
+EXTRACTION_FIELD_TYPES = {'Size_Terrain': 'int', 'Size_Construction': 'int', 'Rooms': 'int', 'Bathrooms': 'float', 'Parking': 'int', 'Age': 'int', 'Lat': 'float', 'Lng': 'float', 'Municipality': 'str'}
+EXTRACTION_PROMPT_TEMPLATE = "Extract the following CDMX apartment details from the text in JSON format, if impossible to extract, leave null: \n{schema} \nUnits should be in meters for size and years for age. If given the date of construction, calculate age. \nLat and Lng you should provide with the closer coordinates you can find for the apartment \nor fallback to the center of detected Municipality (always provide lat/lng). \nMunicipality should be one of the 16 CDMX municipalities: [\nÁlvaro Obregón', 'Azcapotzalco', 'Benito Juárez', 'Coyoacán', 'Cuajimalpa', 'Cuauhtémoc',\nGustavo A. Madero', 'Iztacalco', 'Iztapalapa', 'Magdalena Contreras', 'Miguel Hidalgo',\nMilpa Alta', 'Tláhuac', 'Tlalpan', 'Venustiano Carranza', 'Xochimilco']\nProvide the response without any formatting or additional line breaks, just the minified JSON ready to serialize.\n"
+
+def build_extraction_prompt(fields) -> str:
+    """Build the system prompt asking the LLM only for the given fields."""
+    schema = '{' + ','.join(f'"{field}":{EXTRACTION_FIELD_TYPES[field]}' for field in fields) + '}'
+    return EXTRACTION_PROMPT_TEMPLATE.replace('{schema}', schema)
+
+EXTRACTION_SYSTEM_PROMPT = build_extraction_prompt(APARTMENT_FIELDS)
+
+# Transmitir la extracción para validar cada campo en cuanto llega y cancelar si no tiene solución
+EXTRACTION_STREAM = os.getenv('SKYPRICE_EXTRACTION_STREAM', '1').lower() in ('1', 'true', 'yes')
+
+# Salida restringida por esquema JSON (structured outputs); desactivar para modelos que no la soportan
+EXTRACTION_JSON_SCHEMA = os.getenv('SKYPRICE_EXTRACTION_JSON_SCHEMA', '1').lower() in ('1', 'true', 'yes')
+JSON_SCHEMA_TYPES = {'int': 'integer', 'float': 'number', 'str': 'string'}
+
+def build_response_format(fields) -> dict:
+    """Build a strict JSON schema response format requesting the given fields (each nullable)."""
+    return {
+        'type': 'json_schema',
+        'json_schema': {
+            'name': 'apartment_details',
+            'strict': True,
+            'schema': {
+                'type': 'object',
+                'properties': {field: {'type': [JSON_SCHEMA_TYPES[EXTRACTION_FIELD_TYPES[field]], 'null']} for field in fields},
+                'required': list(fields),
+                'additionalProperties': False,
+            },
+        },
+    }
+
+LISTINGS_PROMPT_SUFFIX = "The text contains {count} numbered listings. Answer {{\"listings\":[...]}} with one object per listing, in the same order.\n"
+
+def build_listings_prompt(count: int) -> str:
+    """Build the system prompt asking the LLM for every field of each of ``count`` listings."""
+    return EXTRACTION_SYSTEM_PROMPT + LISTINGS_PROMPT_SUFFIX.format(count=count)
+
+def build_listings_response_format() -> dict:
+    """Build a strict JSON schema response format requesting a list of apartments."""
+    item = build_response_format(APARTMENT_FIELDS)['json_schema']['schema']
+    return {
+        'type': 'json_schema',
+        'json_schema': {
+            'name': 'apartment_listings',
+            'strict': True,
+            'schema': {
+                'type': 'object',
+                'properties': {'listings': {'type': 'array', 'items': item}},
+                'required': ['listings'],
+                'additionalProperties': False,
+            },
+        },
+    }
+
+def configure_logging() -> None:
+    """Enable logging, written from a background thread; each entry point calls it once at startup."""
+    setup_logging(
+        level=logging.INFO, json_format=LOG_FORMAT == 'json', trace_ids=LOG_TRACE_IDS, sample_rate=LOG_PAYLOAD_SAMPLE_RATE,
+        redact_fields=REDACTED_FIELDS if LOG_REDACT else None, filters=[TraceIdFilter()],
+    )
+    # Set higher logging level for httpx to avoid all GET and POST requests being logged
+    logging.getLogger("httpx").setLevel(logging.WARNING)
 
 # Get the logger instance
 logger = logging.getLogger(__name__)
 
-# Clase para representar los datos requeridos de un departamento
-class ApartmentDetails:
-    def __init__(self, size_terrain, size_construction, rooms, bathrooms, parking, age, lat, lng, municipality):
-        """Initialize the apartment details."""
-        self.Size_Terrain = size_terrain
-        self.Size_Construction = size_construction
-        self.Rooms = rooms
-        self.Bathrooms = bathrooms
-        self.Parking = parking
-        self.Age = age
-        self.Lat = lat
-        self.Lng = lng
-        self.Municipality = municipality
-
-# Clase para representar la predicción de precios
-class PricePrediction:
-    def __init__(self, random_forest, svm, neural_network):
-        """Initialize the price prediction."""
-        self.Random_Forest = random_forest
-        self.SVM = svm
-        self.Neural_Network = neural_network
+# Importar el bot no crea archivos ni hilos: el logging lo configura cada punto de entrada, los
+# almacenes SQLite se abren al arrancar la aplicación (o con su primer uso) y la grabación inicia
+# su hilo con la primera valuación grabada
+
+# Caché de extracciones; el hash del modelo y de la plantilla del prompt forma parte de la llave para invalidarla al cambiarlos
+extraction_cache = LazyStore(lambda: ExtractionCache(
+    path=os.getenv('SKYPRICE_EXTRACTION_CACHE_PATH', 'skyprice_cache.sqlite3') or None,
+    namespace=fingerprint(*(model for model, _ in EXTRACTION_TIERS), EXTRACTION_PROMPT_TEMPLATE),
+    ttl=float(os.getenv('SKYPRICE_EXTRACTION_CACHE_TTL', str(7 * 24 * 3600))),
+    max_memory_entries=int(os.getenv('SKYPRICE_EXTRACTION_CACHE_MEMORY_SIZE', '1024')),
+    max_disk_entries=int(os.getenv('SKYPRICE_EXTRACTION_CACHE_DISK_SIZE', '100000')),
+))
+
+# Preferencias de usuario (idioma) compartidas entre procesos
+preference_store = LazyStore(lambda: PreferenceStore(os.getenv('SKYPRICE_STATE_PATH', 'skyprice_state.sqlite3') or None))
+
+# Caché de predicciones con coordenadas cuantizadas; cambiar SKYPRICE_MODEL_VERSION invalida los precios anteriores
+prediction_cache = PredictionCache(
+    ttl=float(os.getenv('SKYPRICE_PREDICTION_CACHE_TTL', str(6 * 3600))),
+    grid=float(os.getenv('SKYPRICE_PREDICTION_CACHE_GRID', '0.001')),
+    max_entries=int(os.getenv('SKYPRICE_PREDICTION_CACHE_SIZE', '4096')),
+    version=os.getenv('SKYPRICE_MODEL_VERSION', ''),
+)
+
+# Valuaciones producidas (solo agregar, escritas por un hilo) con índice de cuadrícula para /comparables
+comparables_store = LazyStore(lambda: ComparablesStore(
+    os.getenv('SKYPRICE_COMPARABLES_PATH', 'skyprice_comparables.sqlite3') or None,
+    cell_size=float(os.getenv('SKYPRICE_COMPARABLES_CELL', '0.0025')),
+))
+
+# Grabación opcional de las valuaciones para reproducirlas con benchmarks/replay.py (vacío la desactiva)
+recorder = Recorder(
+    os.getenv('SKYPRICE_RECORD_DIR', '') or None,
+    segment_bytes=int(float(os.getenv('SKYPRICE_RECORD_SEGMENT_MB', '16')) * 1024 * 1024),
+    sample_rate=float(os.getenv('SKYPRICE_RECORD_SAMPLE_RATE', '1.0')),
+    redact=os.getenv('SKYPRICE_RECORD_REDACT', '1').lower() in ('1', 'true', 'yes'),
+)
+
+# Valuaciones de las consultas inline: una por usuario, con debounce, cancelación y caché breve
+inline_coordinator = InlineQueryCoordinator(
+    debounce=INLINE_DEBOUNCE, deadline=INLINE_DEADLINE, ttl=INLINE_CACHE_TTL,
+    cacheable=lambda result: result['status'] not in ('not_extracted', 'fallback'),
+)
+
+# Estimador de respaldo: precio por m² de las valuaciones cercanas o de la alcaldía; las anteriores al
+# arranque se leen del almacén de comparables y las nuevas se observan al recibirlas de SkyPrice
+fallback_estimator = FallbackEstimator(
+    area_stats=lambda lat, lng: comparables_store.area_stats(lat, lng, COMPARABLES_RADIUS_KM),
+    load=lambda before=time.time(): comparables_store.municipality_price_m2(before=before),
+)
+# Calibración del estimador lanzada al arrancar (ver start_services)
+fallback_calibration = None
 
 async def set_language(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Set the language for the bot."""
     command = update.message.text.lower().strip('/')
+    user = update.message.from_user
     if command in LANGUAGE_COMMANDS:
-        context.user_data['language'] = LANGUAGE_COMMANDS[command]
-    language = context.user_data.get('language', 'es')
+        await preference_store.aset_language(user.id, LANGUAGE_COMMANDS[command])
+    context.user_data.pop(PENDING_DETAILS_KEY, None)
+    language = await preference_store.aget_language(user.id)
 
-    user = update.message.from_user
-    logger.info(f"Language set to {language} for {user.first_name}")
+    logger.info("Language set to %s", language, extra={'user_name': user.first_name})
 
     if language == 'es':
         await start(update, context)
@@ -99,7 +445,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Send a message when the command /inicio is issued."""
     # Log the start command user and message
     user = update.message.from_user
-    logger.info("Comando de inicio recibido de %s: %s", user.first_name, update.message.text)
+    logger.info("Comando de inicio recibido: %s", update.message.text, extra={'user_name': user.first_name})
 
     # Send the welcome message
     await update.message.reply_text(
@@ -124,7 +470,7 @@ async def start_fr(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Send a message when the command /french is issued."""
     # Log the start command user and message
     user = update.message.from_user
-    logger.info("Comando de inicio en francés recibido de %s: %s", user.first_name, update.message.text)
+    logger.info("Comando de inicio en francés recibido: %s", update.message.text, extra={'user_name': user.first_name})
 
     # Send the welcome message
     await update.message.reply_text(
@@ -149,7 +495,7 @@ async def start_pt(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Send a message when the command /portuguese is issued."""
     # Log the start command user and message
     user = update.message.from_user
-    logger.info("Comando de inicio en portugués recibido de %s: %s", user.first_name, update.message.text)
+    logger.info("Comando de inicio en portugués recibido: %s", update.message.text, extra={'user_name': user.first_name})
 
     # Send the welcome message
     await update.message.reply_text(
@@ -174,7 +520,7 @@ async def start_en(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Send a message when the command /english is issued."""
     # Log the start command user and message
     user = update.message.from_user
-    logger.info("Comando de inicio en inglés recibido de %s: %s", user.first_name, update.message.text)
+    logger.info("Comando de inicio en inglés recibido: %s", update.message.text, extra={'user_name': user.first_name})
 
     # Send the welcome message
     await update.message.reply_text(
@@ -195,113 +541,725 @@ async def start_en(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
 
     return ConversationHandler.END
 
-def extract_apartment_details(text) -> Union[ApartmentDetails, None]:
-    """Extract apartment details from the text using OpenAI's GPT-3."""
+def pop_pending_details(context) -> Optional[dict]:
+    """Take the user's pending incomplete valuation, unless it expired."""
+    user_data = getattr(context, 'user_data', None)
+    pending = user_data.pop(PENDING_DETAILS_KEY, None) if user_data is not None else None
+    if pending is None or pending['expires'] < time.monotonic():
+        return None
+    return pending
 
-    # Log the text to extract apartment details
-    logger.info(f"Extracting apartment details from text: {text}")
+class ExtractionAborted(Exception):
+    """The streamed extraction was cancelled because a field failed a validation rule.
 
-    # Use OpenAI's GPT-3 to extract apartment details
-    try:
-        response = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {
-                    "role": "system",
-                    "content": [
-                        {
-                            "type": "text",
-                            "text": "Extract the following CDMX apartment details from the text in JSON format, if impossible to extract, leave null: \n{\"Size_Terrain\":int,\"Size_Construction\":int,\"Rooms\":int,\"Bathrooms\":float,Parking\":int,\"Age\":int,\"Lat\":float, \"Lng\":float,\"Municipality\":str} \nUnits should be in meters for size and years for age. If given the date of construction, calculate age. \nLat and Lng you should provide with the closer coordinates you can find for the apartment \nor fallback to the center of detected Municipality (always provide lat/lng). \nMunicipality should be one of the 16 CDMX municipalities: [\nÁlvaro Obregón', 'Azcapotzalco', 'Benito Juárez', 'Coyoacán', 'Cuajimalpa', 'Cuauhtémoc',\nGustavo A. Madero', 'Iztacalco', 'Iztapalapa', 'Magdalena Contreras', 'Miguel Hidalgo',\nMilpa Alta', 'Tláhuac', 'Tlalpan', 'Venustiano Carranza', 'Xochimilco']\nProvide the response without any formatting or additional line breaks, just the minified JSON ready to serialize.\n"
-                        }
-                    ]
-                },
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "text",
-                            "text": text
-                        }
-                    ]
-                }
-            ],
-            temperature=0.5,
-            max_tokens=600,
-            top_p=1,
-            frequency_penalty=0,
-            presence_penalty=0
-        )
+    ``rule`` and ``fields`` are those of ``validate_details``; ``details`` holds the fields
+    received so far (None for the rest).
+    """
 
-        # Log the response from OpenAI
-        logger.info(f"Apartment details response: {response.__dict__}")
+    def __init__(self, rule: str, fields: list, details: ApartmentDetails):
+        super().__init__(f"{rule}: {', '.join(fields)}")
+        self.rule = rule
+        self.fields = fields
+        self.details = details
+
+def cache_extraction(text: str, details: ApartmentDetails) -> None:
+    """Cache extracted details only when they pass every validation rule.
+
+    A partial or invalid extraction is not cached, so resending the same text gets a fresh
+    extraction instead of the same failure for the whole TTL.
+    """
+    rule, _ = validate_details(details.__dict__, MUNICIPALITIES)
+    if rule is None:
+        extraction_cache.set(text, details)
 
-        # Cast the response to a dictionary
-        details_json = response.choices[0].message.content
-        details_dict = json.loads(details_json)
+async def extract_apartment_details(text) -> Union[ApartmentDetails, None]:
+    """Extract apartment details from the text using the local parser and OpenAI's GPT-3.
+
+    Raises ExtractionAborted when the streamed answer already fails validation.
+    """
+    with stage('extraction', expected=(ExtractionAborted,)):
+        return await _extract_apartment_details(text)
+
+async def _extract_apartment_details(text) -> Union[ApartmentDetails, None]:
+
+    # Log the text to extract apartment details
+    logger.info("Extracting apartment details", extra={'user_text': text})
+
+    # Return the cached details if the same (normalized) message was already extracted
+    cached_details = await extraction_cache.aget(text)
+    if cached_details is not None:
+        logger.info("Apartment details served from cache")
+        record_field('extraction', {'source': 'cache', 'details': dict(cached_details.__dict__)})
+        return cached_details
+
+    # Resolve as many fields as possible with the local rule-based parser
+    parsed_dict = parse_apartment_details(text)
+    fast_path_stats.record(parsed_dict)
+    missing_fields = [field for field in APARTMENT_FIELDS if parsed_dict[field] is None]
+    if not missing_fields:
+        logger.info("Apartment details resolved by the fast path: %s", parsed_dict, extra=PAYLOAD)
+        details = ApartmentDetails.from_dict(parsed_dict)
+        cache_extraction(text, details)
+        record_field('extraction', {'source': 'fast_path', 'details': dict(details.__dict__)})
+        return details
+
+    # Use OpenAI's GPT-3 to extract only the fields the fast path could not resolve
+    logger.info("Fast path could not resolve %s, asking OpenAI", missing_fields)
+    try:
+        with stage('extraction_llm', expected=(ExtractionAborted,)):
+            details_dict, _ = await request_cascade_details(text, missing_fields, parsed_dict)
 
         # Log the apartment details dictionary
-        logger.info(f"Apartment details dictionary: {details_dict}")
-
-        # Return the apartment details
-        return ApartmentDetails(
-            size_terrain=details_dict['Size_Terrain'],
-            size_construction=details_dict['Size_Construction'],
-            rooms=details_dict['Rooms'],
-            bathrooms=details_dict['Bathrooms'],
-            parking=details_dict['Parking'],
-            age=details_dict['Age'],
-            lat=details_dict['Lat'],
-            lng=details_dict['Lng'],
-            municipality=details_dict['Municipality']
-        )
+        logger.info("Apartment details dictionary: %s", details_dict, extra=PAYLOAD)
+
+        # Cache and return the apartment details
+        details = ApartmentDetails.from_dict(details_dict)
+        cache_extraction(text, details)
+        record_field('extraction', {'source': 'llm', 'details': dict(details.__dict__)})
+        return details
+    except ExtractionAborted as e:
+        logger.info("Extraction cancelled early, %s", e)
+        extraction_aborts_total.inc(rule=e.rule)
+        record_field('extraction', {'source': 'aborted', 'rule': e.rule, 'details': dict(e.details.__dict__)})
+        raise
     except Exception as e:
         # Log the error extracting apartment details
-        logger.info(f"Error extracting apartment details: {e}")
+        logger.info("Error extracting apartment details: %s", e)
+        errors_total.inc(stage='extraction', error=type(e).__name__)
+        record_field('extraction', {'source': 'error', 'error': type(e).__name__})
         return None
 
-def predict_price(details: ApartmentDetails) -> PricePrediction:
-    """Predict the price of the apartment using the SkyPrice API."""
-    response = requests.post(SKYPRICE_API_URL, json=details.__dict__)
-    response_json = response.json()
-    logger.info(f"Price prediction response: {response_json}")
-    return PricePrediction(
-        random_forest=response_json['random_forest'],
-        svm=response_json['svm'],
-        neural_network=response_json['neural_network']
+async def extract_follow_up_details(text: str, pending: dict) -> Union[ApartmentDetails, None]:
+    """Fill the missing fields of a pending valuation from the user's reply.
+
+    The reply is parsed locally (a bare number answers a single missing numeric field); only
+    the fields still unresolved go to the LLM, which reads the earlier messages too. A reply
+    that describes the apartment again is extracted from scratch. Raises ExtractionAborted
+    like ``extract_apartment_details``.
+    """
+    missing = pending['fields']
+    parsed_dict = parse_apartment_details(text)
+    if any(parsed_dict[field] is not None for field in NUMERIC_FIELDS if field not in missing):
+        logger.info("Follow-up describes the apartment again, extracting from scratch")
+        follow_ups_total.inc(source='restart')
+        return await extract_apartment_details(text)
+
+    with stage('extraction', expected=(ExtractionAborted,)):
+        details_dict = dict(pending['details'])
+        details_dict.update({field: parsed_dict[field] for field in missing if parsed_dict[field] is not None})
+        missing_numeric = [field for field in missing if field in NUMERIC_FIELDS and details_dict[field] is None]
+        if len(missing_numeric) == 1 and parse_bare_count(text) is not None:
+            details_dict[missing_numeric[0]] = parse_bare_count(text)
+
+        remaining = [field for field in missing if details_dict[field] is None]
+        if not remaining:
+            follow_ups_total.inc(source='local')
+            return ApartmentDetails.from_dict(gazetteer.resolve(details_dict, text))
+
+        logger.info("Follow-up could not resolve %s locally, asking OpenAI", remaining)
+        follow_ups_total.inc(source='llm')
+        conversation = f"{pending['text']}\n{text}"
+        try:
+            with stage('extraction_llm', expected=(ExtractionAborted,)):
+                details_dict, _ = await request_cascade_details(conversation, remaining, details_dict)
+            return ApartmentDetails.from_dict(details_dict)
+        except ExtractionAborted as e:
+            logger.info("Extraction cancelled early, %s", e)
+            extraction_aborts_total.inc(rule=e.rule)
+            raise
+        except Exception as e:
+            logger.info("Error extracting the follow-up details: %s", e)
+            errors_total.inc(stage='extraction', error=type(e).__name__)
+            return None
+
+async def extract_listings(texts: List[str]) -> List[Optional[ApartmentDetails]]:
+    """Extract the details of several listings, with a single LLM call for those the local parser cannot resolve.
+
+    Returns one ApartmentDetails per text, in order (None if it could not be extracted).
+    """
+    with stage('extraction'):
+        results = [await extraction_cache.aget(text) for text in texts]
+        parsed = {}
+        for index, text in enumerate(texts):
+            if results[index] is not None:
+                continue
+            parsed_dict = parse_apartment_details(text)
+            fast_path_stats.record(parsed_dict)
+            if missing_fields(parsed_dict):
+                parsed[index] = parsed_dict
+            else:
+                results[index] = ApartmentDetails.from_dict(parsed_dict)
+                cache_extraction(text, results[index])
+        if not parsed:
+            return results
+
+        pending = list(parsed)
+        logger.info("Fast path could not resolve %s of %s listings, asking OpenAI", len(pending), len(texts))
+        try:
+            with stage('extraction_llm'):
+                details_dicts = await request_cascade_listings([texts[index] for index in pending], [parsed[index] for index in pending])
+        except Exception as e:
+            logger.info("Error extracting the listings: %s", e)
+            errors_total.inc(stage='extraction', error=type(e).__name__)
+            return results
+        for index, details_dict in zip(pending, details_dicts):
+            if details_dict is not None:
+                results[index] = ApartmentDetails.from_dict(details_dict)
+                cache_extraction(texts[index], results[index])
+        return results
+
+async def request_cascade_details(text: str, fields: list, parsed_dict: dict, tiers=None) -> tuple:
+    """Extract the fields with each model tier in turn until an answer passes validation.
+
+    Fields resolved locally take precedence and the location is resolved with the gazetteer.
+    Returns the details dictionary and the index of the tier that produced it. A tier whose
+    answer has null or invalid fields (or fails) escalates to the next one; the last tier's
+    answer is returned as is, and its ExtractionAborted or error propagates.
+    """
+    tiers = tiers or EXTRACTION_TIERS
+    for index, (model, max_tokens) in enumerate(tiers):
+        last = index == len(tiers) - 1
+        try:
+            with extraction_tier_seconds.time(model=model):
+                # With follow-ups a null field in the last answer is asked to the user, so the
+                # rest of the answer is still worth receiving
+                abort_missing = not last or FOLLOW_UP_TIMEOUT <= 0
+                details_dict = await request_llm_details(
+                    text, fields, check=lambda received: check_partial_details(text, parsed_dict, fields, received, abort_missing),
+                    model=model, max_tokens=max_tokens,
+                )
+        except ExtractionAborted as e:
+            if last:
+                extraction_tier_total.inc(model=model, outcome='rejected')
+                raise
+            logger.info("%s answer rejected (%s), escalating", model, e)
+            extraction_tier_total.inc(model=model, outcome='escalated')
+            continue
+        except Exception as e:
+            extraction_tier_total.inc(model=model, outcome='failed')
+            if last:
+                raise
+            logger.info("%s extraction failed (%s), escalating", model, e)
+            continue
+
+        # Fields resolved locally take precedence over the LLM output
+        details_dict.update({field: value for field, value in parsed_dict.items() if value is not None})
+
+        # Canonicalize the municipality and fill the location from the offline gazetteer
+        details_dict = gazetteer.resolve(details_dict, text)
+
+        rule, invalid = validate_details(details_dict, MUNICIPALITIES)
+        if rule is None or last:
+            extraction_tier_total.inc(model=model, outcome='accepted' if rule is None else 'rejected')
+            return details_dict, index
+        logger.info("%s answer failed validation (%s: %s), escalating", model, rule, invalid)
+        extraction_tier_total.inc(model=model, outcome='escalated')
+
+async def request_cascade_listings(texts: List[str], parsed_dicts: List[dict], tiers=None) -> List[Optional[dict]]:
+    """Extract several listings with each model tier in turn, escalating only the listings that fail validation.
+
+    Every tier asks for all its pending listings in one call. Returns a details dictionary
+    per listing (the last tier's answer as is); if the last tier fails, the listings it
+    was asked for are None.
+    """
+    tiers = tiers or EXTRACTION_TIERS
+    results = [None] * len(texts)
+    pending = list(range(len(texts)))
+    valid_municipalities = MUNICIPALITIES
+    for index, (model, max_tokens) in enumerate(tiers):
+        last = index == len(tiers) - 1
+        try:
+            with extraction_tier_seconds.time(model=model):
+                answers = await request_llm_listings([texts[item] for item in pending], model=model, max_tokens=max_tokens * len(pending))
+        except Exception as e:
+            extraction_tier_total.inc(len(pending), model=model, outcome='failed')
+            if last:
+                raise
+            logger.info("%s listings extraction failed (%s), escalating", model, e)
+            continue
+
+        details_dicts = []
+        for item, answer in zip(pending, answers + [{}] * (len(pending) - len(answers))):
+            details_dict = {field: answer.get(field) for field in APARTMENT_FIELDS}
+            details_dict.update({field: value for field, value in parsed_dicts[item].items() if value is not None})
+            details_dicts.append(gazetteer.resolve(details_dict, texts[item]))
+
+        escalated = []
+        for item, details_dict, (rule, _) in zip(pending, details_dicts, validate_many(details_dicts, valid_municipalities)):
+            results[item] = details_dict
+            if rule is None or last:
+                extraction_tier_total.inc(model=model, outcome='accepted' if rule is None else 'rejected')
+            else:
+                extraction_tier_total.inc(model=model, outcome='escalated')
+                escalated.append(item)
+        if escalated:
+            logger.info("%s answers for %s of %s listings failed validation, escalating", model, len(escalated), len(pending))
+        pending = escalated
+        if not pending:
+            break
+    return results
+
+def check_partial_details(text: str, parsed_dict: dict, requested: list, received: dict, abort_missing: bool = True) -> None:
+    """Raise ExtractionAborted if the fields received so far already fail validation.
+
+    Fields resolved locally take precedence, as in the final result. The municipality is
+    only judged once it and the coordinates are known, since the gazetteer may fill it.
+    Without ``abort_missing`` null fields are not a reason to cancel.
+    """
+    details_dict = {field: received.get(field) for field in APARTMENT_FIELDS}
+    details_dict.update({field: value for field, value in parsed_dict.items() if value is not None})
+    pending = [field for field in requested if field not in received or (not abort_missing and details_dict[field] is None)]
+    rule, fields = validate_known_fields(details_dict, pending)
+    if rule is None and not {'Municipality', 'Lat', 'Lng'} & set(pending):
+        details_dict = gazetteer.resolve(details_dict, text)
+        located = [field for field in ('Lat', 'Lng', 'Municipality') if details_dict[field] is None]
+        if located:
+            rule, fields = 'missing', located
+        elif details_dict['Municipality'] not in MUNICIPALITIES:
+            rule, fields = 'invalid_municipality', ['Municipality']
+    if rule is not None:
+        raise ExtractionAborted(rule, fields, ApartmentDetails.from_dict(details_dict))
+
+def record_llm_usage(model: str, prompt_tokens: int, completion_tokens: int) -> None:
+    """Count the tokens of an LLM call and its estimated cost."""
+    input_price, output_price = MODEL_PRICES.get(model, (0.0, 0.0))
+    extraction_tokens_total.inc(prompt_tokens, model=model, kind='prompt')
+    extraction_tokens_total.inc(completion_tokens, model=model, kind='completion')
+    extraction_cost_usd_total.inc((prompt_tokens * input_price + completion_tokens * output_price) / 1e6, model=model)
+
+async def acquire_openai_budget(system_prompt: str, text: str, max_tokens: int) -> None:
+    """Wait for the OpenAI request and token budgets (tokens estimated at ~4 characters each)."""
+    await openai_rate_limiter.acquire()
+    await openai_token_limiter.acquire((len(system_prompt) + len(text)) // 4 + max_tokens)
+
+def build_llm_request(system_prompt: str, text: str, model: str, max_tokens: int) -> dict:
+    """Build the chat completion arguments for an extraction."""
+    return dict(
+        model=model,
+        messages=[
+            {
+                "role": "system",
+                "content": [
+                    {
+                        "type": "text",
+                        "text": system_prompt
+                    }
+                ]
+            },
+            {
+                "role": "user",
+                "content": [
+                    {
+                        "type": "text",
+                        "text": text
+                    }
+                ]
+            }
+        ],
+        temperature=0.5,
+        max_tokens=max_tokens,
+        top_p=1,
+        frequency_penalty=0,
+        presence_penalty=0
     )
 
+async def request_llm_details(text, fields, check=None, model=EXTRACTION_MODEL, max_tokens=600) -> dict:
+    """Ask OpenAI's GPT-3 for the given fields and return every apartment field (None if not provided).
+
+    The answer is streamed and parsed incrementally; ``check(received)`` runs after each
+    requested field arrives and may raise to cancel the request.
+    """
+    system_prompt = build_extraction_prompt(fields)
+    await acquire_openai_budget(system_prompt, text, max_tokens)
+    request = build_llm_request(system_prompt, text, model, max_tokens)
+    if EXTRACTION_JSON_SCHEMA:
+        request['response_format'] = build_response_format(fields)
+    parser = IncrementalJSONParser()
+    started = time.perf_counter()
+
+    if not EXTRACTION_STREAM:
+        response = await client.chat.completions.create(**request)
+
+        # Log the response from OpenAI
+        logger.info("Apartment details response: %s", response, extra=PAYLOAD)
+        if response.usage is not None:
+            record_llm_usage(model, response.usage.prompt_tokens, response.usage.completion_tokens)
+        content = response.choices[0].message.content or ''
+        record_event('llm', {'model': model, 'fields': list(fields), 'content': content, 'complete': True, 'ms': round((time.perf_counter() - started) * 1000, 3)})
+        parser.feed(content)
+        details_dict = parser.result()
+        return {field: details_dict.get(field) for field in APARTMENT_FIELDS}
+
+    # Validate each field as soon as it is complete; closing the stream cancels the generation
+    stream = await client.chat.completions.create(**request, stream=True, stream_options={'include_usage': True})
+    received = {}
+    usage = None
+    streamed = ''
+    complete = False
+    try:
+        async for chunk in stream:
+            if chunk.usage is not None:
+                usage = chunk.usage
+            if not chunk.choices or not chunk.choices[0].delta.content:
+                continue
+            streamed += chunk.choices[0].delta.content
+            for field, value in parser.feed(chunk.choices[0].delta.content):
+                if field not in fields:
+                    continue
+                received[field] = value
+                if check is not None:
+                    check(received)
+        complete = True
+    finally:
+        await stream.close()
+        record_event('llm', {'model': model, 'fields': list(fields), 'content': streamed, 'complete': complete, 'ms': round((time.perf_counter() - started) * 1000, 3)})
+        # A cancelled stream reports no usage: estimate it at ~4 characters per token
+        if usage is not None:
+            record_llm_usage(model, usage.prompt_tokens, usage.completion_tokens)
+        else:
+            record_llm_usage(model, (len(system_prompt) + len(text)) // 4, len(streamed) // 4 + 1)
+
+    # Log the response from OpenAI
+    logger.info("Apartment details response: %s", parser.members, extra=PAYLOAD)
+    details_dict = parser.result()
+    return {field: details_dict.get(field) for field in APARTMENT_FIELDS}
+
+async def request_llm_listings(texts: List[str], model: str = EXTRACTION_MODEL, max_tokens: int = 600) -> List[dict]:
+    """Ask OpenAI for every field of several listings in one call; returns one dictionary per listing answered."""
+    system_prompt = build_listings_prompt(len(texts))
+    text = '\n\n'.join(f'Listing {number}:\n{listing}' for number, listing in enumerate(texts, 1))
+    await acquire_openai_budget(system_prompt, text, max_tokens)
+    request = build_llm_request(system_prompt, text, model, max_tokens)
+    if EXTRACTION_JSON_SCHEMA:
+        request['response_format'] = build_listings_response_format()
+    response = await client.chat.completions.create(**request)
+    if response.usage is not None:
+        record_llm_usage(model, response.usage.prompt_tokens, response.usage.completion_tokens)
+    parser = IncrementalJSONParser()
+    parser.feed(response.choices[0].message.content or '')
+    listings = parser.result().get('listings') or []
+    logger.info("Listings response: %s", listings, extra=PAYLOAD)
+    return [listing if isinstance(listing, dict) else {} for listing in listings]
+
+async def predict_price(details: ApartmentDetails) -> PricePrediction:
+    """Predict the price of the apartment, reusing cached or in-flight predictions.
+
+    While the SkyPrice circuit breaker is open, returns a FallbackPrediction from the local
+    estimator instead (if enabled and it has enough data).
+    """
+    fetch = prediction_batcher.predict if prediction_batcher is not None else fetch_price_prediction
+    started = time.perf_counter()
+    with stage('prediction'):
+        try:
+            prediction = await prediction_cache.get_or_fetch(details, fetch)
+        except CircuitOpenError as e:
+            # La estimación consulta el almacén de comparables: fuera del event loop
+            price = await asyncio.to_thread(fallback_estimator.estimate, details.__dict__) if PREDICTION_FALLBACK else None
+            if price is None:
+                record_event('skyprice', {'details': dict(details.__dict__), 'error': type(e).__name__})
+                raise
+            logger.info("SkyPrice unavailable (%s), using the local estimate", e)
+            prediction = FallbackPrediction(round(price, 2))
+        except Exception as e:
+            record_event('skyprice', {'details': dict(details.__dict__), 'error': type(e).__name__})
+            raise
+    record_event('skyprice', {
+        'details': dict(details.__dict__), 'prediction': dict(prediction.__dict__),
+        'fallback': isinstance(prediction, FallbackPrediction), 'ms': round((time.perf_counter() - started) * 1000, 3),
+    })
+    return prediction
+
+def is_upstream_failure(error: BaseException) -> bool:
+    """Return whether an error means SkyPrice is unhealthy, as opposed to a rejected request (4xx)."""
+    return not (isinstance(error, httpx.HTTPStatusError) and error.response.status_code < 500 and error.response.status_code != 429)
+
+async def call_skyprice(attempt, hedging: HedgingPolicy):
+    """Run ``attempt`` through the circuit breaker, within SKYPRICE_API_DEADLINE and hedged by ``hedging``."""
+    return await skyprice_breaker.call(lambda: asyncio.wait_for(hedging.call(attempt), SKYPRICE_API_DEADLINE), is_upstream_failure)
+
+def observe_prediction(details: ApartmentDetails, prediction: PricePrediction) -> None:
+    """Calibrate the fallback estimator with a SkyPrice prediction."""
+    prices = [float(price) for price in prediction.__dict__.values()]
+    fallback_estimator.observe(details.Municipality, details.Size_Construction, sum(prices) / len(prices))
+
+async def fetch_price_prediction(details: ApartmentDetails) -> PricePrediction:
+    """Predict the price of the apartment using the SkyPrice API."""
+    async def attempt() -> PricePrediction:
+        await skyprice_rate_limiter.acquire()
+        with stage('prediction_upstream'):
+            response = await http_client.post(SKYPRICE_API_URL, json=details.__dict__)
+            response.raise_for_status()
+        response_json = response.json()
+        logger.info("Price prediction response: %s", response_json, extra=PAYLOAD)
+        return PricePrediction.from_dict(response_json)
+
+    prediction = await call_skyprice(attempt, skyprice_hedging)
+    observe_prediction(details, prediction)
+    return prediction
+
+async def fetch_price_predictions(batch: List[ApartmentDetails]) -> List[PricePrediction]:
+    """Predict the prices of several apartments with a single call to the SkyPrice batch API."""
+    async def attempt() -> List[PricePrediction]:
+        await skyprice_rate_limiter.acquire()
+        with stage('prediction_upstream'):
+            response = await http_client.post(SKYPRICE_BATCH_API_URL, json=[details.__dict__ for details in batch])
+            response.raise_for_status()
+        response_json = response.json()
+        logger.info("Batch price prediction response for %s apartments: %s", len(batch), response_json, extra=PAYLOAD)
+        return [PricePrediction.from_dict(item) for item in response_json]
+
+    predictions = await call_skyprice(attempt, skyprice_batch_hedging)
+    for details, prediction in zip(batch, predictions):
+        observe_prediction(details, prediction)
+    return predictions
+
+# Agrupador de predicciones, activo solo si se configuró el endpoint de batch
+prediction_batcher = PredictionBatcher(
+    fetch_price_predictions,
+    window=PREDICTION_BATCH_WINDOW,
+    max_batch_size=PREDICTION_BATCH_SIZE,
+) if SKYPRICE_BATCH_API_URL else None
+
+@traced('valuation')
+async def value_listing(text: str) -> dict:
+    """Run a listing text through extraction, validation and prediction without Telegram.
+
+    Returns a dict with a ``status`` (``ok``, ``fallback`` for a local estimate, ``not_extracted``,
+    a failed validation rule or ``error``), the extracted ``details``, the offending ``fields``
+    and the ``prediction``.
+    """
+    result = {'status': 'ok', 'details': None, 'fields': [], 'prediction': None, 'error': None}
+    with recorder.session(text):
+        try:
+            try:
+                details = await extract_apartment_details(text)
+                rule, fields = None, []
+            except ExtractionAborted as e:
+                details, rule, fields = e.details, e.rule, e.fields
+            if not details:
+                result['status'] = 'not_extracted'
+                return result
+            result['details'] = dict(details.__dict__)
+            if rule is None:
+                rule, fields = validate_details(details.__dict__, MUNICIPALITIES)
+            if rule:
+                result.update(status=rule, fields=fields)
+                return result
+            prediction = await predict_price(details)
+            result['prediction'] = dict(prediction.__dict__)
+            if isinstance(prediction, FallbackPrediction):
+                result['status'] = 'fallback'
+            else:
+                comparables_store.append(result['details'], result['prediction'])
+        except Exception as e:
+            logger.info("Error valuing listing: %s", e)
+            errors_total.inc(stage='valuation', error=type(e).__name__)
+            result.update(status='error', error=str(e))
+        finally:
+            valuations_total.inc(status=result['status'])
+            record_field('status', result['status'])
+    return result
+
 def format_price(price: str) -> str:
     """Format the price to follow $123,456.78 MXN format."""
     return f"${float(price):,.2f} MXN"
 
+def format_price_short(price: str) -> str:
+    """Format the price compactly, e.g. $3.25M."""
+    value = float(price)
+    return f"${value / 1e6:,.2f}M" if value >= 1e6 else f"${value / 1e3:,.0f}k"
+
+# Nombres de los campos y textos de la tabla de varios anuncios por idioma
+FIELD_LABELS = {
+    'es': {'Size_Terrain': 'Tamaño del terreno', 'Size_Construction': 'Tamaño de la construcción', 'Rooms': 'Habitaciones', 'Bathrooms': 'Baños', 'Parking': 'Estacionamientos', 'Age': 'Antigüedad', 'Lat': 'Latitud', 'Lng': 'Longitud', 'Municipality': 'Alcaldía'},
+    'en': {'Size_Terrain': 'Terrain size', 'Size_Construction': 'Construction size', 'Rooms': 'Rooms', 'Bathrooms': 'Bathrooms', 'Parking': 'Parking spaces', 'Age': 'Age', 'Lat': 'Latitude', 'Lng': 'Longitude', 'Municipality': 'Municipality'},
+    'fr': {'Size_Terrain': 'Taille du terrain', 'Size_Construction': 'Taille de la construction', 'Rooms': 'Chambres', 'Bathrooms': 'Salles de bains', 'Parking': 'Places de parking', 'Age': 'Âge', 'Lat': 'Latitude', 'Lng': 'Longitude', 'Municipality': 'Municipalité'},
+    'pt': {'Size_Terrain': 'Tamanho do terreno', 'Size_Construction': 'Tamanho da construção', 'Rooms': 'Quartos', 'Bathrooms': 'Banheiros', 'Parking': 'Vagas de estacionamento', 'Age': 'Idade', 'Lat': 'Latitude', 'Lng': 'Longitude', 'Municipality': 'Município'},
+}
+LISTING_TABLE_TEXT = {
+    'es': {
+        'title': '💰 Precios estimados de {count} departamentos (mínimo–máximo de los 3 modelos):',
+        'header': '# | m² | Rec. | Baños | Est. | Alcaldía | Precio',
+        'skipped': '⚠️ Solo valué los primeros {limit} anuncios del mensaje; envía el resto por separado.',
+        'footer': '🔍 Puedes encontrar más detalles en https://skyprice.xyz 🏡',
+        'not_extracted': '❌ No pude extraer los detalles',
+        'missing': '❌ Faltan: {fields}',
+        'invalid_municipality': '❌ Alcaldía no válida ({municipality})',
+        'invalid': '❌ Valores no válidos: {fields}',
+        'out_of_range': '❌ Fuera de los límites: {fields}',
+        'error': '❌ Error al estimar el precio',
+        'fallback': '≈ Estimación local aproximada (precio por m² de valuaciones previas): SkyPrice no está disponible en este momento.',
+    },
+    'en': {
+        'title': '💰 Estimated prices of {count} apartments (lowest–highest of the 3 models):',
+        'header': '# | m² | Rooms | Baths | Parking | Municipality | Price',
+        'skipped': '⚠️ I only valued the first {limit} listings of the message; send the rest separately.',
+        'footer': '🔍 You can find more details at https://skyprice.xyz 🏡',
+        'not_extracted': '❌ Could not extract the details',
+        'missing': '❌ Missing: {fields}',
+        'invalid_municipality': '❌ Invalid municipality ({municipality})',
+        'invalid': '❌ Invalid values: {fields}',
+        'out_of_range': '❌ Beyond the limits: {fields}',
+        'error': '❌ Could not estimate the price',
+        'fallback': '≈ Rough local estimate (price per m² of past valuations): SkyPrice is unavailable right now.',
+    },
+    'fr': {
+        'title': '💰 Prix estimés de {count} appartements (minimum–maximum des 3 modèles):',
+        'header': '# | m² | Ch. | SdB | Parking | Municipalité | Prix',
+        'skipped': '⚠️ Je n\'ai évalué que les {limit} premières annonces du message; envoyez le reste séparément.',
+        'footer': '🔍 Vous pouvez trouver plus de détails sur https://skyprice.xyz 🏡',
+        'not_extracted': '❌ Impossible d\'extraire les détails',
+        'missing': '❌ Manquant: {fields}',
+        'invalid_municipality': '❌ Municipalité invalide ({municipality})',
+        'invalid': '❌ Valeurs invalides: {fields}',
+        'out_of_range': '❌ Hors limites: {fields}',
+        'error': '❌ Impossible d\'estimer le prix',
+        'fallback': '≈ Estimation locale approximative (prix au m² des évaluations précédentes): SkyPrice est indisponible pour le moment.',
+    },
+    'pt': {
+        'title': '💰 Preços estimados de {count} apartamentos (mínimo–máximo dos 3 modelos):',
+        'header': '# | m² | Quartos | Banh. | Vagas | Município | Preço',
+        'skipped': '⚠️ Avaliei apenas os primeiros {limit} anúncios da mensagem; envie o restante separadamente.',
+        'footer': '🔍 Você pode encontrar mais detalhes em https://skyprice.xyz 🏡',
+        'not_extracted': '❌ Não consegui extrair os detalhes',
+        'missing': '❌ Faltam: {fields}',
+        'invalid_municipality': '❌ Município inválido ({municipality})',
+        'invalid': '❌ Valores inválidos: {fields}',
+        'out_of_range': '❌ Fora dos limites: {fields}',
+        'error': '❌ Não foi possível estimar o preço',
+        'fallback': '≈ Estimativa local aproximada (preço por m² de avaliações anteriores): o SkyPrice está indisponível no momento.',
+    },
+}
+
+# Respuesta con la estimación local cuando SkyPrice no está disponible
+FALLBACK_TEXT = {
+    'es': (
+        "⚠️ El servicio de SkyPrice no está disponible en este momento. Este precio es una estimación local "
+        "aproximada (precio por m² de valuaciones previas), no la de los modelos de SkyPrice.\n\n"
+        "💰 Precio aproximado: ≈ {price}\n\n"
+        "🔁 Vuelve a intentarlo en unos minutos para obtener la estimación de los modelos."
+    ),
+    'en': (
+        "⚠️ The SkyPrice service is unavailable right now. This price is a rough local estimate "
+        "(price per m² of past valuations), not the SkyPrice models' estimate.\n\n"
+        "💰 Approximate price: ≈ {price}\n\n"
+        "🔁 Try again in a few minutes to get the models' estimate."
+    ),
+    'fr': (
+        "⚠️ Le service SkyPrice est indisponible pour le moment. Ce prix est une estimation locale "
+        "approximative (prix au m² des évaluations précédentes), pas celle des modèles de SkyPrice.\n\n"
+        "💰 Prix approximatif: ≈ {price}\n\n"
+        "🔁 Réessayez dans quelques minutes pour obtenir l'estimation des modèles."
+    ),
+    'pt': (
+        "⚠️ O serviço do SkyPrice está indisponível no momento. Este preço é uma estimativa local "
+        "aproximada (preço por m² de avaliações anteriores), não a dos modelos do SkyPrice.\n\n"
+        "💰 Preço aproximado: ≈ {price}\n\n"
+        "🔁 Tente novamente em alguns minutos para obter a estimativa dos modelos."
+    ),
+}
+
+async def reply_listings(progress: ProgressReply, language: str, texts: List[str]) -> None:
+    """Value several listings from one message and reply with a single table.
+
+    At most MAX_LISTINGS are valued: their extraction shares one LLM call, they are
+    validated together and their predictions run concurrently (batched when the SkyPrice
+    batch endpoint is configured).
+    """
+    text, labels = LISTING_TABLE_TEXT.get(language, LISTING_TABLE_TEXT['es']), FIELD_LABELS.get(language, FIELD_LABELS['es'])
+    skipped = len(texts) > MAX_LISTINGS
+    texts = texts[:MAX_LISTINGS]
+    logger.info("Valuing %s listings from one message", len(texts))
+
+    details = await extract_listings(texts)
+    details_dicts = [listing.__dict__ if listing else dict.fromkeys(APARTMENT_FIELDS) for listing in details]
+    with stage('validation'):
+        checks = validate_many(details_dicts, MUNICIPALITIES)
+    valid = [index for index, (rule, _) in enumerate(checks) if details[index] and rule is None]
+    predictions = dict(zip(valid, await asyncio.gather(*(predict_price(details[index]) for index in valid), return_exceptions=True)))
+
+    rows, fallback = [], False
+    for index, (listing, (rule, fields)) in enumerate(zip(details, checks)):
+        number = index + 1
+        if not listing:
+            status, row = 'not_extracted', text['not_extracted']
+        elif rule is not None:
+            status = rule
+            row = text[rule].format(fields=', '.join(labels[field] for field in fields), municipality=listing.Municipality)
+        elif isinstance(predictions[index], Exception):
+            logger.info("Error predicting listing %s: %s", number, predictions[index])
+            errors_total.inc(stage='prediction', error=type(predictions[index]).__name__)
+            status, row = 'error', text['error']
+        elif isinstance(predictions[index], FallbackPrediction):
+            status, fallback = 'fallback', True
+            row = (
+                f"{listing.Size_Construction} | {listing.Rooms} | {listing.Bathrooms} | {listing.Parking} | "
+                f"{listing.Municipality} | ≈ {format_price_short(predictions[index].SVM)}"
+            )
+        else:
+            prices = [float(price) for price in predictions[index].__dict__.values()]
+            status = 'ok'
+            comparables_store.append(listing.__dict__, predictions[index].__dict__)
+            row = (
+                f"{listing.Size_Construction} | {listing.Rooms} | {listing.Bathrooms} | {listing.Parking} | "
+                f"{listing.Municipality} | {format_price_short(min(prices))}–{format_price_short(max(prices))}"
+            )
+        valuations_total.inc(status=status)
+        rows.append(f"{number} | {row}")
+
+    message = [text['title'].format(count=len(texts)), '', text['header'], *rows, '']
+    if fallback:
+        message += [text['fallback'], '']
+    if skipped:
+        message += [text['skipped'].format(limit=MAX_LISTINGS), '']
+    message.append(text['footer'])
+    await progress.reply('\n'.join(message), append=True)
+
+@traced('handle_message')
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Handle the message from the user."""
+    progress = ProgressReply(
+        update.message, mode=RESPONSE_MODE, delay=PROGRESS_DELAY, min_interval=PROGRESS_EDIT_INTERVAL,
+        retries=TELEGRAM_SEND_RETRIES, backoff=TELEGRAM_SEND_BACKOFF,
+    )
+    try:
+        with recorder.session(update.message.text):
+            return await reply_valuation(update, progress, context)
+    finally:
+        await progress.finish()
+
+async def reply_valuation(update: Update, progress: ProgressReply, context=None) -> int:
+    """Value the apartment described in the message, reporting each stage through ``progress``.
+
+    Returns AWAITING_FIELDS after asking for missing fields (kept in ``context.user_data``),
+    otherwise ConversationHandler.END.
+    """
     user = update.message.from_user
-    logger.info("Valuación de departamento recibida de %s: %s", user.first_name, update.message.text)
+    logger.info("Valuación de departamento recibida", extra={'user_name': user.first_name, 'user_text': update.message.text})
 
     # Obtener el idioma del usuario
-    language = context.user_data.get('language', 'es')
+    language = await preference_store.aget_language(user.id)
 
     if language == 'es':
-        await update.message.reply_text(
+        await progress.reply(
             "🏡 SkyPrice ChatBot 🤖\n\n"
             "📝 ¡Gracias! Mensaje recibido. 📩\n\n"
             "🔄 Procesando tu solicitud..."
         )
     elif language == 'en':
-        await update.message.reply_text(
+        await progress.reply(
             "🏡 SkyPrice ChatBot 🤖\n\n"
             "📝 Thank you! Message received. 📩\n\n"
             "🔄 Processing your request..."
         )
     elif language == 'fr':
-        await update.message.reply_text(
+        await progress.reply(
             "🏡 SkyPrice ChatBot 🤖\n\n"
             "📝 Merci! Message reçu. 📩\n\n"
             "🔄 Traitement de votre demande..."
         )
     elif language == 'pt':
-        await update.message.reply_text(
+        await progress.reply(
             "🏡 SkyPrice ChatBot 🤖\n\n"
             "📝 Obrigado! Mensagem recebida. 📩\n\n"
             "🔄 Processando sua solicitação..."
@@ -310,31 +1268,63 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     try:
         # Extrae los detalles del departamento del mensaje del usuario
         user_text = update.message.text
-        details_text= extract_apartment_details(user_text)
+        pending = pop_pending_details(context)
+        listings = split_listings(user_text) if MAX_LISTINGS > 1 else [user_text]
+        if len(listings) > 1:
+            # Varios anuncios en un mismo mensaje: se valúan juntos y se responde con una tabla
+            discard_record()
+            await reply_listings(progress, language, listings)
+            return ConversationHandler.END
+        validation_rule = None
+        try:
+            if pending is not None:
+                # Respuesta a la pregunta por los datos faltantes de la valuación anterior (depende de la
+                # conversación, así que no se graba)
+                discard_record()
+                details_text = await extract_follow_up_details(user_text, pending)
+                user_text = f"{pending['text']}\n{user_text}"
+            else:
+                details_text= await extract_apartment_details(user_text)
+        except ExtractionAborted as e:
+            # La extracción se canceló en cuanto un campo falló la validación
+            details_text, validation_rule, validation_fields = e.details, e.rule, e.fields
 
         # Valida si se pudieron extraer los detalles del departamento
         if not details_text:
-            logger.info("No se pudieron extraer los detalles del departamento del mensaje del usuario %s: %s", user.first_name, user_text)
+            logger.info("No se pudieron extraer los detalles del departamento del mensaje", extra={'user_name': user.first_name, 'user_text': user_text})
+            valuations_total.inc(status='not_extracted')
 
             if language == 'es':
-                await update.message.reply_text('❌ Lo siento, no pude extraer los detalles del departamento de tu mensaje. Por favor, inténtalo de nuevo. Si necesitas ayuda, escribe /inicio.')
+                await progress.reply('❌ Lo siento, no pude extraer los detalles del departamento de tu mensaje. Por favor, inténtalo de nuevo. Si necesitas ayuda, escribe /inicio.')
             elif language == 'en':
-                await update.message.reply_text('❌ Sorry, I could not extract the apartment details from your message. Please try again. If you need help, type /english.')
+                await progress.reply('❌ Sorry, I could not extract the apartment details from your message. Please try again. If you need help, type /english.')
             elif language == 'fr':
-                await update.message.reply_text('❌ Désolé, je n\'ai pas pu extraire les détails de l\'appartement de votre message. Veuillez réessayer. Si vous avez besoin d\'aide, tapez /french.')
+                await progress.reply('❌ Désolé, je n\'ai pas pu extraire les détails de l\'appartement de votre message. Veuillez réessayer. Si vous avez besoin d\'aide, tapez /french.')
             elif language == 'pt':
-                await update.message.reply_text('❌ Desculpe, não consegui extrair os detalhes do apartamento da sua mensagem. Por favor, tente novamente. Se precisar de ajuda, digite /portuguese.')
+                await progress.reply('❌ Desculpe, não consegui extrair os detalhes do apartamento da sua mensagem. Por favor, tente novamente. Se precisar de ajuda, digite /portuguese.')
 
             return ConversationHandler.END
 
         # Convierte los detalles del departamento a un diccionario
         details_dict = details_text.__dict__
+        valid_municipalities = MUNICIPALITIES
+        if validation_rule is None:
+            with stage('validation'):
+                validation_rule, validation_fields = validate_details(details_dict, valid_municipalities)
+        if validation_rule:
+            valuations_total.inc(status=validation_rule)
 
         # Validate that all required keys are present and not None, if not, provide the user with feedback on missing keys.
-        required_keys = ['Size_Terrain', 'Size_Construction', 'Rooms', 'Bathrooms', 'Parking', 'Age', 'Lat', 'Lng', 'Municipality']
-        missing_keys = [key for key in required_keys if key not in details_dict or details_dict[key] is None]
+        missing_keys = validation_fields if validation_rule == 'missing' else []
         if missing_keys:
             logger.info("Missing keys: %s", missing_keys)
+            follow_up = FOLLOW_UP_TIMEOUT > 0 and getattr(context, 'user_data', None) is not None
+            if follow_up:
+                # Conserva los datos parciales para completar la valuación con la respuesta del usuario
+                context.user_data[PENDING_DETAILS_KEY] = {
+                    'text': user_text, 'details': dict(details_dict), 'fields': missing_fields(details_dict),
+                    'expires': time.monotonic() + FOLLOW_UP_TIMEOUT,
+                }
             required_keys_es = {'Size_Terrain': 'Tamaño del terreno', 'Size_Construction': 'Tamaño de la construcción', 'Rooms': 'Habitaciones', 'Bathrooms': 'Baños', 'Parking': 'Estacionamientos', 'Age': 'Antigüedad', 'Lat': 'Latitud', 'Lng': 'Longitud', 'Municipality': 'Alcaldía'}
             required_keys_fr = {'Size_Terrain': 'Taille du terrain', 'Size_Construction': 'Taille de la construction', 'Rooms': 'Chambres', 'Bathrooms': 'Salles de bains', 'Parking': 'Places de parking', 'Age': 'Âge', 'Lat': 'Latitude', 'Lng': 'Longitude', 'Municipality': 'Municipalité'}
             required_keys_pt = {'Size_Terrain': 'Tamanho do terreno', 'Size_Construction': 'Tamanho da construção', 'Rooms': 'Quartos', 'Bathrooms': 'Banheiros', 'Parking': 'Vagas de estacionamento', 'Age': 'Idade', 'Lat': 'Latitude', 'Lng': 'Longitude', 'Municipality': 'Município'}
@@ -345,38 +1335,46 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             elif language == 'pt':
                 missing_keys = [required_keys_pt[key] for key in missing_keys]
 
+            if follow_up:
+                if language == 'es':
+                    await progress.reply(f'❓ Me faltan los siguientes detalles del departamento: {", ".join(missing_keys)}. Respóndeme solo con esos datos (por ejemplo: "3 recámaras, 2 baños") y completo la valuación. Si necesitas ayuda, escribe /inicio.')
+                elif language == 'en':
+                    await progress.reply(f'❓ I still need the following apartment details: {", ".join(missing_keys)}. Reply with just those details (for example: "3 rooms, 2 bathrooms") and I will finish the valuation. If you need help, type /english.')
+                elif language == 'fr':
+                    await progress.reply(f'❓ Il me manque les détails suivants de l\'appartement: {", ".join(missing_keys)}. Répondez seulement avec ces détails (par exemple: "3 chambres, 2 salles de bains") et je terminerai l\'évaluation. Si vous avez besoin d\'aide, tapez /french.')
+                elif language == 'pt':
+                    await progress.reply(f'❓ Ainda preciso dos seguintes detalhes do apartamento: {", ".join(missing_keys)}. Responda apenas com esses dados (por exemplo: "3 quartos, 2 banheiros") e eu concluo a avaliação. Se precisar de ajuda, digite /portuguese.')
+
+                return AWAITING_FIELDS
+
             if language == 'es':
-                await update.message.reply_text(f'❌ Lo siento, no pude extraer los siguientes detalles del departamento de tu mensaje: {", ".join(missing_keys)}. Por favor, inténtalo de nuevo. Si necesitas ayuda, escribe /inicio.')
+                await progress.reply(f'❌ Lo siento, no pude extraer los siguientes detalles del departamento de tu mensaje: {", ".join(missing_keys)}. Por favor, inténtalo de nuevo. Si necesitas ayuda, escribe /inicio.')
             elif language == 'en':
-                await update.message.reply_text(f'❌ Sorry, I could not extract the following apartment details from your message: {", ".join(missing_keys)}. Please try again. If you need help, type /english.')
+                await progress.reply(f'❌ Sorry, I could not extract the following apartment details from your message: {", ".join(missing_keys)}. Please try again. If you need help, type /english.')
             elif language == 'fr':
-                await update.message.reply_text(f'❌ Désolé, je n\'ai pas pu extraire les détails de l\'appartement suivants de votre message: {", ".join(missing_keys)}. Veuillez réessayer. Si vous avez besoin d\'aide, tapez /french.')
+                await progress.reply(f'❌ Désolé, je n\'ai pas pu extraire les détails de l\'appartement suivants de votre message: {", ".join(missing_keys)}. Veuillez réessayer. Si vous avez besoin d\'aide, tapez /french.')
             elif language == 'pt':
-                await update.message.reply_text(f'❌ Desculpe, não consegui extrair os seguintes detalhes do apartamento da sua mensagem: {", ".join(missing_keys)}. Por favor, tente novamente. Se precisar de ajuda, digite /portuguese.')
+                await progress.reply(f'❌ Desculpe, não consegui extrair os seguintes detalhes do apartamento da sua mensagem: {", ".join(missing_keys)}. Por favor, tente novamente. Se precisar de ajuda, digite /portuguese.')
 
             return ConversationHandler.END
 
         # Validate that municipality is valid, if not, provide the user with feedback on invalid municipality.
-        valid_municipalities = ['Álvaro Obregón', 'Azcapotzalco', 'Benito Juárez', 'Coyoacán', 'Cuajimalpa de Morelos', 'Cuauhtémoc',
-                  'Gustavo A. Madero', 'Iztacalco', 'Iztapalapa', 'Magdalena Contreras', 'Miguel Hidalgo',
-                  'Milpa Alta', 'Tláhuac', 'Tlalpan', 'Venustiano Carranza', 'Xochimilco']
-        if details_dict['Municipality'] not in valid_municipalities:
+        if validation_rule == 'invalid_municipality':
             logger.info("Municipality is invalid")
 
             if language == 'es':
-                await update.message.reply_text(f'❌ Lo siento, la alcaldía proporcionada ({details_dict["Municipality"]}) no es válida. Por favor, inténtalo de nuevo. Si necesitas ayuda, escribe /inicio.')
+                await progress.reply(f'❌ Lo siento, la alcaldía proporcionada ({details_dict["Municipality"]}) no es válida. Por favor, inténtalo de nuevo. Si necesitas ayuda, escribe /inicio.')
             elif language == 'en':
-                await update.message.reply_text(f'❌ Sorry, the provided municipality ({details_dict["Municipality"]}) is invalid. Please try again. If you need help, type /english.')
+                await progress.reply(f'❌ Sorry, the provided municipality ({details_dict["Municipality"]}) is invalid. Please try again. If you need help, type /english.')
             elif language == 'fr':
-                await update.message.reply_text(f'❌ Désolé, la municipalité fournie ({details_dict["Municipality"]}) est invalide. Veuillez réessayer. Si vous avez besoin d\'aide, tapez /french.')
+                await progress.reply(f'❌ Désolé, la municipalité fournie ({details_dict["Municipality"]}) est invalide. Veuillez réessayer. Si vous avez besoin d\'aide, tapez /french.')
             elif language == 'pt':
-                await update.message.reply_text(f'❌ Desculpe, a municipalidade fornecida ({details_dict["Municipality"]}) é inválida. Por favor, tente novamente. Se precisar de ajuda, digite /portuguese.')
+                await progress.reply(f'❌ Desculpe, a municipalidade fornecida ({details_dict["Municipality"]}) é inválida. Por favor, tente novamente. Se precisar de ajuda, digite /portuguese.')
 
             return ConversationHandler.END
 
         # Validate that numeric values are numeric and positive or zero, if not, provide the user with feedback on offending fields.
-        numeric_fields = ['Size_Terrain', 'Size_Construction', 'Rooms', 'Bathrooms', 'Parking', 'Age']
-        invalid_fields = [field for field in numeric_fields if not isinstance(details_dict[field], (int, float)) or details_dict[field] < 0]
+        invalid_fields = validation_fields if validation_rule == 'invalid' else []
         if invalid_fields:
             logger.info("Invalid fields: %s", invalid_fields)
             invalid_fields_es = {'Size_Terrain': 'Tamaño del terreno', 'Size_Construction': 'Tamaño de la construcción', 'Rooms': 'Habitaciones', 'Bathrooms': 'Baños', 'Parking': 'Estacionamientos', 'Age': 'Antigüedad'}
@@ -395,20 +1393,19 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             invalid_fields = [invalid_fields_es[field] for field in invalid_fields]
 
             if language == 'es':
-                await update.message.reply_text(f'❌ Lo siento, los siguientes campos numéricos no son válidos: {", ".join(invalid_fields)}. Por favor, inténtalo de nuevo. Si necesitas ayuda, escribe /inicio.')
+                await progress.reply(f'❌ Lo siento, los siguientes campos numéricos no son válidos: {", ".join(invalid_fields)}. Por favor, inténtalo de nuevo. Si necesitas ayuda, escribe /inicio.')
             elif language == 'en':
-                await update.message.reply_text(f'❌ Sorry, the following numeric fields are not valid: {", ".join(invalid_fields)}. Please try again. If you need help, type /english.')
+                await progress.reply(f'❌ Sorry, the following numeric fields are not valid: {", ".join(invalid_fields)}. Please try again. If you need help, type /english.')
             elif language == 'fr':
-                await update.message.reply_text(f'❌ Désolé, les champs numériques suivants ne sont pas valides: {", ".join(invalid_fields)}. Veuillez réessayer. Si vous avez besoin d\'aide, tapez /french.')
+                await progress.reply(f'❌ Désolé, les champs numériques suivants ne sont pas valides: {", ".join(invalid_fields)}. Veuillez réessayer. Si vous avez besoin d\'aide, tapez /french.')
             elif language == 'pt':
-                await update.message.reply_text(f'❌ Desculpe, os seguintes campos numéricos não são válidos: {", ".join(invalid_fields)}. Por favor, tente novamente. Se precisar de ajuda, digite /portuguese.')
+                await progress.reply(f'❌ Desculpe, os seguintes campos numéricos não são válidos: {", ".join(invalid_fields)}. Por favor, tente novamente. Se precisar de ajuda, digite /portuguese.')
 
             return ConversationHandler.END
 
 
         # Validate that numeric values are within the expected range, if not, provide the user with feedback on offending fields.
-        size_limits = {'Size_Terrain': 10000, 'Size_Construction': 10000, 'Rooms': 20, 'Bathrooms': 20, 'Parking': 20, 'Age': 100}
-        invalid_fields = [field for field in numeric_fields if details_dict[field] > size_limits[field]]
+        invalid_fields = validation_fields if validation_rule == 'out_of_range' else []
         if invalid_fields:
             logger.info("Invalid fields: %s", invalid_fields)
             invalid_fields_es = {'Size_Terrain': 'Tamaño del terreno', 'Size_Construction': 'Tamaño de la construcción', 'Rooms': 'Habitaciones', 'Bathrooms': 'Baños', 'Parking': 'Estacionamientos', 'Age': 'Antigüedad'}
@@ -425,20 +1422,20 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
                 invalid_fields = [invalid_fields_pt[field] for field in invalid_fields]
 
             if language == 'es':
-                await update.message.reply_text(f'❌ Lo siento, los siguientes campos numéricos exceden los límites esperados: {", ".join(invalid_fields)}. Por favor, inténtalo de nuevo. Si necesitas ayuda, escribe /inicio.')
+                await progress.reply(f'❌ Lo siento, los siguientes campos numéricos exceden los límites esperados: {", ".join(invalid_fields)}. Por favor, inténtalo de nuevo. Si necesitas ayuda, escribe /inicio.')
             elif language == 'en':
-                await update.message.reply_text(f'❌ Sorry, the following numeric fields exceed the expected limits: {", ".join(invalid_fields)}. Please try again. If you need help, type /english.')
+                await progress.reply(f'❌ Sorry, the following numeric fields exceed the expected limits: {", ".join(invalid_fields)}. Please try again. If you need help, type /english.')
             elif language == 'fr':
-                await update.message.reply_text(f'❌ Désolé, les champs numériques suivants dépassent les limites attendues: {", ".join(invalid_fields)}. Veuillez réessayer. Si vous avez besoin d\'aide, tapez /french.')
+                await progress.reply(f'❌ Désolé, les champs numériques suivants dépassent les limites attendues: {", ".join(invalid_fields)}. Veuillez réessayer. Si vous avez besoin d\'aide, tapez /french.')
             elif language == 'pt':
-                await update.message.reply_text(f'❌ Desculpe, os seguintes campos numéricos excedem os limites esperados: {", ".join(invalid_fields)}. Por favor, tente novamente. Se precisar de ajuda, digite /portuguese.')
+                await progress.reply(f'❌ Desculpe, os seguintes campos numéricos excedem os limites esperados: {", ".join(invalid_fields)}. Por favor, tente novamente. Se precisar de ajuda, digite /portuguese.')
 
             return ConversationHandler.END
 
 
         # Envía un mensaje con los detalles del departamento
         if language == 'es':
-            await update.message.reply_text(
+            await progress.reply(
                 f"🏢 Detalles del departamento extraídos:\n\n"
                 f"📏 Tamaño del terreno: {details_text.Size_Terrain}m²\n"
                 f"🏗️ Tamaño de la construcción: {details_text.Size_Construction}m²\n"
@@ -449,7 +1446,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
                 f"🌍 Alcaldía: {details_text.Municipality}"
             )
         elif language == 'en':
-            await update.message.reply_text(
+            await progress.reply(
                 f"🏢 Extracted apartment details:\n\n"
                 f"📏 Terrain size: {details_text.Size_Terrain}m²\n"
                 f"🏗️ Construction size: {details_text.Size_Construction}m²\n"
@@ -460,7 +1457,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
                 f"🌍 Municipality: {details_text.Municipality}"
             )
         elif language == 'fr':
-            await update.message.reply_text(
+            await progress.reply(
                 f"🏢 Détails de l'appartement extraits:\n\n"
                 f"📏 Taille du terrain: {details_text.Size_Terrain}m²\n"
                 f"🏗️ Taille de la construction: {details_text.Size_Construction}m²\n"
@@ -471,7 +1468,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
                 f"🌍 Municipalité: {details_text.Municipality}"
             )
         elif language == 'pt':
-            await update.message.reply_text(
+            await progress.reply(
                 f"🏢 Detalhes do apartamento extraídos:\n\n"
                 f"📏 Tamanho do terreno: {details_text.Size_Terrain}m²\n"
                 f"🏗️ Tamanho da construção: {details_text.Size_Construction}m²\n"
@@ -483,10 +1480,10 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             )
 
 
-        logger.info("Detalles del departamento extraídos: Tamaño del terreno: %s, Tamaño de la construcción: %s, Habitaciones: %s, Baños: %s, Estacionamientos: %s, Antigüedad: %s, Alcaldía: %s", details_text.Size_Terrain, details_text.Size_Construction, details_text.Rooms, details_text.Bathrooms, details_text.Parking, details_text.Age, details_text.Municipality)
+        logger.info("Detalles del departamento extraídos: Tamaño del terreno: %s, Tamaño de la construcción: %s, Habitaciones: %s, Baños: %s, Estacionamientos: %s, Antigüedad: %s, Alcaldía: %s", details_text.Size_Terrain, details_text.Size_Construction, details_text.Rooms, details_text.Bathrooms, details_text.Parking, details_text.Age, details_text.Municipality, extra=PAYLOAD)
 
         # Envía un mensaje con los precios estimados
-        price_prediction = predict_price(details_text)
+        price_prediction = await predict_price(details_text)
 
         response_message = (
             f"💰 Precios estimados:\n\n"
@@ -520,36 +1517,493 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
                 "🔍 Você pode encontrar mais detalhes em https://skyprice.xyz 🏡"
             )
 
-        await update.message.reply_text(response_message)
-        logger.info("Estimación de precios: SVM: %s, Random Forest: %s, Neural Network: %s", price_prediction.SVM, price_prediction.Random_Forest, price_prediction.Neural_Network)
+        fallback = isinstance(price_prediction, FallbackPrediction)
+        if fallback:
+            # SkyPrice no está disponible: estimación local, marcada como aproximada
+            response_message = FALLBACK_TEXT.get(language, FALLBACK_TEXT['es']).format(price=format_price(price_prediction.SVM))
+
+        await progress.reply(response_message, append=True)
+        valuations_total.inc(status='fallback' if fallback else 'ok')
+        if not fallback:
+            comparables_store.append(details_dict, price_prediction.__dict__)
+        if getattr(context, 'user_data', None) is not None:
+            context.user_data[LAST_VALUATION_KEY] = dict(details_dict)
+        logger.info("Estimación de precios: SVM: %s, Random Forest: %s, Neural Network: %s", price_prediction.SVM, price_prediction.Random_Forest, price_prediction.Neural_Network, extra=PAYLOAD)
     except Exception as e:
-        logger.info(f"Error: {e}")
+        logger.info("Error: %s", e)
+        valuations_total.inc(status='error')
+        errors_total.inc(stage='handle_message', error=type(e).__name__)
         if language == 'es':
-            await update.message.reply_text('❌ Lo siento, ha ocurrido un error. Por favor, inténtalo de nuevo. Si necesitas ayuda, escribe /inicio.')
+            await progress.reply('❌ Lo siento, ha ocurrido un error. Por favor, inténtalo de nuevo. Si necesitas ayuda, escribe /inicio.')
         elif language == 'en':
-            await update.message.reply_text('❌ Sorry, an error occurred. Please try again. If you need help, type /english.')
+            await progress.reply('❌ Sorry, an error occurred. Please try again. If you need help, type /english.')
         elif language == 'fr':
-            await update.message.reply_text('❌ Désolé, une erreur s\'est produite. Veuillez réessayer. Si vous avez besoin d\'aide, tapez /french.')
+            await progress.reply('❌ Désolé, une erreur s\'est produite. Veuillez réessayer. Si vous avez besoin d\'aide, tapez /french.')
         elif language == 'pt':
-            await update.message.reply_text('❌ Desculpe, ocorreu um erro. Por favor, tente novamente. Se precisar de ajuda, digite /portuguese.')
+            await progress.reply('❌ Desculpe, ocorreu um erro. Por favor, tente novamente. Se precisar de ajuda, digite /portuguese.')
 
     return ConversationHandler.END
 
-def main() -> None:
-    # Log de inicio
-    logger.info("Iniciando el bot de Telegram de SkyPrice...")
+# Comando de comparables (mismo nombre en todos los idiomas) y sus textos por idioma
+COMPARABLES_COMMANDS = ['comparables', 'comparaveis']
+COMPARABLES_TEXT = {
+    'es': {
+        'usage': '📍 Envía /comparables seguido de la descripción del departamento (por ejemplo: "/comparables 80 m², 2 recámaras en Narvarte") o valúa uno primero y escribe /comparables.',
+        'not_located': '❌ No pude ubicar el departamento. Incluye la colonia o la alcaldía.',
+        'title': '📍 Valuaciones previas cercanas y similares{similar}:',
+        'similar': ' ({size} m², {rooms} rec.)',
+        'row': '{number}. {distance:.1f} km · {size} m² · {rooms} rec. · {municipality} · {price} ({price_m2}/m²)',
+        'none': 'Aún no hay valuaciones similares a menos de {max_km:g} km.',
+        'stats': '📊 Precio por m² a {radius:g} km ({count} valuaciones): mediana {median} · p25 {p25} · p75 {p75}',
+        'no_stats': '📊 Aún no hay valuaciones a menos de {radius:g} km para calcular el precio por m².',
+    },
+    'en': {
+        'usage': '📍 Send /comparables followed by the apartment description (for example: "/comparables 80 m², 2 rooms in Narvarte") or value one first and type /comparables.',
+        'not_located': '❌ I could not locate the apartment. Include the neighborhood or the municipality.',
+        'title': '📍 Nearby similar past valuations{similar}:',
+        'similar': ' ({size} m², {rooms} rooms)',
+        'row': '{number}. {distance:.1f} km · {size} m² · {rooms} rooms · {municipality} · {price} ({price_m2}/m²)',
+        'none': 'There are no similar valuations within {max_km:g} km yet.',
+        'stats': '📊 Price per m² within {radius:g} km ({count} valuations): median {median} · p25 {p25} · p75 {p75}',
+        'no_stats': '📊 There are no valuations within {radius:g} km yet to compute the price per m².',
+    },
+    'fr': {
+        'usage': '📍 Envoyez /comparables suivi de la description de l\'appartement (par exemple: "/comparables 80 m², 2 chambres à Narvarte") ou évaluez-en un d\'abord et tapez /comparables.',
+        'not_located': '❌ Je n\'ai pas pu localiser l\'appartement. Indiquez le quartier ou la municipalité.',
+        'title': '📍 Évaluations précédentes proches et similaires{similar}:',
+        'similar': ' ({size} m², {rooms} ch.)',
+        'row': '{number}. {distance:.1f} km · {size} m² · {rooms} ch. · {municipality} · {price} ({price_m2}/m²)',
+        'none': 'Il n\'y a pas encore d\'évaluations similaires à moins de {max_km:g} km.',
+        'stats': '📊 Prix au m² à {radius:g} km ({count} évaluations): médiane {median} · p25 {p25} · p75 {p75}',
+        'no_stats': '📊 Il n\'y a pas encore d\'évaluations à moins de {radius:g} km pour calculer le prix au m².',
+    },
+    'pt': {
+        'usage': '📍 Envie /comparaveis seguido da descrição do apartamento (por exemplo: "/comparaveis 80 m², 2 quartos em Narvarte") ou avalie um primeiro e digite /comparaveis.',
+        'not_located': '❌ Não consegui localizar o apartamento. Inclua o bairro ou o município.',
+        'title': '📍 Avaliações anteriores próximas e semelhantes{similar}:',
+        'similar': ' ({size} m², {rooms} quartos)',
+        'row': '{number}. {distance:.1f} km · {size} m² · {rooms} quartos · {municipality} · {price} ({price_m2}/m²)',
+        'none': 'Ainda não há avaliações semelhantes a menos de {max_km:g} km.',
+        'stats': '📊 Preço por m² a {radius:g} km ({count} avaliações): mediana {median} · p25 {p25} · p75 {p75}',
+        'no_stats': '📊 Ainda não há avaliações a menos de {radius:g} km para calcular o preço por m².',
+    },
+}
+
+def format_number(value) -> str:
+    """Format a stored number without a trailing .0 (e.g. 2.0 rooms -> 2)."""
+    return f"{value:g}" if isinstance(value, float) else str(value)
+
+async def comparables(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Reply with the nearest similar past valuations and the price per m² around the apartment.
+
+    The apartment comes from the command arguments or, without them, from the user's last
+    valuation.
+    """
+    user = update.message.from_user
+    language = await preference_store.aget_language(user.id)
+    text = COMPARABLES_TEXT.get(language, COMPARABLES_TEXT['es'])
+    query = ' '.join(context.args or [])
+    logger.info("Comparables solicitados", extra={'user_name': user.first_name, 'user_text': query})
+
+    if query:
+        # Basta con la ubicación; el tamaño y las habitaciones afinan la búsqueda si vienen en el texto
+        details_dict = parse_apartment_details(query)
+        if details_dict['Lat'] is None or details_dict['Lng'] is None:
+            try:
+                details = await extract_apartment_details(query)
+            except ExtractionAborted as e:
+                details = e.details
+            details_dict = details.__dict__ if details else details_dict
+    else:
+        details_dict = (context.user_data or {}).get(LAST_VALUATION_KEY)
+        if details_dict is None:
+            await send_with_retry(lambda: update.message.reply_text(text['usage']), TELEGRAM_SEND_RETRIES, TELEGRAM_SEND_BACKOFF)
+            return ConversationHandler.END
+    if details_dict.get('Lat') is None or details_dict.get('Lng') is None:
+        await send_with_retry(lambda: update.message.reply_text(text['not_located']), TELEGRAM_SEND_RETRIES, TELEGRAM_SEND_BACKOFF)
+        return ConversationHandler.END
+
+    lat, lng = float(details_dict['Lat']), float(details_dict['Lng'])
+    size, rooms = details_dict.get('Size_Construction'), details_dict.get('Rooms')
+    # Consultas SQLite fuera del event loop: el hilo escritor retiene el candado durante cada lote
+    with stage('comparables'):
+        nearest = await asyncio.to_thread(
+            comparables_store.nearest, lat, lng, COMPARABLES_K, size=size, rooms=rooms, max_km=COMPARABLES_MAX_KM,
+        )
+        area = await asyncio.to_thread(comparables_store.area_stats, lat, lng, COMPARABLES_RADIUS_KM)
+
+    similar = text['similar'].format(size=size, rooms=rooms) if size and rooms else ''
+    message = [text['title'].format(similar=similar), '']
+    for number, valuation in enumerate(nearest, 1):
+        message.append(text['row'].format(
+            number=number, distance=valuation['distance_km'], size=format_number(valuation['size_construction']),
+            rooms=format_number(valuation['rooms']), municipality=valuation['municipality'],
+            price=format_price_short(valuation['price']), price_m2=f"${valuation['price_m2'] or 0:,.0f}",
+        ))
+    if not nearest:
+        message.append(text['none'].format(max_km=COMPARABLES_MAX_KM))
+    message.append('')
+    if area['count']:
+        message.append(text['stats'].format(
+            radius=area['radius_km'], count=area['count'],
+            **{name: f"${area[name]:,.0f}" for name in ('median', 'p25', 'p75')},
+        ))
+    else:
+        message.append(text['no_stats'].format(radius=area['radius_km']))
+    await send_with_retry(lambda: update.message.reply_text('\n'.join(message)), TELEGRAM_SEND_RETRIES, TELEGRAM_SEND_BACKOFF)
+    return ConversationHandler.END
+
+# Textos de las respuestas inline por idioma
+INLINE_TEXT = {
+    'es': {
+        'usage': '🏡 Describe el departamento para valuarlo',
+        'price': '💰 {low} – {high}',
+        'estimate': '≈ {price} (estimación local)',
+        'preliminary': '≈ {price} (preliminar, sigo calculando)',
+        'pending': '⏳ Sigo calculando el precio...',
+        'message': '🏡 {summary}\n\n💰 Precio estimado: {low} – {high} (mínimo–máximo de los 3 modelos)\n\n🔍 Puedes encontrar más detalles en https://skyprice.xyz 🏡',
+        'preliminary_message': '🏡 {summary}\n\n≈ Precio preliminar: {price} (precio por m² de valuaciones previas)\n\n🔍 Envíame la descripción para la estimación de los modelos de SkyPrice.',
+        'fields': {'Size_Construction': '{} m²', 'Rooms': '{} rec.', 'Bathrooms': '{} baños', 'Parking': '{} est.', 'Age': '{} años', 'Municipality': '{}'},
+    },
+    'en': {
+        'usage': '🏡 Describe the apartment to value it',
+        'price': '💰 {low} – {high}',
+        'estimate': '≈ {price} (local estimate)',
+        'preliminary': '≈ {price} (preliminary, still calculating)',
+        'pending': '⏳ Still calculating the price...',
+        'message': '🏡 {summary}\n\n💰 Estimated price: {low} – {high} (lowest–highest of the 3 models)\n\n🔍 You can find more details at https://skyprice.xyz 🏡',
+        'preliminary_message': '🏡 {summary}\n\n≈ Preliminary price: {price} (price per m² of past valuations)\n\n🔍 Send me the description to get the SkyPrice models\' estimate.',
+        'fields': {'Size_Construction': '{} m²', 'Rooms': '{} rooms', 'Bathrooms': '{} baths', 'Parking': '{} parking', 'Age': '{} years', 'Municipality': '{}'},
+    },
+    'fr': {
+        'usage': '🏡 Décrivez l\'appartement pour l\'évaluer',
+        'price': '💰 {low} – {high}',
+        'estimate': '≈ {price} (estimation locale)',
+        'preliminary': '≈ {price} (préliminaire, calcul en cours)',
+        'pending': '⏳ Calcul du prix en cours...',
+        'message': '🏡 {summary}\n\n💰 Prix estimé: {low} – {high} (minimum–maximum des 3 modèles)\n\n🔍 Vous pouvez trouver plus de détails sur https://skyprice.xyz 🏡',
+        'preliminary_message': '🏡 {summary}\n\n≈ Prix préliminaire: {price} (prix au m² des évaluations précédentes)\n\n🔍 Envoyez-moi la description pour obtenir l\'estimation des modèles de SkyPrice.',
+        'fields': {'Size_Construction': '{} m²', 'Rooms': '{} ch.', 'Bathrooms': '{} SdB', 'Parking': '{} parking', 'Age': '{} ans', 'Municipality': '{}'},
+    },
+    'pt': {
+        'usage': '🏡 Descreva o apartamento para avaliá-lo',
+        'price': '💰 {low} – {high}',
+        'estimate': '≈ {price} (estimativa local)',
+        'preliminary': '≈ {price} (preliminar, ainda calculando)',
+        'pending': '⏳ Ainda calculando o preço...',
+        'message': '🏡 {summary}\n\n💰 Preço estimado: {low} – {high} (mínimo–máximo dos 3 modelos)\n\n🔍 Você pode encontrar mais detalhes em https://skyprice.xyz 🏡',
+        'preliminary_message': '🏡 {summary}\n\n≈ Preço preliminar: {price} (preço por m² de avaliações anteriores)\n\n🔍 Envie-me a descrição para obter a estimativa dos modelos do SkyPrice.',
+        'fields': {'Size_Construction': '{} m²', 'Rooms': '{} quartos', 'Bathrooms': '{} banh.', 'Parking': '{} vagas', 'Age': '{} anos', 'Municipality': '{}'},
+    },
+}
 
-    # Inicializa la aplicación de Telegram
-    application = Application.builder().token(TELEGRAM_TOKEN).build()
+async def value_inline_query(query: str, progress: dict) -> dict:
+    """Value the text of an inline query, storing the extracted details in ``progress`` once known.
+
+    Returns a dict like ``value_listing``, but the valuation is not recorded, counted or kept
+    as a comparable: the query is a draft the user is still typing.
+    """
+    try:
+        details = await extract_apartment_details(query)
+        rule, fields = None, []
+    except ExtractionAborted as e:
+        details, rule, fields = e.details, e.rule, e.fields
+    if not details:
+        return {'status': 'not_extracted', 'details': None, 'fields': [], 'prediction': None}
+    progress['details'] = dict(details.__dict__)
+    if rule is None:
+        rule, fields = validate_details(details.__dict__, MUNICIPALITIES)
+    result = {'status': rule or 'ok', 'details': progress['details'], 'fields': fields, 'prediction': None}
+    if rule:
+        return result
+    prediction = await predict_price(details)
+    result['prediction'] = dict(prediction.__dict__)
+    if isinstance(prediction, FallbackPrediction):
+        result['status'] = 'fallback'
+    return result
+
+def inline_summary(text: dict, details: dict) -> str:
+    """Describe the known details in one line, e.g. 80 m² · 2 rec. · Benito Juárez."""
+    return ' · '.join(
+        label.format(format_number(details[field])) for field, label in text['fields'].items() if details.get(field) is not None
+    )
+
+async def build_inline_article(language: str, query: str, outcome: str, result: Optional[dict]) -> InlineQueryResultArticle:
+    """Build the inline result for a finished valuation, or a partial one from the details known so far."""
+    text, table = INLINE_TEXT.get(language, INLINE_TEXT['es']), LISTING_TABLE_TEXT.get(language, LISTING_TABLE_TEXT['es'])
+    labels = FIELD_LABELS.get(language, FIELD_LABELS['es'])
+    if outcome in ('partial', 'error'):
+        # Sin la valuación completa: los detalles extraídos o, si aún no llegan, los del extractor local
+        details = (result or {}).get('details') or parse_apartment_details(query)
+        status = 'partial'
+    else:
+        details = result['details'] or {}
+        status = result['status']
+    summary = inline_summary(text, details)
+
+    if status == 'ok':
+        prices = [float(price) for price in result['prediction'].values()]
+        title = text['price'].format(low=format_price_short(min(prices)), high=format_price_short(max(prices)))
+        message = text['message'].format(summary=summary, low=format_price(min(prices)), high=format_price(max(prices)))
+    elif status == 'fallback':
+        title = text['estimate'].format(price=format_price_short(result['prediction']['SVM']))
+        message = f"🏡 {summary}\n\n" + FALLBACK_TEXT.get(language, FALLBACK_TEXT['es']).format(price=format_price(result['prediction']['SVM']))
+    elif status == 'partial':
+        # Estimación preliminar con el precio por m² local (sin contarla como respuesta de respaldo)
+        found = await asyncio.to_thread(fallback_estimator.price_m2, details) if details.get('Size_Construction') else None
+        if found is not None:
+            price = found[0] * float(details['Size_Construction'])
+            title = text['preliminary' if outcome == 'partial' else 'estimate'].format(price=format_price_short(price))
+            message = text['preliminary_message'].format(summary=summary, price=format_price(price))
+        else:
+            title = text['pending'] if outcome == 'partial' else table['error']
+            message = f"🏡 {summary}\n\n{title}" if summary else title
+    else:
+        title = table[status].format(
+            fields=', '.join(labels[field] for field in result['fields']), municipality=details.get('Municipality'),
+        )
+        message = f"🏡 {summary}\n\n{title}" if summary else title
+    return InlineQueryResultArticle(
+        id=fingerprint(normalize_text(query), status)[:32], title=title, description=summary or query,
+        input_message_content=InputTextMessageContent(message),
+    )
+
+@traced('inline_query')
+async def inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Answer an inline query with a quick valuation of the text typed so far.
+
+    The coordinator debounces the user's keystrokes, cancels their obsolete valuation and
+    answers from its cache or, when SKYPRICE_INLINE_DEADLINE runs out, with the details known
+    so far. A superseded query is not answered: Telegram only shows the newest one. Inline
+    queries have no chat, so the update processor runs each one on its own instead of queuing
+    it behind the user's previous query.
+    """
+    started = time.monotonic()
+    query = update.inline_query
+    language = await preference_store.aget_language(query.from_user.id)
+    logger.info("Consulta inline recibida", extra={'user_name': query.from_user.first_name, 'user_text': query.query})
+
+    if len(query.query.strip()) < INLINE_MIN_LENGTH:
+        # Consulta vacía o muy corta: un botón que abre el chat con las instrucciones
+        button = InlineQueryResultsButton(text=INLINE_TEXT.get(language, INLINE_TEXT['es'])['usage'], start_parameter='inline')
+        await send_with_retry(lambda: query.answer([], button=button, cache_time=int(INLINE_CACHE_TTL), is_personal=True), retries=0)
+        return
+
+    outcome, result = await inline_coordinator.answer(query.from_user.id, query.query, value_inline_query, started)
+    logger.info("Inline query answered: %s", outcome)
+    if outcome == 'superseded':
+        return
+    article = await build_inline_article(language, query.query, outcome, result)
+    # Una respuesta parcial no se guarda en la caché de Telegram, así la consulta repetida obtiene el precio
+    cache_time = 0 if outcome in ('partial', 'error') else int(INLINE_CACHE_TTL)
+    # Reintentar no sirve: pasado el plazo Telegram rechaza la respuesta
+    await send_with_retry(lambda: query.answer([article], cache_time=cache_time, is_personal=True), retries=0)
+
+async def notify_queued(update: object, position: int) -> None:
+    """Tell the user their message is waiting for a free slot."""
+    if not isinstance(update, Update) or update.message is None or update.message.from_user is None:
+        return
+    language = await preference_store.aget_language(update.message.from_user.id)
+    if language == 'es':
+        text = f'⏳ Hay mucha demanda en este momento. Tu mensaje está en la fila, posición {position}.'
+    elif language == 'en':
+        text = f'⏳ We are very busy right now. Your message is queued, position {position}.'
+    elif language == 'fr':
+        text = f'⏳ Nous sommes très sollicités en ce moment. Votre message est en file d\'attente, position {position}.'
+    else:
+        text = f'⏳ Estamos com muita demanda agora. Sua mensagem está na fila, posição {position}.'
+    await send_with_retry(lambda: update.message.reply_text(text), TELEGRAM_SEND_RETRIES, TELEGRAM_SEND_BACKOFF)
+
+async def notify_shed(update: object, reason: str) -> None:
+    """Tell the user their message was not processed because the bot is saturated."""
+    logger.info("Update shed by the scheduler: %s", reason)
+    if not isinstance(update, Update) or update.message is None or update.message.from_user is None:
+        return
+    language = await preference_store.aget_language(update.message.from_user.id)
+    if reason == 'user_queue':
+        if language == 'es':
+            text = '🚦 Aún estoy procesando tus mensajes anteriores. Espera a que termine y vuelve a enviarlo.'
+        elif language == 'en':
+            text = '🚦 I am still processing your previous messages. Please wait for them and send it again.'
+        elif language == 'fr':
+            text = '🚦 Je traite encore vos messages précédents. Veuillez patienter puis le renvoyer.'
+        else:
+            text = '🚦 Ainda estou processando suas mensagens anteriores. Aguarde e envie novamente.'
+    else:
+        if language == 'es':
+            text = '🚦 Estamos recibiendo demasiados mensajes. Por favor, inténtalo de nuevo en un minuto.'
+        elif language == 'en':
+            text = '🚦 We are receiving too many messages. Please try again in a minute.'
+        elif language == 'fr':
+            text = '🚦 Nous recevons trop de messages. Veuillez réessayer dans une minute.'
+        else:
+            text = '🚦 Estamos recebendo muitas mensagens. Por favor, tente novamente em um minuto.'
+    await send_with_retry(lambda: update.message.reply_text(text), TELEGRAM_SEND_RETRIES, TELEGRAM_SEND_BACKOFF)
+
+# Exporta los contadores existentes como métricas
+registry.register_stats('skyprice_extraction_cache', extraction_cache.stats)
+registry.register_stats('skyprice_prediction_cache', prediction_cache.stats)
+registry.register_stats('skyprice_fast_path', fast_path_stats.stats)
+registry.register_stats('skyprice_openai_rate_limiter', openai_rate_limiter.stats)
+registry.register_stats('skyprice_openai_token_limiter', openai_token_limiter.stats)
+registry.register_stats('skyprice_scheduler', update_scheduler.stats)
+registry.register_stats('skyprice_api_rate_limiter', skyprice_rate_limiter.stats)
+registry.register_stats('skyprice_comparables', comparables_store.stats)
+registry.register_stats('skyprice_api_breaker', skyprice_breaker.stats)
+registry.register_stats('skyprice_api_hedging', skyprice_hedging.stats)
+registry.register_stats('skyprice_api_batch_hedging', skyprice_batch_hedging.stats)
+registry.register_stats('skyprice_fallback', fallback_estimator.stats)
+registry.register_stats('skyprice_recorder', recorder.stats)
+registry.register_stats('skyprice_inline', inline_coordinator.stats)
+if prediction_batcher is not None:
+    registry.register_stats('skyprice_prediction_batcher', prediction_batcher.stats)
+
+# Servidor de métricas, iniciado junto con la aplicación
+metrics_server = MetricsServer(registry)
+
+async def start_metrics_server(application: Application) -> None:
+    """Expose the Prometheus metrics when SKYPRICE_METRICS_PORT is set."""
+    if METRICS_PORT:
+        await metrics_server.start(METRICS_HOST, METRICS_PORT + WORKER_INDEX)
+
+def open_stores() -> None:
+    """Open the SQLite stores (blocking: run it in a thread)."""
+    for store in (extraction_cache, preference_store, comparables_store):
+        store.open()
+
+async def start_services(application: Application) -> None:
+    """Open the stores and start the metrics server, then calibrate the fallback estimator in a thread."""
+    global fallback_calibration
+    await asyncio.to_thread(open_stores)
+    await start_metrics_server(application)
+    # Recorre todo el almacén de comparables: en un hilo y sin retrasar el arranque
+    fallback_calibration = asyncio.create_task(asyncio.to_thread(fallback_estimator.calibrate))
+
+async def finish_deliveries(application: Application) -> None:
+    """Wait for the final replies still in flight, while the bot can still send them."""
+    await drain_pending_deliveries(DELIVERY_DRAIN_TIMEOUT)
+
+async def close_clients(application: Application) -> None:
+    """Close the pooled HTTP clients and caches when the application shuts down."""
+    await metrics_server.stop()
+    await http_client.aclose()
+    await client.close()
+    logger.info("Extraction cache stats: %s", extraction_cache.stats())
+    logger.info("Prediction cache stats: %s", prediction_cache.stats())
+    logger.info("Fast path stats: %s", fast_path_stats.stats())
+    if prediction_batcher is not None:
+        logger.info("Prediction batcher stats: %s", prediction_batcher.stats())
+    logger.info("Rate limiter stats: OpenAI %s (tokens %s), SkyPrice %s", openai_rate_limiter.stats(), openai_token_limiter.stats(), skyprice_rate_limiter.stats())
+    logger.info("Scheduler stats: %s", update_scheduler.stats())
+    logger.info("SkyPrice breaker stats: %s, hedging %s, fallback %s", skyprice_breaker.stats(), skyprice_hedging.stats(), fallback_estimator.stats())
+    logger.info("Comparables store stats: %s", comparables_store.stats())
+    logger.info("Inline query stats: %s", inline_coordinator.stats())
+    if recorder.enabled:
+        logger.info("Recorder stats: %s", recorder.stats())
+    if fallback_calibration is not None:
+        # El hilo de calibración lee el almacén de comparables: se espera antes de cerrarlo
+        await asyncio.wait({fallback_calibration})
+    extraction_cache.close()
+    preference_store.close()
+    comparables_store.close()
+    recorder.close()
+
+def build_application() -> Application:
+    """Build the Telegram application with every handler registered."""
+    # Inicializa la aplicación de Telegram procesando actualizaciones de forma concurrente (en orden por chat)
+    update_queue = TimedUpdateQueue()
+    update_scheduler.max_active = MAX_CONCURRENT_UPDATES
+    processor = ChatOrderedUpdateProcessor(
+        MAX_CONCURRENT_UPDATES, update_queue, scheduler=update_scheduler, on_queued=notify_queued, on_shed=notify_shed,
+    )
+    builder = (
+        Application.builder()
+        .token(TELEGRAM_TOKEN)
+        .request(InstrumentedRequest(connection_pool_size=MAX_CONCURRENT_UPDATES + 8))
+        .update_queue(update_queue)
+        .concurrent_updates(processor)
+        .post_init(start_services)
+        .post_stop(finish_deliveries)
+        .post_shutdown(close_clients)
+    )
+    if TELEGRAM_API_BASE_URL:
+        builder = builder.base_url(TELEGRAM_API_BASE_URL)
+    application = builder.build()
 
     # Handle para las instrucciones en otros idiomas
     for command in LANGUAGE_COMMANDS:
         application.add_handler(CommandHandler(command, set_language))
 
-    # Handle para los mensajes de valuación de departamentos
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    # Handle para las valuaciones previas cercanas
+    application.add_handler(CommandHandler(COMPARABLES_COMMANDS, comparables))
+
+    # Handle para las valuaciones rápidas desde cualquier chat (@bot descripción)
+    application.add_handler(InlineQueryHandler(inline_query))
+
+    # Handle para los mensajes de valuación de departamentos; con seguimiento, una conversación
+    # que tras pedir los datos faltantes trata la siguiente respuesta como complemento
+    valuation_handler = MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message)
+    if FOLLOW_UP_TIMEOUT > 0:
+        application.add_handler(ConversationHandler(
+            entry_points=[valuation_handler],
+            states={AWAITING_FIELDS: [valuation_handler]},
+            fallbacks=[],
+        ))
+    else:
+        application.add_handler(valuation_handler)
+
+    return application
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Bot de Telegram de SkyPrice.')
+    subparsers = parser.add_subparsers(dest='mode')
+    subparsers.add_parser('polling', help='Recibe actualizaciones con long polling (por defecto).')
+    webhook_parser = subparsers.add_parser('webhook', help='Recibe actualizaciones con un webhook y N procesos.')
+    webhook_parser.add_argument('--workers', type=int, default=WEBHOOK_WORKERS, help='Procesos que atienden actualizaciones.')
+    webhook_parser.add_argument('--host', default=WEBHOOK_HOST, help='Interfaz del servidor HTTP.')
+    webhook_parser.add_argument('--port', type=int, default=WEBHOOK_PORT, help='Puerto del servidor HTTP.')
+    webhook_parser.add_argument('--path', default=WEBHOOK_PATH, help='Ruta que recibe las actualizaciones.')
+    webhook_parser.add_argument('--url', default=WEBHOOK_URL, help='URL pública a registrar en Telegram (vacío para no registrar).')
+    bulk_parser = subparsers.add_parser('bulk', help='Valúa un archivo CSV/JSONL de anuncios sin pasar por Telegram.')
+    bulk_parser.add_argument('input', help='Archivo CSV (columna de texto) o JSONL (campo de texto o cadenas) de entrada.')
+    bulk_parser.add_argument('output', help='Archivo de resultados (.jsonl o .csv); se agrega al reanudar.')
+    bulk_parser.add_argument('--text-field', default='text', help='Columna/campo con el texto del anuncio.')
+    bulk_parser.add_argument('--id-field', default='id', help='Columna/campo con el identificador del anuncio (opcional).')
+    bulk_parser.add_argument('--concurrency', type=int, default=16, help='Anuncios procesados de forma concurrente.')
+    bulk_parser.add_argument('--checkpoint', default=None, help='Archivo de checkpoint (por defecto <output>.checkpoint).')
+    bulk_parser.add_argument('--openai-rate', type=float, default=None, help='Solicitudes por segundo a OpenAI (0 = sin límite; por defecto SKYPRICE_OPENAI_RPM o SKYPRICE_OPENAI_RATE_LIMIT).')
+    bulk_parser.add_argument('--skyprice-rate', type=float, default=None, help='Solicitudes por segundo a SkyPrice (0 = sin límite; por defecto SKYPRICE_API_RATE_LIMIT).')
+    args = parser.parse_args()
+    configure_logging()
+
+    # Log de inicio
+    logger.info("Iniciando el bot de Telegram de SkyPrice...")
+
+    if args.mode == 'webhook':
+        from skyprice_webhook import run_webhook
+        run_webhook(
+            build_application, TELEGRAM_TOKEN, workers=args.workers, host=args.host, port=args.port,
+            path=args.path, url=args.url or None, secret_token=WEBHOOK_SECRET or None,
+            base_url=TELEGRAM_API_BASE_URL or None,
+        )
+        return
+
+    if args.mode == 'bulk':
+        from skyprice_bulk import run_bulk
+        # Sin las opciones se conservan los límites configurados por variables de entorno
+        if args.openai_rate is not None:
+            openai_rate_limiter.rate = args.openai_rate
+        if args.skyprice_rate is not None:
+            skyprice_rate_limiter.rate = args.skyprice_rate
+        run_bulk(
+            value_listing, args.input, args.output, text_field=args.text_field, id_field=args.id_field,
+            concurrency=args.concurrency, checkpoint_path=args.checkpoint,
+            on_start=lambda: start_services(None), on_close=lambda: close_clients(None),
+        )
+        return
 
     # Inicia el bot de Telegram
+    application = build_application()
     application.run_polling(allowed_updates=Update.ALL_TYPES)
 
 if __name__ == '__main__':
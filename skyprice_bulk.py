@@ -0,0 +1,217 @@
+# @Author: Humberto Alejandro Ortega Alcocer
+# @Date: 2024-Junio-24
+# @Description: Valuación masiva de anuncios desde CSV/JSONL con concurrencia acotada, checkpoints y memoria constante.
+# @License: MIT
+import asyncio
+import csv
+import json
+import logging
+import os
+import time
+from typing import Awaitable, Callable, Iterator, Optional, Tuple
+
+from skyprice_models import APARTMENT_FIELDS
+
+# Get the logger instance
+logger = logging.getLogger(__name__)
+
+# Columnas de la salida en CSV
+PREDICTION_FIELDS = ['Random_Forest', 'SVM', 'Neural_Network']
+CSV_COLUMNS = ['index', 'id', 'status', 'fields', 'error'] + APARTMENT_FIELDS + PREDICTION_FIELDS
+
+# Cada cuántos resultados se guarda el checkpoint y se reporta el progreso
+CHECKPOINT_EVERY = 50
+PROGRESS_EVERY = 500
+
+def iter_listings(path: str, text_field: str = 'text', id_field: str = 'id') -> Iterator[Tuple[int, Optional[str], str]]:
+    """Stream ``(index, id, text)`` from a CSV or JSONL file without loading it in memory.
+
+    JSONL lines may be objects (with ``text_field``) or plain strings; CSV files need a
+    ``text_field`` column. ``index`` is the record's position and identifies it across runs.
+    """
+    with open(path, newline='', encoding='utf-8') as file:
+        if path.lower().endswith('.csv'):
+            for index, row in enumerate(csv.DictReader(file)):
+                yield index, row.get(id_field) or None, row.get(text_field) or ''
+            return
+        index = 0
+        for line in file:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if isinstance(record, str):
+                yield index, None, record
+            else:
+                listing_id = record.get(id_field)
+                yield index, None if listing_id is None else str(listing_id), record.get(text_field) or ''
+            index += 1
+
+class Checkpoint:
+    """Track which input records are done so an interrupted run resumes where it stopped.
+
+    Stores a watermark (every index below it is done) plus the few indexes above it that
+    finished out of order, so its size is bounded by the concurrency, not by the input.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.watermark = 0
+        self.done = set()
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as file:
+                state = json.load(file)
+            self.watermark = state['watermark']
+            self.done = set(state['done'])
+
+    def is_done(self, index: int) -> bool:
+        return index < self.watermark or index in self.done
+
+    def mark_done(self, index: int) -> None:
+        self.done.add(index)
+        while self.watermark in self.done:
+            self.done.remove(self.watermark)
+            self.watermark += 1
+
+    def recover(self, output_path: str) -> None:
+        """Mark done the records written to the output after the last checkpoint was saved.
+
+        A trailing partial line (from a crash mid-write) is truncated so appends stay valid.
+        """
+        if not os.path.exists(output_path):
+            return
+        with open(output_path, 'rb+') as file:
+            file.seek(0, os.SEEK_END)
+            size = file.tell()
+            end = size
+            while end > 0:
+                start = max(0, end - 4096)
+                file.seek(start)
+                last_newline = file.read(end - start).rfind(b'\n')
+                if last_newline >= 0:
+                    end = start + last_newline + 1
+                    break
+                end = start
+            if end != size:
+                file.truncate(end)
+        with open(output_path, newline='', encoding='utf-8') as file:
+            rows = csv.DictReader(file) if output_path.lower().endswith('.csv') else (json.loads(line) for line in file if line.strip())
+            for row in rows:
+                index = int(row['index'])
+                if index >= self.watermark:
+                    self.mark_done(index)
+
+    def save(self) -> None:
+        """Atomically replace the checkpoint file."""
+        temporary_path = f'{self.path}.tmp'
+        with open(temporary_path, 'w', encoding='utf-8') as file:
+            json.dump({'watermark': self.watermark, 'done': sorted(self.done)}, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary_path, self.path)
+
+class ResultWriter:
+    """Append results to a JSONL or CSV file as they complete."""
+
+    def __init__(self, path: str):
+        self.is_csv = path.lower().endswith('.csv')
+        write_header = self.is_csv and (not os.path.exists(path) or os.path.getsize(path) == 0)
+        self.file = open(path, 'a', newline='', encoding='utf-8')
+        if self.is_csv:
+            self.writer = csv.DictWriter(self.file, fieldnames=CSV_COLUMNS)
+            if write_header:
+                self.writer.writeheader()
+
+    def write(self, index: int, listing_id: Optional[str], result: dict) -> None:
+        if self.is_csv:
+            row = {'index': index, 'id': listing_id, 'status': result['status'], 'fields': ','.join(result['fields']), 'error': result['error']}
+            row.update(result['details'] or {})
+            row.update(result['prediction'] or {})
+            self.writer.writerow(row)
+        else:
+            self.file.write(json.dumps({'index': index, 'id': listing_id, **result}, ensure_ascii=False) + '\n')
+
+    def flush(self) -> None:
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self) -> None:
+        self.file.close()
+
+async def value_file(value_listing: Callable[[str], Awaitable[dict]], input_path: str, output_path: str,
+                     text_field: str = 'text', id_field: str = 'id', concurrency: int = 16,
+                     checkpoint_path: Optional[str] = None) -> dict:
+    """Value every listing of the input with ``concurrency`` workers and return the status counts.
+
+    The input is read lazily through a bounded queue, so memory stays constant. Results are
+    written as they complete (not in input order) and carry the record ``index``, which is
+    how a resumed run skips the records written after the last checkpoint.
+    """
+    checkpoint = Checkpoint(checkpoint_path or f'{output_path}.checkpoint')
+    checkpoint.recover(output_path)
+    writer = ResultWriter(output_path)
+    queue = asyncio.Queue(maxsize=concurrency * 2)
+    counts = {}
+    skipped = 0
+    started = time.monotonic()
+
+    def record(index, listing_id, result) -> None:
+        writer.write(index, listing_id, result)
+        checkpoint.mark_done(index)
+        counts[result['status']] = counts.get(result['status'], 0) + 1
+        processed = sum(counts.values())
+        if processed % CHECKPOINT_EVERY == 0:
+            writer.flush()
+            checkpoint.save()
+        if processed % PROGRESS_EVERY == 0:
+            logger.info("Bulk valuation: %s listings (%.1f/s) %s", processed, processed / (time.monotonic() - started), counts)
+
+    async def worker() -> None:
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            index, listing_id, text = item
+            record(index, listing_id, await value_listing(text))
+
+    workers = [asyncio.create_task(worker()) for _ in range(concurrency)]
+    try:
+        for index, listing_id, text in iter_listings(input_path, text_field, id_field):
+            if checkpoint.is_done(index):
+                skipped += 1
+                continue
+            await queue.put((index, listing_id, text))
+        for _ in workers:
+            await queue.put(None)
+        await asyncio.gather(*workers)
+    finally:
+        for task in workers:
+            task.cancel()
+        writer.flush()
+        writer.close()
+        checkpoint.save()
+
+    elapsed = time.monotonic() - started
+    processed = sum(counts.values())
+    summary = {'processed': processed, 'skipped': skipped, 'elapsed_s': round(elapsed, 3),
+               'listings_per_s': round(processed / elapsed, 2) if elapsed else 0.0, 'statuses': counts}
+    logger.info("Bulk valuation finished: %s", summary)
+    return summary
+
+def run_bulk(value_listing: Callable[[str], Awaitable[dict]], input_path: str, output_path: str,
+             text_field: str = 'text', id_field: str = 'id', concurrency: int = 16,
+             checkpoint_path: Optional[str] = None, on_start: Optional[Callable[[], Awaitable]] = None,
+             on_close: Optional[Callable[[], Awaitable]] = None) -> dict:
+    """Run the bulk valuation between the ``on_start`` and ``on_close`` hooks of the bot."""
+
+    async def run() -> dict:
+        if on_start is not None:
+            await on_start()
+        try:
+            return await value_file(value_listing, input_path, output_path, text_field, id_field, concurrency, checkpoint_path)
+        finally:
+            if on_close is not None:
+                await on_close()
+
+    summary = asyncio.run(run())
+    print(json.dumps(summary))
+    return summary
@@ -0,0 +1,349 @@
+# @Author: Humberto Alejandro Ortega Alcocer
+# @Date: 2024-Junio-24
+# @Description: Cachés del bot de SkyPrice: extracciones del LLM (LRU + SQLite) y predicciones de precio (cuantizadas, single-flight).
+# @License: MIT
+import asyncio
+import copy
+import hashlib
+import json
+import logging
+import queue
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Awaitable, Callable, Optional
+
+from skyprice_models import ApartmentDetails, PricePrediction
+
+# Get the logger instance
+logger = logging.getLogger(__name__)
+
+# Expresión regular para colapsar espacios en blanco
+WHITESPACE_RE = re.compile(r'\s+')
+
+def normalize_text(text: str) -> str:
+    """Normalize a message so near-identical copies share the same cache key."""
+    decomposed = unicodedata.normalize('NFKD', text)
+    without_accents = ''.join(char for char in decomposed if not unicodedata.combining(char))
+    return WHITESPACE_RE.sub(' ', without_accents.casefold()).strip()
+
+def fingerprint(*parts: str) -> str:
+    """Return a stable SHA-256 fingerprint of the given parts."""
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part.encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+class ExtractionCache:
+    """Content-addressed cache of parsed ApartmentDetails keyed by normalized message text.
+
+    Lookups go to an in-memory LRU first and then to an optional SQLite file. Entries
+    expire after ``ttl`` seconds and each tier is bounded in size. The ``namespace`` (for
+    example a hash of the model and system prompt) is part of every key, and rows written
+    under another namespace are purged on startup so a prompt change invalidates the cache.
+    Disk writes are queued to a background thread that commits them in batches, so ``set``
+    never waits for the disk; ``aget`` reads the disk in a thread on a memory miss.
+    """
+
+    def __init__(self, path: Optional[str], namespace: str, ttl: float = 7 * 24 * 3600,
+                 max_memory_entries: int = 1024, max_disk_entries: int = 100000,
+                 batch_size: int = 256, flush_interval: float = 0.5):
+        self.namespace = namespace
+        self.ttl = ttl
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_entries = max_disk_entries
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.hits_memory = 0
+        self.hits_disk = 0
+        self.misses = 0
+        self.errors = 0
+        self._memory = OrderedDict()
+        # Candados separados: una consulta a memoria no espera a que el hilo escritor confirme un lote
+        self._lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        self._writes = 0
+        self._db = None
+        self._queue = None
+        self._writer = None
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('PRAGMA synchronous=NORMAL')
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS extraction_cache ('
+                'key TEXT PRIMARY KEY, namespace TEXT NOT NULL, value TEXT NOT NULL, '
+                'created_at REAL NOT NULL, accessed_at REAL NOT NULL)'
+            )
+            self._db.execute('CREATE INDEX IF NOT EXISTS extraction_cache_accessed ON extraction_cache (accessed_at)')
+            purged = self._db.execute('DELETE FROM extraction_cache WHERE namespace != ?', (namespace,)).rowcount
+            if purged:
+                logger.info("Purged %s extraction cache entries from a previous prompt", purged)
+            self._queue = queue.SimpleQueue()
+            self._writer = threading.Thread(target=self._write_loop, name='skyprice-extraction-cache', daemon=True)
+            self._writer.start()
+
+    def key(self, text: str) -> str:
+        """Return the cache key for a message."""
+        return fingerprint(self.namespace, normalize_text(text))
+
+    def get(self, text: str) -> Optional[ApartmentDetails]:
+        """Return a copy of the cached details for the message, or None on a miss (may read the disk)."""
+        key, now = self.key(text), time.time()
+        details = self._get_memory(key, now)
+        if details is None and self._db is not None:
+            details = self._get_disk(key, now)
+        if details is None:
+            self.misses += 1
+        return details
+
+    async def aget(self, text: str) -> Optional[ApartmentDetails]:
+        """Like ``get``, reading the disk in a thread so the event loop never waits for it."""
+        key, now = self.key(text), time.time()
+        details = self._get_memory(key, now)
+        if details is None and self._db is not None:
+            details = await asyncio.to_thread(self._get_disk, key, now)
+        if details is None:
+            self.misses += 1
+        return details
+
+    def set(self, text: str, details: ApartmentDetails) -> None:
+        """Store the parsed details for the message in memory and queue the disk write."""
+        key = self.key(text)
+        now = time.time()
+        with self._lock:
+            self._remember(key, copy.copy(details), now)
+        if self._queue is not None:
+            self._queue.put(('set', key, json.dumps(details.__dict__), now))
+
+    def invalidate(self) -> None:
+        """Drop every cached entry, e.g. after changing the extraction prompt."""
+        self.flush()
+        with self._lock:
+            self._memory.clear()
+        if self._db is not None:
+            with self._db_lock:
+                self._db.execute('DELETE FROM extraction_cache')
+
+    def flush(self, timeout: Optional[float] = None) -> None:
+        """Wait until every disk write queued so far has been committed."""
+        if self._queue is not None:
+            event = threading.Event()
+            self._queue.put(event)
+            event.wait(timeout)
+
+    def stats(self) -> dict:
+        """Return the hit/miss counters, the writes still queued and the ones that failed."""
+        lookups = self.hits_memory + self.hits_disk + self.misses
+        return {
+            'hits_memory': self.hits_memory,
+            'hits_disk': self.hits_disk,
+            'misses': self.misses,
+            'hit_rate': (self.hits_memory + self.hits_disk) / lookups if lookups else 0.0,
+            'memory_entries': len(self._memory),
+            'pending_writes': self._queue.qsize() if self._queue is not None else 0,
+            'write_errors': self.errors,
+        }
+
+    def close(self) -> None:
+        """Write the pending entries, stop the writer thread and close the SQLite connection."""
+        if self._writer is not None:
+            self._queue.put(None)
+            self._writer.join()
+            self._writer = None
+        if self._db is not None:
+            with self._db_lock:
+                self._db.close()
+            self._db = None
+
+    def _get_memory(self, key: str, now: float) -> Optional[ApartmentDetails]:
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is None:
+                return None
+            details, created_at = entry
+            if now - created_at <= self.ttl:
+                self._memory.move_to_end(key)
+                self.hits_memory += 1
+                return copy.copy(details)
+            del self._memory[key]
+            return None
+
+    def _get_disk(self, key: str, now: float) -> Optional[ApartmentDetails]:
+        with self._db_lock:
+            row = self._db.execute('SELECT value, created_at FROM extraction_cache WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        value, created_at = row
+        if now - created_at > self.ttl:
+            self._queue.put(('delete', key))
+            return None
+        # La fecha de acceso (para el desalojo) se actualiza en el hilo escritor
+        self._queue.put(('touch', key, now))
+        details = ApartmentDetails.from_dict(json.loads(value))
+        with self._lock:
+            self._remember(key, details, created_at)
+        self.hits_disk += 1
+        return copy.copy(details)
+
+    def _remember(self, key, details, created_at) -> None:
+        """Insert into the in-memory LRU, evicting the least recently used entries."""
+        self._memory[key] = (details, created_at)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+
+    def _write_batch(self, batch: list) -> None:
+        """Apply the queued writes in a single transaction."""
+        with self._db_lock:
+            self._db.execute('BEGIN')
+            try:
+                for operation, key, *values in batch:
+                    if operation == 'set':
+                        value, now = values
+                        self._db.execute(
+                            'INSERT OR REPLACE INTO extraction_cache (key, namespace, value, created_at, accessed_at) '
+                            'VALUES (?, ?, ?, ?, ?)',
+                            (key, self.namespace, value, now, now)
+                        )
+                        self._writes += 1
+                        if self._writes % 256 == 0:
+                            self._evict_disk(now)
+                    elif operation == 'touch':
+                        self._db.execute('UPDATE extraction_cache SET accessed_at = ? WHERE key = ?', (values[0], key))
+                    else:
+                        self._db.execute('DELETE FROM extraction_cache WHERE key = ?', (key,))
+            except BaseException:
+                self._db.execute('ROLLBACK')
+                raise
+            self._db.execute('COMMIT')
+
+    def _write_loop(self) -> None:
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            batch, events = [], []
+            deadline = time.monotonic() + self.flush_interval
+            # Agrupa lo que llegue durante flush_interval (o hasta batch_size) en una sola transacción
+            while True:
+                if item is None:
+                    stopping = True
+                    break
+                if isinstance(item, threading.Event):
+                    events.append(item)
+                    break
+                batch.append(item)
+                if len(batch) >= self.batch_size:
+                    break
+                try:
+                    item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+            if batch:
+                try:
+                    self._write_batch(batch)
+                except sqlite3.Error as e:
+                    logger.info("Error writing %s extraction cache entries: %s", len(batch), e)
+                    self.errors += len(batch)
+            for event in events:
+                event.set()
+
+    def _evict_disk(self, now) -> None:
+        """Remove expired rows and trim the table to its maximum size."""
+        self._db.execute('DELETE FROM extraction_cache WHERE created_at < ?', (now - self.ttl,))
+        count = self._db.execute('SELECT COUNT(*) FROM extraction_cache').fetchone()[0]
+        if count > self.max_disk_entries:
+            self._db.execute(
+                'DELETE FROM extraction_cache WHERE key IN '
+                '(SELECT key FROM extraction_cache ORDER BY accessed_at ASC LIMIT ?)',
+                (count - self.max_disk_entries,)
+            )
+
+class PredictionCache:
+    """TTL cache of SkyPrice predictions keyed on a canonicalized ApartmentDetails.
+
+    Coordinates are quantized to a grid of ``grid`` degrees and the numeric fields are
+    normalized, so apartments that only differ by spurious LLM precision share an entry.
+    Concurrent lookups for the same key are coalesced into a single in-flight request.
+    ``version`` identifies the SkyPrice model; changing it (or waiting ``ttl`` seconds)
+    discards prices computed by a previous model.
+    """
+
+    def __init__(self, ttl: float = 6 * 3600, grid: float = 0.001, max_entries: int = 4096, version: str = ''):
+        self.ttl = ttl
+        self.grid = grid
+        self.max_entries = max_entries
+        self.version = version
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self._entries = OrderedDict()
+        self._in_flight = {}
+
+    def key(self, details: ApartmentDetails) -> tuple:
+        """Return the canonical key of the apartment details."""
+        return (
+            self.version,
+            round(float(details.Size_Terrain)),
+            round(float(details.Size_Construction)),
+            round(float(details.Rooms)),
+            round(float(details.Bathrooms) * 2) / 2,
+            round(float(details.Parking)),
+            round(float(details.Age)),
+            round(float(details.Lat) / self.grid),
+            round(float(details.Lng) / self.grid),
+            normalize_text(str(details.Municipality)),
+        )
+
+    async def get_or_fetch(self, details: ApartmentDetails,
+                           fetch: Callable[[ApartmentDetails], Awaitable[PricePrediction]]) -> PricePrediction:
+        """Return the cached prediction, joining an in-flight request or calling ``fetch`` on a miss."""
+        key = self.key(details)
+        entry = self._entries.get(key)
+        if entry is not None:
+            prediction, created_at = entry
+            if time.monotonic() - created_at <= self.ttl:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return prediction
+            del self._entries[key]
+
+        in_flight = self._in_flight.get(key)
+        if in_flight is not None:
+            self.coalesced += 1
+        else:
+            self.misses += 1
+            # The request runs as its own task so a cancelled caller does not cancel the other waiters
+            in_flight = asyncio.ensure_future(fetch(details))
+            self._in_flight[key] = in_flight
+            in_flight.add_done_callback(lambda task: self._complete(key, task))
+        return await asyncio.shield(in_flight)
+
+    def _complete(self, key, task) -> None:
+        """Store the result of a finished request; failures are not cached."""
+        del self._in_flight[key]
+        if task.cancelled() or task.exception() is not None:
+            return
+        self._entries[key] = (task.result(), time.monotonic())
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def invalidate(self) -> None:
+        """Drop every cached prediction, e.g. after a SkyPrice model retrain."""
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        """Return the hit/miss/coalesced counters."""
+        lookups = self.hits + self.misses + self.coalesced
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+            'hit_rate': (self.hits + self.coalesced) / lookups if lookups else 0.0,
+            'entries': len(self._entries),
+            'in_flight': len(self._in_flight),
+        }
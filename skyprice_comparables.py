@@ -0,0 +1,268 @@
+# @Author: Humberto Alejandro Ortega Alcocer
+# @Date: 2024-Junio-24
+# @Description: Almacén local (SQLite, solo agregar) de las valuaciones producidas, con índice de cuadrícula sobre Lat/Lng para buscar comparables.
+# @License: MIT
+import hashlib
+import math
+import queue
+import sqlite3
+import threading
+import time
+from typing import Iterable, List, Optional, Tuple
+
+from skyprice_geo import haversine_km
+
+# Separación entre filas de la cuadrícula en la llave de celda; las columnas (longitud) caben holgadamente
+CELL_STRIDE = 1 << 24
+
+# Kilómetros por grado usados para convertir el radio de búsqueda en celdas (conservador para la CDMX)
+KM_PER_DEGREE = 104.0
+
+# Resolución del histograma de precio por m² por celda (escala logarítmica, 1% por intervalo)
+PRICE_BIN_WIDTH = 0.01
+
+# Columnas de cada valuación; la llave de celda, el precio por m² y su intervalo se calculan al agregar
+COLUMNS = ('created_at', 'cell', 'lat', 'lng', 'municipality', 'size_terrain', 'size_construction', 'rooms',
+           'bathrooms', 'parking', 'age', 'random_forest', 'svm', 'neural_network', 'price', 'price_m2', 'price_bin')
+
+# Columnas devueltas por las consultas
+RESULT_COLUMNS = ('lat', 'lng', 'municipality', 'size_construction', 'rooms', 'bathrooms', 'parking', 'age', 'price', 'price_m2', 'created_at')
+
+class ComparablesStore:
+    """Append-only store of validated valuations with a uniform grid index on Lat/Lng.
+
+    ``append`` only queues the valuation; a background thread writes the queue in batches
+    (one transaction each), so the handler never waits for the disk. Each row carries the
+    key of its grid cell (``cell_size`` degrees); the nearest-neighbour search reads, ring
+    by ring, only the cells around the point from a covering index, and the area statistics
+    come from a per-cell histogram of the price per m² kept up to date by a trigger.
+    Identical valuations are stored once. ``path=None`` keeps the store in memory.
+    """
+
+    def __init__(self, path: Optional[str], cell_size: float = 0.0025, batch_size: int = 512, flush_interval: float = 1.0):
+        self.cell_size = cell_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.appended = 0
+        self.written = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path or ':memory:', check_same_thread=False, isolation_level=None, timeout=5.0)
+        if path:
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS valuations ('
+            'id INTEGER PRIMARY KEY, key INTEGER NOT NULL UNIQUE, created_at REAL NOT NULL, cell INTEGER NOT NULL, '
+            'lat REAL NOT NULL, lng REAL NOT NULL, municipality TEXT, size_terrain REAL, size_construction REAL, '
+            'rooms REAL, bathrooms REAL, parking REAL, age REAL, random_forest REAL, svm REAL, neural_network REAL, '
+            'price REAL NOT NULL, price_m2 REAL, price_bin INTEGER)'
+        )
+        # Índice de cuadrícula que cubre los filtros y la distancia: la búsqueda no lee la tabla
+        self._db.execute('CREATE INDEX IF NOT EXISTS valuations_cell ON valuations (cell, rooms, size_construction, lat, lng)')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS price_histogram ('
+            'cell INTEGER NOT NULL, bin INTEGER NOT NULL, count INTEGER NOT NULL, PRIMARY KEY (cell, bin)) WITHOUT ROWID'
+        )
+        self._db.execute(
+            'CREATE TRIGGER IF NOT EXISTS valuations_histogram AFTER INSERT ON valuations WHEN NEW.price_bin IS NOT NULL BEGIN '
+            'INSERT INTO price_histogram (cell, bin, count) VALUES (NEW.cell, NEW.price_bin, 1) '
+            'ON CONFLICT (cell, bin) DO UPDATE SET count = count + 1; END'
+        )
+        self._queue = queue.SimpleQueue()
+        self._writer = threading.Thread(target=self._write_loop, name='skyprice-comparables', daemon=True)
+        self._writer.start()
+
+    def cell(self, lat: float, lng: float) -> Tuple[int, int]:
+        """Return the (row, column) grid cell of a point."""
+        return math.floor(lat / self.cell_size), math.floor(lng / self.cell_size)
+
+    def row(self, details: dict, prediction: dict, created_at: Optional[float] = None) -> tuple:
+        """Build the stored row (key first) of a valuation, from ApartmentDetails and PricePrediction dicts."""
+        lat, lng = float(details['Lat']), float(details['Lng'])
+        row_index, column = self.cell(lat, lng)
+        prices = [float(prediction['Random_Forest']), float(prediction['SVM']), float(prediction['Neural_Network'])]
+        price = sum(prices) / len(prices)
+        size = details.get('Size_Construction')
+        price_m2 = price / float(size) if size else None
+        identity = '|'.join(str(details.get(field)) for field in ('Size_Terrain', 'Size_Construction', 'Rooms', 'Bathrooms', 'Parking', 'Age'))
+        key = int.from_bytes(hashlib.sha1(f'{lat:.5f}|{lng:.5f}|{identity}'.encode('utf-8')).digest()[:8], 'big', signed=True)
+        return (
+            key, created_at or time.time(), row_index * CELL_STRIDE + column, lat, lng, details.get('Municipality'),
+            details.get('Size_Terrain'), size, details.get('Rooms'), details.get('Bathrooms'), details.get('Parking'),
+            details.get('Age'), *prices, price, price_m2,
+            round(math.log(price_m2) / math.log1p(PRICE_BIN_WIDTH)) if price_m2 and price_m2 > 0 else None,
+        )
+
+    def append(self, details: dict, prediction: dict) -> None:
+        """Queue a valuation to be written; never blocks on the database."""
+        try:
+            row = self.row(details, prediction)
+        except (KeyError, TypeError, ValueError):
+            self.errors += 1
+            return
+        self.appended += 1
+        self._queue.put(row)
+
+    def extend(self, rows: Iterable[tuple]) -> int:
+        """Write already built rows synchronously (e.g. an import); returns how many were new."""
+        with self._lock:
+            self._db.execute('BEGIN')
+            try:
+                # rowcount cuenta solo las filas nuevas (no las ignoradas ni las del trigger)
+                written = self._db.executemany(
+                    f'INSERT OR IGNORE INTO valuations (key, {", ".join(COLUMNS)}) VALUES ({", ".join("?" * (len(COLUMNS) + 1))})', rows
+                ).rowcount
+            except BaseException:
+                self._db.execute('ROLLBACK')
+                raise
+            self._db.execute('COMMIT')
+        self.written += written
+        return written
+
+    def _write_loop(self) -> None:
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            batch, events = [], []
+            deadline = time.monotonic() + self.flush_interval
+            # Agrupa lo que llegue durante flush_interval (o hasta batch_size) en una sola transacción
+            while True:
+                if item is None:
+                    stopping = True
+                    break
+                if isinstance(item, threading.Event):
+                    events.append(item)
+                    break
+                batch.append(item)
+                if len(batch) >= self.batch_size:
+                    break
+                try:
+                    item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+            if batch:
+                try:
+                    self.extend(batch)
+                except sqlite3.Error:
+                    self.errors += len(batch)
+            for event in events:
+                event.set()
+
+    def flush(self, timeout: Optional[float] = None) -> None:
+        """Wait until every valuation queued so far has been written."""
+        event = threading.Event()
+        self._queue.put(event)
+        event.wait(timeout)
+
+    def _ring_cells(self, row_index: int, column: int, ring: int) -> List[int]:
+        """Return the keys of the cells on the square ring at ``ring`` cells from the center."""
+        if ring == 0:
+            return [row_index * CELL_STRIDE + column]
+        cells = []
+        for current in range(row_index - ring, row_index + ring + 1):
+            base = current * CELL_STRIDE
+            if abs(current - row_index) == ring:
+                cells.extend(range(base + column - ring, base + column + ring + 1))
+            else:
+                cells.extend((base + column - ring, base + column + ring))
+        return cells
+
+    def nearest(self, lat: float, lng: float, k: int = 5, size: Optional[float] = None, rooms: Optional[float] = None,
+                size_tolerance: float = 0.25, rooms_tolerance: int = 1, max_km: float = 5.0) -> List[dict]:
+        """Return up to ``k`` past valuations closest to the point, within ``max_km``.
+
+        With ``size`` only valuations within ``size_tolerance`` of the construction size are
+        considered, and with ``rooms`` only those within ``rooms_tolerance`` rooms. Each
+        result includes its ``distance_km``.
+        """
+        conditions, params = '', ()
+        if rooms is not None:
+            conditions += ' AND rooms BETWEEN ? AND ?'
+            params += (rooms - rooms_tolerance, rooms + rooms_tolerance)
+        if size:
+            conditions += ' AND size_construction BETWEEN ? AND ?'
+            params += (size * (1 - size_tolerance), size * (1 + size_tolerance))
+        row_index, column = self.cell(lat, lng)
+        cell_km = self.cell_size * KM_PER_DEGREE
+        candidates = []
+        with self._lock:
+            for ring in range(int(max_km / cell_km) + 2):
+                cells = self._ring_cells(row_index, column, ring)
+                query = f'SELECT id, lat, lng FROM valuations WHERE cell IN ({", ".join("?" * len(cells))}){conditions}'
+                for valuation_id, other_lat, other_lng in self._db.execute(query, (*cells, *params)):
+                    distance = haversine_km(lat, lng, other_lat, other_lng)
+                    if distance <= max_km:
+                        candidates.append((distance, valuation_id))
+                candidates.sort()
+                # Las celdas ya recorridas contienen todo lo que está a menos de ring * cell_km del punto
+                if len(candidates) >= k and candidates[k - 1][0] <= ring * cell_km:
+                    break
+            candidates = candidates[:k]
+            rows = {row[0]: row[1:] for row in self._db.execute(
+                f'SELECT id, {", ".join(RESULT_COLUMNS)} FROM valuations WHERE id IN ({", ".join("?" * len(candidates))})',
+                [valuation_id for _, valuation_id in candidates],
+            )}
+        return [dict(zip(RESULT_COLUMNS, rows[valuation_id]), distance_km=distance) for distance, valuation_id in candidates]
+
+    def area_stats(self, lat: float, lng: float, radius_km: float = 1.0) -> dict:
+        """Return the count, mean and percentiles of the price per m² around the point.
+
+        The area is made of the grid cells whose center lies within ``radius_km`` (so its
+        edge has the resolution of the grid) and the prices come from the per-cell
+        histogram, accurate to PRICE_BIN_WIDTH.
+        """
+        row_index, column = self.cell(lat, lng)
+        rings = int(radius_km / (self.cell_size * KM_PER_DEGREE)) + 1
+        cells = []
+        for current in range(row_index - rings, row_index + rings + 1):
+            for other in range(column - rings, column + rings + 1):
+                center_lat, center_lng = (current + 0.5) * self.cell_size, (other + 0.5) * self.cell_size
+                if haversine_km(lat, lng, center_lat, center_lng) <= radius_km:
+                    cells.append(current * CELL_STRIDE + other)
+        if not cells:
+            cells.append(row_index * CELL_STRIDE + column)
+        with self._lock:
+            histogram = self._db.execute(
+                f'SELECT bin, SUM(count) FROM price_histogram WHERE cell IN ({", ".join("?" * len(cells))}) GROUP BY bin ORDER BY bin',
+                cells,
+            ).fetchall()
+        total = sum(count for _, count in histogram)
+        if not total:
+            return {'count': 0, 'radius_km': radius_km}
+        base = math.log1p(PRICE_BIN_WIDTH)
+        stats = {'count': total, 'radius_km': radius_km, 'mean': sum(math.exp(bin_index * base) * count for bin_index, count in histogram) / total}
+        for name, fraction in (('p25', 0.25), ('median', 0.5), ('p75', 0.75)):
+            # Percentil por rango más cercano, como skyprice_batch.percentile
+            rank, seen = min(total - 1, int(fraction * total)), 0
+            for bin_index, count in histogram:
+                seen += count
+                if seen > rank:
+                    stats[name] = math.exp(bin_index * base)
+                    break
+        return stats
+
+    def municipality_price_m2(self, before: Optional[float] = None) -> List[Tuple[str, float, int]]:
+        """Return ``(municipality, mean log price per m², count)`` for the valuations stored before ``before``."""
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT municipality, AVG(price_bin), COUNT(*) FROM valuations WHERE price_bin IS NOT NULL AND created_at < ? GROUP BY municipality',
+                (before if before is not None else math.inf,),
+            ).fetchall()
+        return [(municipality, mean_bin * math.log1p(PRICE_BIN_WIDTH), count) for municipality, mean_bin, count in rows]
+
+    def count(self) -> int:
+        """Return the number of stored valuations."""
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM valuations').fetchone()[0]
+
+    def stats(self) -> dict:
+        """Return the valuations appended, written and still queued, and the rows that failed."""
+        return {'appended': self.appended, 'written': self.written, 'pending': self._queue.qsize(), 'errors': self.errors}
+
+    def close(self) -> None:
+        """Write the pending valuations, stop the writer thread and close the database."""
+        self._queue.put(None)
+        self._writer.join()
+        with self._lock:
+            self._db.close()
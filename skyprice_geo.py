@@ -0,0 +1,312 @@
+# @Author: Humberto Alejandro Ortega Alcocer
+# @Date: 2024-Junio-24
+# @Description: Geocodificador local de alcaldías y colonias de la CDMX con búsqueda difusa (trie) e índice espacial (cuadrícula).
+# @License: MIT
+import json
+import math
+import os
+from collections import namedtuple
+from typing import Iterable, List, Optional, Tuple
+
+from skyprice_cache import normalize_text
+
+# Gazetteer incluido con el bot
+DEFAULT_GAZETTEER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'skyprice_gazetteer.json')
+
+# Caja envolvente de la Ciudad de México (lat_min, lat_max, lng_min, lng_max)
+CDMX_BOUNDS = (19.04, 19.60, -99.37, -98.94)
+
+# Lugar del gazetteer: alcaldía o colonia
+Place = namedtuple('Place', ['name', 'kind', 'municipality', 'lat', 'lng'])
+
+def haversine_km(lat1, lng1, lat2, lng2) -> float:
+    """Return the great-circle distance between two points in kilometers."""
+    lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    return 12742 * math.asin(math.sqrt(a))
+
+def point_in_polygon(lat, lng, ring) -> bool:
+    """Ray-casting test of a point against a ring of (lat, lng) vertices."""
+    inside = False
+    j = len(ring) - 1
+    for i in range(len(ring)):
+        lat_i, lng_i = ring[i]
+        lat_j, lng_j = ring[j]
+        if (lat_i > lat) != (lat_j > lat) and lng < (lng_j - lng_i) * (lat - lat_i) / (lat_j - lat_i) + lng_i:
+            inside = not inside
+        j = i
+    return inside
+
+class NameTrie:
+    """Character trie over normalized place names, with longest-match scanning and fuzzy lookup."""
+
+    # Llave reservada para los lugares que terminan en un nodo
+    END = '\0'
+
+    def __init__(self):
+        self.root = {}
+
+    def insert(self, name: str, place: Place) -> None:
+        """Index a place under a (normalized) name."""
+        node = self.root
+        for char in normalize_text(name):
+            node = node.setdefault(char, {})
+        places = node.setdefault(self.END, [])
+        if place not in places:
+            places.append(place)
+
+    def get(self, name: str) -> List[Place]:
+        """Return the places indexed under exactly this name."""
+        node = self._walk(normalize_text(name))
+        return list(node.get(self.END, [])) if node else []
+
+    def complete(self, prefix: str, limit: int = 10) -> List[Place]:
+        """Return up to ``limit`` places whose name starts with the prefix."""
+        node = self._walk(normalize_text(prefix))
+        found = []
+        stack = [node] if node else []
+        while stack and len(found) < limit:
+            current = stack.pop()
+            for key, child in current.items():
+                if key == self.END:
+                    found.extend(place for place in child if place not in found)
+                else:
+                    stack.append(child)
+        return found[:limit]
+
+    def fuzzy(self, name: str, max_distance: Optional[int] = None) -> List[Place]:
+        """Return the places whose name is within the edit distance, closest first."""
+        word = normalize_text(name)
+        if max_distance is None:
+            max_distance = 0 if len(word) <= 3 else 1 if len(word) <= 7 else 2
+        results = []
+        first_row = list(range(len(word) + 1))
+        for char, child in self.root.items():
+            if char != self.END:
+                self._fuzzy_search(child, char, word, first_row, max_distance, results)
+        results.sort(key=lambda result: result[0])
+        places = []
+        for _, found in results:
+            places.extend(place for place in found if place not in places)
+        return places
+
+    def scan(self, text: str) -> List[Tuple[int, int, List[Place]]]:
+        """Return every (start, end, places) name match that starts and ends on a word boundary."""
+        matches = []
+        length = len(text)
+        for start in range(length):
+            if start > 0 and text[start - 1].isalnum():
+                continue
+            node = self.root
+            position = start
+            while position < length and text[position] in node:
+                node = node[text[position]]
+                position += 1
+                if self.END in node and (position == length or not text[position].isalnum()):
+                    matches.append((start, position, node[self.END]))
+        return matches
+
+    def _walk(self, word: str):
+        node = self.root
+        for char in word:
+            node = node.get(char)
+            if node is None:
+                return None
+        return node
+
+    def _fuzzy_search(self, node, char, word, previous_row, max_distance, results) -> None:
+        """Levenshtein search over the trie, pruning branches that cannot match."""
+        row = [previous_row[0] + 1]
+        for column in range(1, len(word) + 1):
+            row.append(min(
+                row[column - 1] + 1,
+                previous_row[column] + 1,
+                previous_row[column - 1] + (word[column - 1] != char),
+            ))
+        if row[-1] <= max_distance and self.END in node:
+            results.append((row[-1], node[self.END]))
+        if min(row) <= max_distance:
+            for next_char, child in node.items():
+                if next_char != self.END:
+                    self._fuzzy_search(child, next_char, word, row, max_distance, results)
+
+class GridIndex:
+    """Uniform grid spatial index of points and polygons."""
+
+    def __init__(self, cell_size: float = 0.02):
+        self.cell_size = cell_size
+        self.points = {}
+        self.polygons = {}
+
+    def cell(self, lat, lng) -> Tuple[int, int]:
+        """Return the grid cell containing the point."""
+        return (math.floor(lat / self.cell_size), math.floor(lng / self.cell_size))
+
+    def add_point(self, place: Place) -> None:
+        """Index a place by its coordinates."""
+        self.points.setdefault(self.cell(place.lat, place.lng), []).append(place)
+
+    def add_polygon(self, name: str, ring: List[Tuple[float, float]]) -> None:
+        """Index a polygon in every cell overlapped by its bounding box."""
+        lats = [lat for lat, _ in ring]
+        lngs = [lng for _, lng in ring]
+        low = self.cell(min(lats), min(lngs))
+        high = self.cell(max(lats), max(lngs))
+        for i in range(low[0], high[0] + 1):
+            for j in range(low[1], high[1] + 1):
+                self.polygons.setdefault((i, j), []).append((name, ring))
+
+    def containing(self, lat, lng) -> Optional[str]:
+        """Return the name of the polygon containing the point, if any."""
+        for name, ring in self.polygons.get(self.cell(lat, lng), []):
+            if point_in_polygon(lat, lng, ring):
+                return name
+        return None
+
+    def nearest(self, lat, lng, max_km: float) -> Optional[Place]:
+        """Return the closest indexed place within ``max_km``, searching rings of cells outward."""
+        center_i, center_j = self.cell(lat, lng)
+        # Approximate kilometers per cell (latitude direction is the narrower one at CDMX)
+        max_rings = int(max_km / (self.cell_size * 104)) + 1
+        best, best_distance = None, max_km
+        for radius in range(max_rings + 1):
+            for i in range(center_i - radius, center_i + radius + 1):
+                for j in range(center_j - radius, center_j + radius + 1):
+                    if max(abs(i - center_i), abs(j - center_j)) != radius:
+                        continue
+                    for place in self.points.get((i, j), []):
+                        distance = haversine_km(lat, lng, place.lat, place.lng)
+                        if distance <= best_distance:
+                            best, best_distance = place, distance
+            # Points beyond this ring are at least radius cells away
+            if best is not None and best_distance <= radius * self.cell_size * 104:
+                break
+        return best
+
+class Gazetteer:
+    """Offline gazetteer of the 16 CDMX alcaldías and their colonias."""
+
+    def __init__(self, data: dict, nearest_max_km: float = 4.0):
+        self.nearest_max_km = nearest_max_km
+        self.municipalities = {}
+        self.colonias = []
+        self.names = NameTrie()
+        self.index = GridIndex()
+        self.has_polygons = False
+
+        for municipality in data['municipalities']:
+            lat, lng = municipality['center']
+            place = Place(municipality['name'], 'municipality', municipality['name'], lat, lng)
+            self.municipalities[place.name] = place
+            for name in [place.name] + municipality.get('aliases', []):
+                self.names.insert(name, place)
+            self.index.add_point(place)
+            for ring in municipality.get('polygons', []):
+                self.index.add_polygon(place.name, [tuple(vertex) for vertex in ring])
+                self.has_polygons = True
+
+        for colonia in data.get('colonias', []):
+            lat, lng = colonia['center']
+            place = Place(colonia['name'], 'colonia', colonia['municipality'], lat, lng)
+            self.colonias.append(place)
+            for name in [place.name] + colonia.get('aliases', []):
+                self.names.insert(name, place)
+            self.index.add_point(place)
+
+    @classmethod
+    def load(cls, path: Optional[str] = None) -> 'Gazetteer':
+        """Load a gazetteer JSON file (the bundled seed by default)."""
+        with open(path or DEFAULT_GAZETTEER_PATH, encoding='utf-8') as gazetteer_file:
+            return cls(json.load(gazetteer_file))
+
+    def municipality_names(self) -> List[str]:
+        """Return the canonical municipality names."""
+        return list(self.municipalities)
+
+    def center(self, municipality: str) -> Tuple[float, float]:
+        """Return the approximate center of a municipality."""
+        place = self.municipalities[municipality]
+        return place.lat, place.lng
+
+    def lookup(self, name: str, kinds: Iterable[str] = ('municipality', 'colonia')) -> Optional[Place]:
+        """Resolve a place name, accent-insensitively, allowing small typos."""
+        if not name:
+            return None
+        for candidates in (self.names.get(name), self.names.fuzzy(name)):
+            candidates = [place for place in candidates if place.kind in kinds]
+            if candidates:
+                return candidates[0]
+        return None
+
+    def canonical_municipality(self, name) -> Optional[str]:
+        """Return the canonical name of a municipality given any spelling of it."""
+        if not isinstance(name, str):
+            return None
+        place = self.lookup(name, kinds=('municipality',))
+        return place.name if place else None
+
+    def find_in_text(self, text: str) -> Tuple[Optional[Place], Optional[Place]]:
+        """Find the municipality and colonia mentioned in a message, preferring the longest names."""
+        municipality = colonia = None
+        matches = sorted(self.names.scan(normalize_text(text)), key=lambda match: match[0] - match[1])
+        for _, _, places in matches:
+            for place in places:
+                if place.kind == 'municipality' and municipality is None:
+                    municipality = place
+                elif place.kind == 'colonia' and colonia is None:
+                    colonia = place
+        # A colonia from another municipality is most likely a false match
+        if municipality is not None and colonia is not None and colonia.municipality != municipality.name:
+            colonia = None
+        return municipality, colonia
+
+    def municipality_at(self, lat, lng) -> Optional[str]:
+        """Return the municipality containing the point.
+
+        Uses point-in-polygon when the gazetteer has boundaries, otherwise the municipality
+        of the nearest known place within ``nearest_max_km``.
+        """
+        try:
+            lat, lng = float(lat), float(lng)
+        except (TypeError, ValueError):
+            return None
+        lat_min, lat_max, lng_min, lng_max = CDMX_BOUNDS
+        if not (lat_min <= lat <= lat_max and lng_min <= lng <= lng_max):
+            return None
+        if self.has_polygons:
+            return self.index.containing(lat, lng)
+        nearest = self.index.nearest(lat, lng, self.nearest_max_km)
+        return nearest.municipality if nearest else None
+
+    def resolve(self, details_dict: dict, text: Optional[str] = None) -> dict:
+        """Fill and canonicalize Municipality, Lat and Lng in an apartment details dictionary.
+
+        Municipality names are canonicalized; a missing municipality is derived from the
+        coordinates or from a colonia mentioned in ``text``; missing coordinates come from
+        the colonia or the municipality center.
+        """
+        resolved = dict(details_dict)
+        municipality = self.canonical_municipality(resolved.get('Municipality'))
+        colonia = None
+        if text:
+            mentioned_municipality, colonia = self.find_in_text(text)
+            if municipality is None and mentioned_municipality is not None:
+                municipality = mentioned_municipality.name
+
+        has_coordinates = resolved.get('Lat') is not None and resolved.get('Lng') is not None
+        if municipality is None and has_coordinates:
+            municipality = self.municipality_at(resolved['Lat'], resolved['Lng'])
+        if municipality is None and colonia is not None:
+            municipality = colonia.municipality
+
+        if municipality is not None:
+            resolved['Municipality'] = municipality
+            if not has_coordinates:
+                if colonia is not None and colonia.municipality == municipality:
+                    resolved['Lat'], resolved['Lng'] = colonia.lat, colonia.lng
+                else:
+                    resolved['Lat'], resolved['Lng'] = self.center(municipality)
+        return resolved
+
+# Gazetteer global; SKYPRICE_GAZETTEER_PATH permite usar datos oficiales con polígonos
+gazetteer = Gazetteer.load(os.getenv('SKYPRICE_GAZETTEER_PATH') or None)
@@ -0,0 +1,140 @@
+# @Author: Humberto Alejandro Ortega Alcocer
+# @Date: 2024-Junio-24
+# @Description: Coordinación de las consultas inline: debounce por usuario, cancelación de valuaciones obsoletas, caché breve y plazo de respuesta.
+# @License: MIT
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Hashable, Optional, Tuple
+
+from skyprice_cache import normalize_text
+
+# Get the logger instance
+logger = logging.getLogger(__name__)
+
+class InlineQueryCoordinator:
+    """Run at most one inline valuation per user, keeping up with the user as they type.
+
+    ``answer(user_id, query, value)`` first looks the normalized query up in a cache of
+    results younger than ``ttl`` seconds. On a miss it waits ``debounce`` seconds and gives
+    up if the user sent a newer query meanwhile; otherwise it runs ``value(query, progress)``
+    as a task. A new query cancels the user's previous valuation as soon as it arrives, so
+    an abandoned LLM or SkyPrice call stops while the user keeps typing. If the valuation is
+    not done ``deadline`` seconds after the query arrived, the answer is whatever ``value``
+    stored in ``progress`` so far; the task keeps running (until it finishes or a newer
+    query replaces it) and its result is cached for the next identical query. Results that
+    raise or fail ``cacheable(result)`` (e.g. transient errors) are not cached.
+
+    Returns ``(outcome, result)``: ``cached``, ``complete`` (the result), ``partial`` or
+    ``error`` (the progress) and ``superseded`` (None, nothing to answer).
+    """
+
+    def __init__(self, debounce: float = 0.4, deadline: float = 8.0, ttl: float = 300.0, max_entries: int = 1024,
+                 cacheable: Optional[Callable[[Any], bool]] = None):
+        self.debounce = debounce
+        self.deadline = deadline
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.cacheable = cacheable
+        self.queries = 0
+        self.cancelled = 0
+        self.outcomes = {}
+        self._entries = OrderedDict()
+        # Consulta más reciente de cada usuario (durante el debounce) y su valuación en curso
+        self._latest = {}
+        self._running = {}
+
+    def get(self, key: str) -> Optional[Any]:
+        """Return the cached result of a normalized query, if still fresh."""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        result, created_at = entry
+        if time.monotonic() - created_at > self.ttl:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return result
+
+    def _outcome(self, outcome: str, result: Any) -> Tuple[str, Any]:
+        self.outcomes[outcome] = self.outcomes.get(outcome, 0) + 1
+        return outcome, result
+
+    def _supersede(self, user_id: Hashable, key: str) -> None:
+        """Cancel the user's valuation in progress unless it is for the same query."""
+        running = self._running.get(user_id)
+        if running is not None and running[0] != key and not running[1].done():
+            running[1].cancel()
+            self.cancelled += 1
+
+    def _complete(self, user_id: Hashable, key: str, task: asyncio.Task) -> None:
+        """Forget the finished valuation and cache its result; cancelled or failed ones are not cached."""
+        running = self._running.get(user_id)
+        if running is not None and running[1] is task:
+            del self._running[user_id]
+        if task.cancelled():
+            return
+        if task.exception() is not None:
+            logger.info("Inline valuation failed: %s", task.exception())
+            return
+        if self.cacheable is not None and not self.cacheable(task.result()):
+            return
+        self._entries[key] = (task.result(), time.monotonic())
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def answer(self, user_id: Hashable, query: str, value: Callable[[str, dict], Awaitable[Any]],
+                     started: Optional[float] = None) -> Tuple[str, Any]:
+        """Value ``query`` for ``user_id`` within the deadline, counted from ``started`` (monotonic, now by default)."""
+        started = time.monotonic() if started is None else started
+        self.queries += 1
+        key = normalize_text(query)
+        token = object()
+        self._latest[user_id] = token
+        # La valuación de una consulta anterior ya no sirve: se cancela en cuanto llega la nueva
+        self._supersede(user_id, key)
+        try:
+            cached = self.get(key)
+            if cached is None:
+                await asyncio.sleep(self.debounce)
+                if self._latest.get(user_id) is not token:
+                    return self._outcome('superseded', None)
+                # Otro usuario pudo haber valuado el mismo texto durante el debounce
+                cached = self.get(key)
+            if cached is not None:
+                return self._outcome('cached', cached)
+
+            running = self._running.get(user_id)
+            if running is not None and running[0] == key and not running[1].done():
+                # La misma consulta reenviada (p. ej. tras una respuesta parcial): se espera a la valuación en curso
+                _, task, progress = running
+            else:
+                progress = {}
+                task = asyncio.ensure_future(value(query, progress))
+                self._running[user_id] = (key, task, progress)
+                task.add_done_callback(lambda task: self._complete(user_id, key, task))
+
+            # asyncio.wait no cancela la tarea al vencer el plazo ni propaga su cancelación
+            await asyncio.wait({task}, timeout=max(0.0, self.deadline - (time.monotonic() - started)))
+            if not task.done():
+                return self._outcome('partial', progress)
+            if task.cancelled():
+                return self._outcome('superseded', None)
+            if task.exception() is not None:
+                return self._outcome('error', progress)
+            return self._outcome('complete', task.result())
+        finally:
+            if self._latest.get(user_id) is token:
+                del self._latest[user_id]
+
+    def stats(self) -> dict:
+        """Return the queries, their outcomes, the valuations cancelled and the cache size."""
+        return {
+            'queries': self.queries,
+            'cancelled': self.cancelled,
+            'in_flight': len(self._running),
+            'entries': len(self._entries),
+            **{outcome: count for outcome, count in self.outcomes.items()},
+        }
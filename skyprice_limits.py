@@ -0,0 +1,63 @@
+# @Author: Humberto Alejandro Ortega Alcocer
+# @Date: 2024-Junio-24
+# @Description: Limitadores de tasa (token bucket) para las llamadas a OpenAI y a SkyPrice, por solicitudes o por tokens.
+# @License: MIT
+import asyncio
+import time
+
+class RateLimiter:
+    """Async token bucket allowing ``rate`` units per second with bursts of ``burst``.
+
+    A ``rate`` of 0 disables the limit. Waiters are served in FIFO order. Units are requests
+    by default; ``acquire(amount)`` takes several at once (e.g. LLM tokens per minute).
+    """
+
+    def __init__(self, rate: float = 0.0, burst: int = 1):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.waited = 0.0
+        self.queued = 0.0
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self, amount: float = 1) -> None:
+        """Wait until ``amount`` tokens (at most ``burst``) are available and take them."""
+        if self.rate <= 0:
+            return
+        amount = min(amount, self.burst)
+        self.queued += amount
+        try:
+            async with self._lock:
+                self._refill()
+                if self._tokens < amount:
+                    delay = (amount - self._tokens) / self.rate
+                    self.waited += delay
+                    await asyncio.sleep(delay)
+                    self._refill()
+                self._tokens -= amount
+        finally:
+            self.queued -= amount
+
+    def would_wait(self) -> bool:
+        """Return whether ``acquire`` would have to wait right now."""
+        if self.rate <= 0:
+            return False
+        self._refill()
+        return self._tokens < 1
+
+    def backlog(self) -> float:
+        """Return the seconds until every pending ``acquire`` would be served."""
+        if self.rate <= 0:
+            return 0.0
+        self._refill()
+        return max(0.0, (self.queued - self._tokens) / self.rate)
+
+    def stats(self) -> dict:
+        """Return the configured rate, the units waiting, the backlog and the total time spent waiting for tokens."""
+        return {'rate': self.rate, 'burst': self.burst, 'queued': self.queued, 'backlog_s': self.backlog(), 'waited_s': self.waited}
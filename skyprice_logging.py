@@ -0,0 +1,149 @@
+# @Author: Humberto Alejandro Ortega Alcocer
+# @Date: 2024-Junio-24
+# @Description: Logging no bloqueante: registros estructurados (JSON o texto) escritos desde un hilo, con muestreo de payloads y redacción de datos personales.
+# @License: MIT
+import atexit
+import datetime
+import hashlib
+import json
+import logging
+import queue
+import random
+import sys
+from logging.handlers import QueueHandler, QueueListener
+from typing import Iterable, Optional, TextIO
+
+# Marca para los registros con payloads grandes (respuestas de OpenAI o SkyPrice), que se muestrean
+PAYLOAD = {'payload': True}
+
+# Atributos propios de LogRecord; el resto proviene de ``extra`` y se escribe como campos estructurados
+RESERVED_ATTRIBUTES = set(logging.LogRecord('', 0, '', 0, '', None, None).__dict__) | {'message', 'asctime', 'taskName', 'trace_id', 'payload'}
+
+# Campos de ``extra`` con datos personales (p. ej. el texto del usuario)
+REDACTED_FIELDS = ('user_text', 'user_name')
+
+def redact(value: object) -> str:
+    """Replace a value with its length and a short hash, so equal values can still be correlated."""
+    text = str(value)
+    return f'<redacted {len(text)} chars {hashlib.sha256(text.encode("utf-8")).hexdigest()[:8]}>'
+
+def record_fields(record: logging.LogRecord) -> dict:
+    """Return the structured fields passed through ``extra``."""
+    return {key: value for key, value in record.__dict__.items() if key not in RESERVED_ATTRIBUTES and not key.startswith('_')}
+
+class PayloadSampler(logging.Filter):
+    """Let through only a ``rate`` fraction of the records marked with ``PAYLOAD``."""
+
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return not getattr(record, 'payload', False) or random.random() < self.rate
+
+class RedactionFilter(logging.Filter):
+    """Redact the personal data fields of each record."""
+
+    def __init__(self, fields: Iterable[str] = REDACTED_FIELDS):
+        super().__init__()
+        self.fields = tuple(fields)
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        for field in self.fields:
+            if field in record.__dict__:
+                record.__dict__[field] = redact(record.__dict__[field])
+        return True
+
+class JSONFormatter(logging.Formatter):
+    """Format each record as one JSON object per line."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        trace_id = getattr(record, 'trace_id', '-')
+        if trace_id != '-':
+            entry['trace_id'] = trace_id
+        entry.update(record_fields(record))
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class TextFormatter(logging.Formatter):
+    """Classic text format with the structured fields appended as ``key=value``."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        line = super().format(record)
+        fields = record_fields(record)
+        if fields:
+            line += ' ' + ' '.join(f'{key}={value}' for key, value in fields.items())
+        return line
+
+class DeferredQueueHandler(QueueHandler):
+    """Queue handler that leaves the formatting to the listener thread.
+
+    The standard QueueHandler formats each message on the calling thread (the event
+    loop); here the record travels as is, so callers must not mutate the logged arguments.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+# Listener activo, detenido al reconfigurar o al salir
+_listener = None
+
+def setup_logging(level: int = logging.INFO, json_format: bool = False, trace_ids: bool = False, sample_rate: float = 0.01,
+                  redact_fields: Optional[Iterable[str]] = REDACTED_FIELDS, filters: Iterable[logging.Filter] = (),
+                  stream: Optional[TextIO] = None) -> QueueListener:
+    """Route every log record through a queue to a writer thread.
+
+    Sampling, redaction and ``filters`` (e.g. the trace id, which lives in a context
+    variable) run on the calling thread before the record is queued; formatting and the
+    write happen on the listener thread. Calling it again replaces the previous setup.
+    """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+
+    # Ninguno de los formatos usa el hilo o proceso de origen: no se calculan en cada registro. El
+    # archivo y la línea sí se calculan, porque logging no tiene una opción pública para omitirlos
+    logging.logThreads = False
+    logging.logProcesses = False
+    logging.logMultiprocessing = False
+
+    handler = logging.StreamHandler(stream or sys.stderr)
+    if json_format:
+        handler.setFormatter(JSONFormatter())
+    else:
+        handler.setFormatter(TextFormatter(
+            "%(asctime)s - %(name)s - %(levelname)s - [%(trace_id)s] %(message)s" if trace_ids else "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+        ))
+
+    queue_handler = DeferredQueueHandler(queue.SimpleQueue())
+    queue_handler.addFilter(PayloadSampler(sample_rate))
+    if redact_fields:
+        queue_handler.addFilter(RedactionFilter(redact_fields))
+    for log_filter in filters:
+        queue_handler.addFilter(log_filter)
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+
+    _listener = QueueListener(queue_handler.queue, handler, respect_handler_level=True)
+    _listener.start()
+    return _listener
+
+def stop_logging() -> None:
+    """Flush the pending records and stop the writer thread."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+atexit.register(stop_logging)
@@ -0,0 +1,295 @@
+# @Author: Humberto Alejandro Ortega Alcocer
+# @Date: 2024-Junio-24
+# @Description: Métricas del bot (histogramas, contadores, gauges) en formato Prometheus e identificadores de traza para los logs.
+# @License: MIT
+import asyncio
+import contextvars
+import functools
+import logging
+import time
+import uuid
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Callable
+
+from telegram.request import HTTPXRequest
+
+# Get the logger instance
+logger = logging.getLogger(__name__)
+
+# Límites (segundos) de los histogramas de latencia
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+def format_labels(names, values) -> str:
+    if not names:
+        return ''
+    pairs = ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                     for name, value in zip(names, values))
+    return '{' + pairs + '}'
+
+class Metric:
+    """Base class of the labelled metrics; one series per combination of label values."""
+
+    kind = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._series = {}
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self) -> list:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        for key, value in sorted(self._series.items()):
+            lines.extend(self._render_series(key, value))
+        return lines
+
+    def _render_series(self, key, value) -> list:
+        return [f'{self.name}{format_labels(self.labelnames, key)} {value}']
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        self._series[key] = self._series.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._series.get(self._key(labels), 0)
+
+    def total(self) -> float:
+        """Return the sum over every series."""
+        return sum(self._series.values())
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value: float, **labels) -> None:
+        self._series[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        self._series[key] = self._series.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels) -> None:
+        self.inc(-amount, **labels)
+
+    def value(self, **labels) -> float:
+        return self._series.get(self._key(labels), 0)
+
+    @contextmanager
+    def track(self, **labels):
+        """Count the enclosed block as in progress."""
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = [[0] * len(self.buckets), 0, 0.0]
+        index = bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            series[0][index] += 1
+        series[1] += 1
+        series[2] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the duration of the enclosed block."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def count(self, **labels) -> int:
+        series = self._series.get(self._key(labels))
+        return series[1] if series else 0
+
+    def _render_series(self, key, value) -> list:
+        bucket_counts, count, total = value
+        names = self.labelnames + ('le',)
+        lines, cumulative = [], 0
+        for bound, bucket_count in zip(self.buckets, bucket_counts):
+            cumulative += bucket_count
+            lines.append(f'{self.name}_bucket{format_labels(names, key + (bound,))} {cumulative}')
+        lines.append(f'{self.name}_bucket{format_labels(names, key + ("+Inf",))} {count}')
+        lines.append(f'{self.name}_count{format_labels(self.labelnames, key)} {count}')
+        lines.append(f'{self.name}_sum{format_labels(self.labelnames, key)} {total}')
+        return lines
+
+class Registry:
+    """Holds the metrics and the ``stats()`` callbacks exported as gauges."""
+
+    def __init__(self):
+        self._metrics = []
+        self._stats = []
+
+    def counter(self, name: str, documentation: str, labelnames=()) -> Counter:
+        return self._add(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames=()) -> Gauge:
+        return self._add(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames=(), buckets=LATENCY_BUCKETS) -> Histogram:
+        return self._add(Histogram(name, documentation, labelnames, buckets))
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def register_stats(self, prefix: str, stats: Callable[[], dict]) -> None:
+        """Export every numeric value of ``stats()`` as the gauge ``<prefix>_<key>``.
+
+        Nested dictionaries become one series per key (label ``key``).
+        """
+        self._stats.append((prefix, stats))
+
+    def render(self) -> str:
+        """Return every metric in the Prometheus text exposition format."""
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for prefix, stats in self._stats:
+            try:
+                values = stats()
+            except Exception as e:
+                logger.info("Could not collect %s stats: %s", prefix, e)
+                continue
+            for key, value in values.items():
+                name = f'{prefix}_{key}'
+                if isinstance(value, dict):
+                    lines.append(f'# TYPE {name} gauge')
+                    lines.extend(f'{name}{format_labels(("key",), (item,))} {float(count)}' for item, count in sorted(value.items()))
+                elif isinstance(value, (int, float)) and not isinstance(value, bool):
+                    lines.extend([f'# TYPE {name} gauge', f'{name} {float(value)}'])
+        return '\n'.join(lines) + '\n'
+
+# Registro global y métricas del bot
+registry = Registry()
+stage_seconds = registry.histogram('skyprice_stage_seconds', 'Latency of each valuation stage.', ['stage'])
+telegram_request_seconds = registry.histogram('skyprice_telegram_request_seconds', 'Latency of each Bot API request.', ['method'])
+errors_total = registry.counter('skyprice_errors_total', 'Errors by stage and exception class.', ['stage', 'error'])
+valuations_total = registry.counter('skyprice_valuations_total', 'Valuations by outcome.', ['status'])
+extraction_aborts_total = registry.counter('skyprice_extraction_aborts_total', 'Streamed extractions cancelled early by failed rule.', ['rule'])
+extraction_tier_seconds = registry.histogram('skyprice_extraction_tier_seconds', 'Latency of each extraction model call.', ['model'])
+extraction_tier_total = registry.counter('skyprice_extraction_tier_total', 'Extraction model calls by outcome (accepted, escalated, rejected, failed).', ['model', 'outcome'])
+extraction_tokens_total = registry.counter('skyprice_extraction_tokens_total', 'LLM tokens by model and kind (prompt, completion).', ['model', 'kind'])
+extraction_cost_usd_total = registry.counter('skyprice_extraction_cost_usd_total', 'Estimated LLM cost in USD by model.', ['model'])
+follow_ups_total = registry.counter('skyprice_follow_ups_total', 'Replies to a missing-fields question by how they were resolved (local, llm, restart).', ['source'])
+in_flight = registry.gauge('skyprice_in_flight', 'Operations currently in progress by stage.', ['stage'])
+
+# Identificador de traza de la solicitud en curso
+current_trace_id = contextvars.ContextVar('skyprice_trace_id', default='-')
+
+class TraceIdFilter(logging.Filter):
+    """Add the current ``trace_id`` to every log record."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.trace_id = current_trace_id.get()
+        return True
+
+def new_trace_id() -> str:
+    """Start a new trace in the current context and return its id."""
+    trace_id = uuid.uuid4().hex[:12]
+    current_trace_id.set(trace_id)
+    return trace_id
+
+@contextmanager
+def stage(name: str, expected: tuple = ()):
+    """Time a stage, count it as in flight and count its errors by exception class.
+
+    Exceptions in ``expected`` are outcomes of the stage (counted by their own metric), not errors.
+    """
+    started = time.perf_counter()
+    in_flight.inc(stage=name)
+    try:
+        yield
+    except expected:
+        raise
+    except Exception as e:
+        errors_total.inc(stage=name, error=type(e).__name__)
+        raise
+    finally:
+        in_flight.dec(stage=name)
+        stage_seconds.observe(time.perf_counter() - started, stage=name)
+
+def traced(name: str):
+    """Decorate a coroutine function so each call gets a trace id and is measured as a stage."""
+
+    def decorator(function):
+        @functools.wraps(function)
+        async def wrapper(*args, **kwargs):
+            # Each update (and each bulk worker) runs in its own task, so the id stays local to it
+            new_trace_id()
+            with stage(name):
+                return await function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+class InstrumentedRequest(HTTPXRequest):
+    """Bot API request class that records the latency and errors of every call by method."""
+
+    async def do_request(self, url: str, method: str, *args, **kwargs):
+        api_method = url.rsplit('/', 1)[-1]
+        started = time.perf_counter()
+        in_flight.inc(stage='telegram')
+        try:
+            return await super().do_request(url, method, *args, **kwargs)
+        except Exception as e:
+            errors_total.inc(stage='telegram', error=type(e).__name__)
+            raise
+        finally:
+            in_flight.dec(stage='telegram')
+            telegram_request_seconds.observe(time.perf_counter() - started, method=api_method)
+
+class MetricsServer:
+    """Minimal HTTP server exposing ``GET /metrics`` for Prometheus."""
+
+    def __init__(self, registry: Registry):
+        self.registry = registry
+        self.server = None
+
+    async def start(self, host: str, port: int) -> None:
+        self.server = await asyncio.start_server(self._serve, host, port)
+        logger.info("Metrics available at http://%s:%s/metrics", host, port)
+
+    async def stop(self) -> None:
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+    async def _serve(self, reader, writer) -> None:
+        try:
+            request_line = await reader.readline()
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+            target = request_line.decode('latin-1').split(' ')[1] if request_line else ''
+            if target.split('?')[0] == '/metrics':
+                status, body = '200 OK', self.registry.render().encode('utf-8')
+            else:
+                status, body = '404 Not Found', b''
+            writer.write(
+                f'HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n'
+                f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode('latin-1') + body
+            )
+            await writer.drain()
+        except (ConnectionError, IndexError):
+            pass
+        finally:
+            writer.close()
@@ -0,0 +1,137 @@
+# @Author: Humberto Alejandro Ortega Alcocer
+# @Date: 2024-Abril-8
+# @Description: Modelos de datos compartidos por el bot de SkyPrice y sus componentes.
+# @License: MIT
+
+# Campos requeridos por la API de SkyPrice, en el orden del esquema de extracción
+APARTMENT_FIELDS = ['Size_Terrain', 'Size_Construction', 'Rooms', 'Bathrooms', 'Parking', 'Age', 'Lat', 'Lng', 'Municipality']
+
+# Campos numéricos y sus límites superiores esperados
+NUMERIC_FIELDS = ['Size_Terrain', 'Size_Construction', 'Rooms', 'Bathrooms', 'Parking', 'Age']
+FIELD_LIMITS = {'Size_Terrain': 10000, 'Size_Construction': 10000, 'Rooms': 20, 'Bathrooms': 20, 'Parking': 20, 'Age': 100}
+
+def missing_fields(details_dict: dict) -> list:
+    """Return the required fields that are absent or None."""
+    return [field for field in APARTMENT_FIELDS if field not in details_dict or details_dict[field] is None]
+
+def invalid_numeric_fields(details_dict: dict, fields=NUMERIC_FIELDS) -> list:
+    """Return the numeric fields that are not numbers or are negative."""
+    return [field for field in fields if not isinstance(details_dict[field], (int, float)) or details_dict[field] < 0]
+
+def out_of_range_fields(details_dict: dict, fields=NUMERIC_FIELDS) -> list:
+    """Return the numeric fields that exceed their expected limits."""
+    return [field for field in fields if details_dict[field] > FIELD_LIMITS[field]]
+
+def validate_details(details_dict: dict, valid_municipalities) -> tuple:
+    """Apply the bot's validation rules in order.
+
+    Returns ``(None, [])`` when the details are valid, otherwise the failed rule
+    (``missing``, ``invalid_municipality``, ``invalid`` or ``out_of_range``) and the offending fields.
+    """
+    missing = missing_fields(details_dict)
+    if missing:
+        return 'missing', missing
+    if details_dict['Municipality'] not in valid_municipalities:
+        return 'invalid_municipality', ['Municipality']
+    invalid = invalid_numeric_fields(details_dict)
+    if invalid:
+        return 'invalid', invalid
+    out_of_range = out_of_range_fields(details_dict)
+    if out_of_range:
+        return 'out_of_range', out_of_range
+    return None, []
+
+def validate_many(details_dicts: list, valid_municipalities) -> list:
+    """Validate several listings at once, returning a ``(rule, fields)`` pair per listing.
+
+    Each rule is applied to every listing still valid before moving to the next, in the
+    order of ``validate_details``.
+    """
+    results = [(None, [])] * len(details_dicts)
+    valid_municipalities = set(valid_municipalities)
+    rules = (
+        ('missing', missing_fields),
+        ('invalid_municipality', lambda details: ['Municipality'] if details['Municipality'] not in valid_municipalities else []),
+        ('invalid', invalid_numeric_fields),
+        ('out_of_range', out_of_range_fields),
+    )
+    pending = list(range(len(details_dicts)))
+    for rule, check in rules:
+        still_valid = []
+        for index in pending:
+            fields = check(details_dicts[index])
+            if fields:
+                results[index] = (rule, fields)
+            else:
+                still_valid.append(index)
+        pending = still_valid
+    return results
+
+def validate_known_fields(details_dict: dict, pending) -> tuple:
+    """Apply the numeric rules to the fields already known, skipping the ``pending`` ones.
+
+    Used while the extraction is still streaming: a failure here can no longer be fixed by
+    the fields yet to come. Returns ``(rule, fields)`` like ``validate_details``.
+    """
+    known = [field for field in NUMERIC_FIELDS if field not in pending]
+    missing = [field for field in known if details_dict.get(field) is None]
+    if missing:
+        return 'missing', missing
+    invalid = invalid_numeric_fields(details_dict, known)
+    if invalid:
+        return 'invalid', invalid
+    out_of_range = out_of_range_fields(details_dict, known)
+    if out_of_range:
+        return 'out_of_range', out_of_range
+    return None, []
+
+# Clase para representar los datos requeridos de un departamento
+class ApartmentDetails:
+    def __init__(self, size_terrain, size_construction, rooms, bathrooms, parking, age, lat, lng, municipality):
+        """Initialize the apartment details."""
+        self.Size_Terrain = size_terrain
+        self.Size_Construction = size_construction
+        self.Rooms = rooms
+        self.Bathrooms = bathrooms
+        self.Parking = parking
+        self.Age = age
+        self.Lat = lat
+        self.Lng = lng
+        self.Municipality = municipality
+
+    @classmethod
+    def from_dict(cls, details_dict: dict) -> 'ApartmentDetails':
+        """Build the apartment details from a dictionary with the API field names."""
+        return cls(
+            size_terrain=details_dict['Size_Terrain'],
+            size_construction=details_dict['Size_Construction'],
+            rooms=details_dict['Rooms'],
+            bathrooms=details_dict['Bathrooms'],
+            parking=details_dict['Parking'],
+            age=details_dict['Age'],
+            lat=details_dict['Lat'],
+            lng=details_dict['Lng'],
+            municipality=details_dict['Municipality']
+        )
+
+# Clase para representar la predicción de precios
+class PricePrediction:
+    def __init__(self, random_forest, svm, neural_network):
+        """Initialize the price prediction."""
+        self.Random_Forest = random_forest
+        self.SVM = svm
+        self.Neural_Network = neural_network
+
+    @classmethod
+    def from_dict(cls, response_json: dict) -> 'PricePrediction':
+        """Build the price prediction from a SkyPrice API response."""
+        return cls(
+            random_forest=response_json['random_forest'],
+            svm=response_json['svm'],
+            neural_network=response_json['neural_network']
+        )
+
+class FallbackPrediction(PricePrediction):
+    def __init__(self, price):
+        """Local estimate used while the SkyPrice API is unavailable; the three models share the same price."""
+        super().__init__(price, price, price)
@@ -0,0 +1,274 @@
+# @Author: Humberto Alejandro Ortega Alcocer
+# @Date: 2024-Junio-24
+# @Description: Extractor local basado en reglas (es/en/fr/pt) que resuelve los detalles del departamento sin llamar al LLM.
+# @License: MIT
+import datetime
+import re
+from typing import List, Optional
+
+from skyprice_cache import normalize_text
+from skyprice_geo import gazetteer
+from skyprice_models import APARTMENT_FIELDS
+
+# Números escritos con palabras en los idiomas soportados (texto ya normalizado, sin acentos)
+NUMBER_WORDS = {
+    # Español
+    'un': 1, 'uno': 1, 'una': 1, 'dos': 2, 'tres': 3, 'cuatro': 4, 'cinco': 5,
+    'seis': 6, 'siete': 7, 'ocho': 8, 'nueve': 9, 'diez': 10,
+    # English
+    'a': 1, 'an': 1, 'one': 1, 'two': 2, 'three': 3, 'four': 4, 'five': 5,
+    'six': 6, 'seven': 7, 'eight': 8, 'nine': 9, 'ten': 10,
+    # Français
+    'une': 1, 'deux': 2, 'trois': 3, 'quatre': 4, 'cinq': 5, 'sept': 7, 'huit': 8, 'neuf': 9, 'dix': 10,
+    # Português
+    'um': 1, 'uma': 1, 'dois': 2, 'duas': 2, 'quatro': 4, 'sete': 7, 'oito': 8, 'nove': 9, 'dez': 10,
+}
+
+# Cantidad: dígitos (con punto o coma decimal) o número escrito con palabras
+COUNT = r'(\d+(?:[.,]\d+)?|' + '|'.join(sorted(NUMBER_WORDS, key=len, reverse=True)) + r')'
+
+# Superficie: admite separador de miles (1,200 / 1.200) y decimales
+AREA = r'(\d{1,3}(?:[.,]\d{3})+|\d+(?:[.,]\d+)?)'
+AREA_UNIT = (
+    r'(?:m2|mts2|mt2|m\^2|mts|metros cuadrados|metros|sq\.? ?m|square meters|square metres|sqm|'
+    r'metres carres|metres|metros quadrados)'
+)
+
+# Palabras clave que califican una superficie como terreno o construcción
+TERRAIN_WORDS = r'(?:terreno|lote|predio|terrain|land|lot|plot)'
+CONSTRUCTION_WORDS = r'(?:construccion|construidos?|construction|built|construit|construcao|habitables?|living)'
+
+# Expresiones precompiladas por campo
+AREA_RE = re.compile(r'\b' + AREA + r'\s*' + AREA_UNIT + r'(?![a-z])')
+TERRAIN_AFTER_RE = re.compile(r'^\s*(?:\w+\s+){0,3}?' + TERRAIN_WORDS + r'\b')
+CONSTRUCTION_AFTER_RE = re.compile(r'^\s*(?:\w+\s+){0,3}?' + CONSTRUCTION_WORDS + r'\b')
+TERRAIN_BEFORE_RE = re.compile(r'\b' + TERRAIN_WORDS + r'\b[^,;0-9]{0,20}$')
+CONSTRUCTION_BEFORE_RE = re.compile(r'\b' + CONSTRUCTION_WORDS + r'\b[^,;0-9]{0,20}$')
+ROOMS_RE = re.compile(
+    r'\b' + COUNT + r'\s+(?:recamaras?|recs?|habitacion(?:es)?|cuartos?(?!\s+de\s+bano)|dormitorios?|alcobas?|'
+    r'bedrooms?|rooms?|beds?|chambres?|quartos?)\b'
+)
+BATHROOMS_RE = re.compile(
+    r'\b' + COUNT + r'\s+(?:banos?(?:\s+completos?)?|cuartos?\s+de\s+bano|sanitarios?|full\s+baths?|bathrooms?|baths?|'
+    r'salles?\s+de\s+bains?|salles?\s+d\'eau|banheiros?)\b(\s+(?:y|and\s+a|et|e)\s+(?:medio|half|demi|demie|meio))?'
+)
+HALF_BATHROOMS_RE = re.compile(
+    r'\b' + COUNT + r'\s+(?:medios?\s+banos?|half\s+baths?|half\s+bathrooms?|demi-salles?\s+de\s+bains?|lavabos?|meios?\s+banheiros?)\b'
+)
+PARKING_RE = re.compile(
+    r'\b' + COUNT + r'\s+(?:estacionamientos?|cajon(?:es)?(?:\s+de\s+estacionamiento)?|lugar(?:es)?\s+de\s+estacionamiento|estac|cocheras?|'
+    r'parking\s+(?:spaces?|spots?)|parking|garages?|car\s+spaces?|places?\s+de\s+(?:parking|stationnement)|parkings?|'
+    r'vagas?(?:\s+de\s+(?:garagem|estacionamento))?|garagens?)\b'
+)
+NO_PARKING_RE = re.compile(
+    r'\b(?:sin\s+estacionamiento|no\s+parking|without\s+parking|sans\s+(?:parking|stationnement)|sem\s+(?:vaga|garagem|estacionamento))\b'
+)
+AGE_RE = re.compile(
+    r'\b' + COUNT + r'\s+(?:anos|ano|years?|yrs?|ans|an)\b(?:\s+(?:de\s+antiguedad|de\s+construido|old|d\'anciennete|de\s+idade|de\s+construcao))?'
+)
+BUILT_YEAR_RE = re.compile(
+    r'\b(?:construid[oa]s?\s+en|del\s+ano|built\s+in|year\s+built|construit\s+en|construid[oa]s?\s+em|ano\s+de\s+construcao)\s*:?\s*((?:19|20)\d{2})\b'
+)
+NEW_RE = re.compile(
+    r'\b(?:a\s+estrenar|nuevo|nueva|brand\s+new|new\s+build|newly\s+built|neu(?:f|ve)(?!\s+(?:chambres|salles|places))|novo|nova)\b'
+)
+BARE_COUNT_RE = re.compile(r'^\s*' + COUNT + r'\s*[.!]?\s*$')
+LISTING_START_RE = re.compile(r'^[ \t]*(?:#?\d{1,2}[ \t]*[.):-]|[-•*▪])[ \t]+', re.MULTILINE)
+PARAGRAPH_BREAK_RE = re.compile(r'\n[ \t]*\n')
+COORDINATES_RE = re.compile(r'(?<![\d.])(19\.\d{3,})\s*,\s*(-99\.\d{3,}|-98\.\d{3,})(?![\d.])')
+
+class FastPathStats:
+    """Counters of how often the local extractor resolves a message on its own."""
+
+    def __init__(self):
+        self.messages = 0
+        self.fully_resolved = 0
+        self.partially_resolved = 0
+        self.unresolved = 0
+        self.fields_resolved = dict.fromkeys(APARTMENT_FIELDS, 0)
+
+    def record(self, details_dict: dict) -> None:
+        """Record the outcome of parsing one incoming message (the caller decides which parses count)."""
+        self.messages += 1
+        resolved = [field for field in APARTMENT_FIELDS if details_dict.get(field) is not None]
+        for field in resolved:
+            self.fields_resolved[field] += 1
+        if len(resolved) == len(APARTMENT_FIELDS):
+            self.fully_resolved += 1
+        elif resolved:
+            self.partially_resolved += 1
+        else:
+            self.unresolved += 1
+
+    def stats(self) -> dict:
+        """Return the counters and the full-resolution rate."""
+        return {
+            'messages': self.messages,
+            'fully_resolved': self.fully_resolved,
+            'partially_resolved': self.partially_resolved,
+            'unresolved': self.unresolved,
+            'full_resolution_rate': self.fully_resolved / self.messages if self.messages else 0.0,
+            'fields_resolved': dict(self.fields_resolved),
+        }
+
+# Contadores globales del extractor local
+fast_path_stats = FastPathStats()
+
+def parse_count(value: str) -> Optional[float]:
+    """Parse a quantity written with digits or words."""
+    if value in NUMBER_WORDS:
+        return NUMBER_WORDS[value]
+    try:
+        return float(value.replace(',', '.'))
+    except ValueError:
+        return None
+
+def parse_area(value: str) -> float:
+    """Parse a surface, treating 3-digit groups after a separator as thousands."""
+    if re.fullmatch(r'\d{1,3}(?:[.,]\d{3})+', value):
+        return float(re.sub(r'[.,]', '', value))
+    return float(value.replace(',', '.'))
+
+def as_number(value: float):
+    """Return integral values as int so they match the LLM output types."""
+    return int(value) if float(value).is_integer() else value
+
+def parse_bare_count(text: str):
+    """Return the quantity of a reply that is only a number (e.g. "3" or "tres"), else None."""
+    match = BARE_COUNT_RE.match(normalize_text(text))
+    return as_number(parse_count(match.group(1))) if match else None
+
+def parse_sizes(text: str) -> dict:
+    """Extract the terrain and construction sizes."""
+    terrain = construction = None
+    unqualified = []
+    for match in AREA_RE.finditer(text):
+        value = as_number(parse_area(match.group(1)))
+        after = text[match.end():match.end() + 40]
+        before = text[max(0, match.start() - 40):match.start()]
+        if TERRAIN_AFTER_RE.search(after):
+            terrain = terrain if terrain is not None else value
+        elif CONSTRUCTION_AFTER_RE.search(after):
+            construction = construction if construction is not None else value
+        elif TERRAIN_BEFORE_RE.search(before):
+            terrain = terrain if terrain is not None else value
+        elif CONSTRUCTION_BEFORE_RE.search(before):
+            construction = construction if construction is not None else value
+        else:
+            unqualified.append(value)
+
+    # A single unqualified surface describes the whole apartment
+    if terrain is None and construction is None and len(unqualified) == 1:
+        terrain = construction = unqualified[0]
+    else:
+        for value in unqualified:
+            if terrain is None:
+                terrain = value
+            elif construction is None:
+                construction = value
+    return {'Size_Terrain': terrain, 'Size_Construction': construction}
+
+def parse_bathrooms(text: str):
+    """Extract the number of bathrooms, counting half bathrooms as 0.5."""
+    total = None
+    match = BATHROOMS_RE.search(text)
+    if match:
+        total = parse_count(match.group(1))
+        if total is not None and match.group(2):
+            total += 0.5
+    half = HALF_BATHROOMS_RE.search(text)
+    if half:
+        halves = parse_count(half.group(1))
+        if halves is not None:
+            total = (total or 0) + 0.5 * halves
+    return as_number(total) if total is not None else None
+
+def parse_age(text: str):
+    """Extract the age in years from an explicit age, a construction year or a 'new' keyword."""
+    built = BUILT_YEAR_RE.search(text)
+    if built:
+        return max(0, datetime.date.today().year - int(built.group(1)))
+    match = AGE_RE.search(text)
+    if match:
+        age = parse_count(match.group(1))
+        if age is not None:
+            return as_number(age)
+    if NEW_RE.search(text):
+        return 0
+    return None
+
+def parse_location(text: str) -> dict:
+    """Extract the coordinates and resolve the municipality with the gazetteer."""
+    location = {'Lat': None, 'Lng': None, 'Municipality': None}
+    coordinates = COORDINATES_RE.search(text)
+    if coordinates:
+        location['Lat'], location['Lng'] = float(coordinates.group(1)), float(coordinates.group(2))
+    return gazetteer.resolve(location, text)
+
+def parse_apartment_details(text: str) -> dict:
+    """Parse the apartment details with the local rules.
+
+    Returns a dictionary with every field of ApartmentDetails; fields that could not be
+    resolved are None so the caller can ask the LLM for those only.
+    """
+    normalized = normalize_text(text)
+    details_dict = dict.fromkeys(APARTMENT_FIELDS)
+    details_dict.update(parse_sizes(normalized))
+
+    rooms = ROOMS_RE.search(normalized)
+    if rooms:
+        details_dict['Rooms'] = as_number(parse_count(rooms.group(1)))
+
+    details_dict['Bathrooms'] = parse_bathrooms(normalized)
+
+    parking = PARKING_RE.search(normalized)
+    if parking:
+        details_dict['Parking'] = as_number(parse_count(parking.group(1)))
+    elif NO_PARKING_RE.search(normalized):
+        details_dict['Parking'] = 0
+
+    details_dict['Age'] = parse_age(normalized)
+    details_dict.update(parse_location(normalized))
+
+    return details_dict
+
+def is_listing(text: str) -> bool:
+    """Return whether a block of text describes an apartment: a surface plus another detail."""
+    normalized = normalize_text(text)
+    if not AREA_RE.search(normalized):
+        return False
+    return any(pattern.search(normalized) for pattern in (ROOMS_RE, BATHROOMS_RE, PARKING_RE, AGE_RE))
+
+def split_listings(text: str) -> List[str]:
+    """Split a message that describes several apartments into one text per listing.
+
+    Blocks are separated by blank lines or start with an enumerator ("1.", "2)", "-", "•").
+    Blocks that are not a listing on their own stay with the listing before them, and text
+    before the first listing (e.g. "Depas en Coyoacán:") is prepended to every listing.
+    Returns ``[text]`` when fewer than two listings are found.
+    """
+    blocks = []
+    for paragraph in PARAGRAPH_BREAK_RE.split(text):
+        starts = [match.start() for match in LISTING_START_RE.finditer(paragraph)]
+        if len(starts) < 2:
+            blocks.append(paragraph)
+            continue
+        cuts = ([0] if starts[0] > 0 else []) + starts + [len(paragraph)]
+        blocks.extend(paragraph[start:end] for start, end in zip(cuts, cuts[1:]))
+
+    preamble, listings = [], []
+    for block in (block.strip() for block in blocks):
+        if not block:
+            continue
+        if is_listing(block):
+            listings.append(block)
+        elif listings:
+            listings[-1] = f'{listings[-1]}\n{block}'
+        else:
+            preamble.append(block)
+    if len(listings) < 2:
+        return [text]
+    if preamble:
+        prefix = '\n'.join(preamble)
+        listings = [f'{prefix}\n{listing}' for listing in listings]
+    return listings
@@ -0,0 +1,146 @@
+# @Author: Humberto Alejandro Ortega Alcocer
+# @Date: 2024-Junio-24
+# @Description: Respuestas del bot en un solo mensaje editado progresivamente, con throttling y reintentos con backoff.
+# @License: MIT
+import asyncio
+import logging
+import random
+from typing import Awaitable, Callable, Optional
+
+import httpx
+from telegram import Message
+from telegram.error import BadRequest, NetworkError, RetryAfter
+
+from skyprice_limits import RateLimiter
+
+# Get the logger instance
+logger = logging.getLogger(__name__)
+
+# Ediciones finales pendientes (se conserva la referencia hasta que terminan)
+pending_deliveries = set()
+
+async def drain_pending_deliveries(timeout: Optional[float] = None) -> int:
+    """Wait up to ``timeout`` seconds for the final edits still in flight; returns how many did not finish."""
+    if not pending_deliveries:
+        return 0
+    _, pending = await asyncio.wait(set(pending_deliveries), timeout=timeout)
+    if pending:
+        logger.info("%s final replies were still pending after %ss", len(pending), timeout)
+    return len(pending)
+
+def request_not_sent(error: NetworkError) -> bool:
+    """Return whether a failed Bot API call never reached Telegram (so repeating it is safe)."""
+    return isinstance(error.__cause__, (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout))
+
+async def send_with_retry(call: Callable[[], Awaitable], retries: int = 3, backoff: float = 0.5, idempotent: bool = False):
+    """Run a Bot API call, retrying flood-control and network errors with exponential backoff.
+
+    Network errors (timeouts included) are only retried for ``idempotent`` calls (e.g. edits)
+    or when the request never left: Telegram may have accepted a sendMessage that timed out
+    waiting for the answer, and sending it again would duplicate the reply.
+    Returns the call's result, or None if every attempt failed (the error is logged, not raised).
+    """
+    for attempt in range(retries + 1):
+        try:
+            return await call()
+        except RetryAfter as e:
+            retry_after = e.retry_after
+            delay = retry_after.total_seconds() if hasattr(retry_after, 'total_seconds') else float(retry_after)
+        except BadRequest as e:
+            if 'not modified' in str(e).lower():
+                return None
+            logger.info("Telegram rejected the request: %s", e)
+            return None
+        except NetworkError as e:
+            if not idempotent and not request_not_sent(e):
+                logger.info("Telegram request failed (%s) and may have been delivered, not retrying", e)
+                return None
+            delay = backoff * 2 ** attempt * (1 + random.random() / 2)
+            logger.info("Telegram request failed (%s), attempt %s of %s", e, attempt + 1, retries + 1)
+        if attempt < retries:
+            await asyncio.sleep(delay)
+    logger.info("Giving up on the Telegram request after %s attempts", retries + 1)
+    return None
+
+class ProgressReply:
+    """Reply to a message, either with one message per stage or with a single edited message.
+
+    In ``messages`` mode every ``reply`` sends a new message (with retries). In ``edit`` mode
+    the replies update one message: non-final updates wait ``delay`` seconds so a quicker
+    next stage replaces them, operations on the message are throttled to one per
+    ``min_interval`` seconds (with a burst of two, as Telegram allows short bursts), and
+    ``finish`` delivers the last text. A valuation that completes within ``delay`` costs a
+    single sendMessage; a slower one, a sendMessage and one edit.
+    """
+
+    def __init__(self, message: Message, mode: str = 'messages', delay: float = 0.5, min_interval: float = 1.0,
+                 retries: int = 3, backoff: float = 0.5):
+        self.message = message
+        self.mode = mode
+        self.delay = delay
+        self.min_interval = min_interval
+        self.retries = retries
+        self.backoff = backoff
+        self.calls = 0
+        self._text = None
+        self._shown = None
+        self._sent = None
+        self._limiter = RateLimiter(1 / min_interval if min_interval > 0 else 0, burst=2)
+        self._flush = None
+        self._flush_waiting = False
+        self._lock = asyncio.Lock()
+
+    async def reply(self, text: str, append: bool = False) -> None:
+        """Show a new stage; with ``append`` the text is added below the current one."""
+        if self.mode != 'edit':
+            self.calls += 1
+            await send_with_retry(lambda: self.message.reply_text(text), self.retries, self.backoff)
+            return
+        self._text = f'{self._text}\n\n{text}' if append and self._text else text
+        if self._flush is None or self._flush.done():
+            self._flush_waiting = True
+            self._flush = asyncio.ensure_future(self._flush_later())
+
+    async def finish(self) -> None:
+        """Deliver the latest text as soon as the minimum interval allows.
+
+        A final edit that must wait for the interval is delivered in the background, so the
+        handler (and its concurrency slot) is released right away.
+        """
+        if self.mode != 'edit':
+            return
+        if self._flush is not None and not self._flush.done():
+            if self._flush_waiting:
+                self._flush.cancel()
+            else:
+                await self._flush
+        if not self._limiter.would_wait():
+            await self._deliver()
+            return
+        task = asyncio.ensure_future(self._deliver())
+        pending_deliveries.add(task)
+        task.add_done_callback(pending_deliveries.discard)
+
+    async def _flush_later(self) -> None:
+        try:
+            await asyncio.sleep(self.delay)
+        finally:
+            self._flush_waiting = False
+        await self._deliver()
+
+    async def _deliver(self) -> None:
+        async with self._lock:
+            text = self._text
+            if text is None or text == self._shown:
+                return
+            await self._limiter.acquire()
+            self.calls += 1
+            if self._sent is None:
+                self._sent = await send_with_retry(lambda: self.message.reply_text(text), self.retries, self.backoff)
+                if self._sent is None:
+                    return
+            else:
+                edited = await send_with_retry(lambda: self._sent.edit_text(text), self.retries, self.backoff, idempotent=True)
+                if edited is None:
+                    return
+            self._shown = text
@@ -0,0 +1,206 @@
+# @Author: Humberto Alejandro Ortega Alcocer
+# @Date: 2024-Junio-24
+# @Description: Grabación opcional de valuaciones (texto redactado, respuestas crudas del LLM, detalles y predicciones) en segmentos JSONL comprimidos para reproducirlas después.
+# @License: MIT
+import contextvars
+import glob
+import gzip
+import json
+import os
+import queue
+import random
+import re
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+from typing import Iterable, Iterator, Optional
+
+# Versión del formato de cada registro
+RECORD_VERSION = 1
+
+# Datos personales que se reemplazan en el texto grabado; un teléfono termina en un grupo de cuatro
+# dígitos, así que las listas de cantidades, coordenadas y precios del anuncio se conservan
+EMAIL_RE = re.compile(r'[\w.+-]+@[\w-]+(?:\.[\w-]+)+')
+URL_RE = re.compile(r'(?:https?://|www\.)\S+', re.IGNORECASE)
+HANDLE_RE = re.compile(r'(?<![\w@])@\w{3,}')
+PHONE_RE = re.compile(r'(?<![\w.])(?:\+\d{1,3}[ -]?)?(?:\(\d{2,3}\)|\d{2,3})[ -]?\d{3,4}[ -]?\d{4}(?![\w.])')
+
+# Registro en curso (uno por valuación); las funciones del pipeline le agregan eventos
+current_record = contextvars.ContextVar('skyprice_record', default=None)
+
+def redact_text(text: str) -> str:
+    """Replace emails, URLs, handles and phone numbers with placeholders."""
+    text = EMAIL_RE.sub('<email>', text)
+    text = URL_RE.sub('<url>', text)
+    text = HANDLE_RE.sub('<handle>', text)
+    return PHONE_RE.sub('<phone>', text)
+
+def record_event(kind: str, event: dict) -> None:
+    """Append an event (e.g. ``llm`` or ``skyprice``) to the valuation being recorded, if any."""
+    record = current_record.get()
+    if record is not None:
+        record.setdefault(kind, []).append(event)
+
+def record_field(name: str, value) -> None:
+    """Set a field of the valuation being recorded, if any."""
+    record = current_record.get()
+    if record is not None:
+        record[name] = value
+
+def discard_record() -> None:
+    """Drop the valuation being recorded (e.g. a follow-up that cannot be replayed alone)."""
+    record = current_record.get()
+    if record is not None:
+        record['discarded'] = True
+
+class Recorder:
+    """Append-only recorder of valuations into gzip JSONL segments under ``directory``.
+
+    Each valuation runs inside ``session(text)``; the pipeline adds its events through
+    ``record_event``/``record_field`` and the finished record is queued, so the handler
+    never waits for the disk. A writer thread, started with the first record, appends the
+    records to the current segment (flushed after each batch, so a crash loses at most the
+    last one) and starts a new segment every ``segment_bytes``. Only a ``sample_rate`` fraction of the valuations is
+    recorded; without a directory the recorder is off and ``session`` costs nothing.
+    """
+
+    def __init__(self, directory: Optional[str], segment_bytes: int = 16 * 1024 * 1024, sample_rate: float = 1.0,
+                 redact: bool = True, flush_interval: float = 1.0):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.sample_rate = sample_rate
+        self.redact = redact
+        self.flush_interval = flush_interval
+        self.recorded = 0
+        self.written = 0
+        self.segments = 0
+        self.errors = 0
+        self._segment = None
+        self._segment_size = 0
+        self._queue = None
+        self._writer = None
+        self._lock = threading.Lock()
+        if directory:
+            # El hilo escritor (y el directorio) se crean con la primera grabación, no al importar el bot
+            self._queue = queue.SimpleQueue()
+
+    @property
+    def enabled(self) -> bool:
+        return self._queue is not None
+
+    @contextmanager
+    def session(self, text: str):
+        """Record the valuation of ``text`` run inside the block; yields the record (None when not recorded)."""
+        if self._queue is None or random.random() >= self.sample_rate:
+            yield None
+            return
+        record = {'v': RECORD_VERSION, 'time': round(time.time(), 3), 'text': redact_text(text) if self.redact else text}
+        token = current_record.set(record)
+        started = time.perf_counter()
+        try:
+            yield record
+        finally:
+            current_record.reset(token)
+            if not record.pop('discarded', False):
+                record['ms'] = round((time.perf_counter() - started) * 1000, 3)
+                self.recorded += 1
+                self._queue.put(record)
+                if self._writer is None:
+                    self._start_writer()
+
+    def _start_writer(self) -> None:
+        with self._lock:
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._write_loop, name='skyprice-recorder', daemon=True)
+                self._writer.start()
+
+    def _open_segment(self) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        name = f'valuations-{time.strftime("%Y%m%dT%H%M%S")}-{os.getpid()}-{self.segments}.jsonl.gz'
+        self._segment = gzip.open(os.path.join(self.directory, name), 'ab')
+        self._segment_size = 0
+        self.segments += 1
+
+    def _write_loop(self) -> None:
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            lines, events = [], []
+            deadline = time.monotonic() + self.flush_interval
+            # Agrupa lo que llegue durante flush_interval en una sola escritura
+            while True:
+                if item is None:
+                    stopping = True
+                    break
+                if isinstance(item, threading.Event):
+                    events.append(item)
+                    break
+                lines.append(json.dumps(item, ensure_ascii=False, separators=(',', ':'), default=str).encode('utf-8') + b'\n')
+                try:
+                    item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+            try:
+                for line in lines:
+                    if self._segment is None or self._segment_size >= self.segment_bytes:
+                        if self._segment is not None:
+                            self._segment.close()
+                        self._open_segment()
+                    self._segment.write(line)
+                    self._segment_size += len(line)
+                    self.written += 1
+                if self._segment is not None and lines:
+                    # Vacía el bloque comprimido: el segmento se puede leer aunque el proceso termine abruptamente
+                    self._segment.flush()
+            except OSError:
+                self.errors += len(lines)
+            for event in events:
+                event.set()
+        if self._segment is not None:
+            self._segment.close()
+
+    def flush(self, timeout: Optional[float] = None) -> None:
+        """Wait until every record queued so far has been written."""
+        if self._writer is not None:
+            event = threading.Event()
+            self._queue.put(event)
+            event.wait(timeout)
+
+    def stats(self) -> dict:
+        """Return the valuations recorded, the records written, the segments opened and the write errors."""
+        return {'recorded': self.recorded, 'written': self.written, 'segments': self.segments, 'errors': self.errors}
+
+    def close(self) -> None:
+        """Write the pending records, close the current segment and stop the writer thread."""
+        if self._writer is not None:
+            self._queue.put(None)
+            self._writer.join()
+            self._writer = None
+        self._queue = None
+
+def recording_paths(paths: Iterable[str]) -> list:
+    """Expand directories into their segments (``*.jsonl.gz`` and ``*.jsonl``), in name order."""
+    expanded = []
+    for path in paths:
+        if os.path.isdir(path):
+            expanded.extend(sorted(glob.glob(os.path.join(path, '*.jsonl.gz')) + glob.glob(os.path.join(path, '*.jsonl'))))
+        else:
+            expanded.append(path)
+    return expanded
+
+def read_records(paths: Iterable[str]) -> Iterator[dict]:
+    """Read the records of recording segments or directories; a truncated tail is skipped."""
+    for path in recording_paths(paths):
+        opener = gzip.open if path.endswith('.gz') else open
+        with opener(path, 'rt', encoding='utf-8') as segment:
+            try:
+                for line in segment:
+                    if line.strip():
+                        try:
+                            yield json.loads(line)
+                        except ValueError:
+                            # Última línea incompleta de un segmento que se estaba escribiendo
+                            break
+            except (EOFError, gzip.BadGzipFile, zlib.error):
+                continue
@@ -0,0 +1,250 @@
+# @Author: Humberto Alejandro Ortega Alcocer
+# @Date: 2024-Junio-24
+# @Description: Resiliencia de las llamadas a SkyPrice: solicitudes duplicadas (hedging), circuit breaker y estimador local de respaldo.
+# @License: MIT
+import asyncio
+import math
+import threading
+import time
+from collections import deque
+from typing import Awaitable, Callable, Iterable, Optional, Tuple
+
+from skyprice_cache import normalize_text
+
+class CircuitOpenError(Exception):
+    """The circuit breaker is open, so the upstream was not called."""
+
+class CircuitBreaker:
+    """Stop calling an upstream after ``failure_threshold`` consecutive failures.
+
+    While open every call fails fast with CircuitOpenError. After ``reset_timeout``
+    seconds the breaker is half-open: a single trial call goes through, and its outcome
+    closes the breaker again or reopens it for another ``reset_timeout``.
+    """
+
+    CLOSED, HALF_OPEN, OPEN = 'closed', 'half_open', 'open'
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened = 0
+        self.rejected = 0
+        self._consecutive = 0
+        self._opened_at = None
+        self._trial = False
+
+    @property
+    def state(self) -> str:
+        if self._opened_at is None:
+            return self.CLOSED
+        return self.HALF_OPEN if time.monotonic() - self._opened_at >= self.reset_timeout else self.OPEN
+
+    async def call(self, function: Callable[[], Awaitable], is_failure: Callable[[BaseException], bool] = lambda error: True):
+        """Await ``function()`` unless the breaker is open; errors for which ``is_failure`` is False count as successes."""
+        state = self.state
+        if state == self.OPEN or (state == self.HALF_OPEN and self._trial):
+            self.rejected += 1
+            raise CircuitOpenError(f'circuit open for {self.reset_timeout - (time.monotonic() - self._opened_at):.1f}s')
+        trial = state == self.HALF_OPEN
+        self._trial = self._trial or trial
+        try:
+            result = await function()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            if is_failure(e):
+                self.record_failure()
+            else:
+                self.record_success()
+            raise
+        finally:
+            if trial:
+                self._trial = False
+        self.record_success()
+        return result
+
+    def record_success(self) -> None:
+        self._consecutive = 0
+        self._opened_at = None
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        self._consecutive += 1
+        if self._opened_at is not None or self._consecutive >= self.failure_threshold:
+            # Falla en el intento de prueba o demasiadas fallas seguidas: (re)abre el circuito
+            if self.state != self.OPEN:
+                self.opened += 1
+            self._opened_at = time.monotonic()
+
+    def reset(self) -> None:
+        """Close the breaker and forget the consecutive failures."""
+        self._consecutive = 0
+        self._opened_at = None
+        self._trial = False
+
+    def stats(self) -> dict:
+        """Return the state (0 closed, 1 half-open, 2 open), how often it opened, the failures and the calls rejected."""
+        return {
+            'state': (self.CLOSED, self.HALF_OPEN, self.OPEN).index(self.state),
+            'opened': self.opened,
+            'failures': self.failures,
+            'rejected': self.rejected,
+        }
+
+class HedgingPolicy:
+    """Send a duplicate request when the first one is slower than the recent ``quantile`` latency.
+
+    The first successful answer wins and the other request is cancelled. The delay is the
+    ``quantile`` of the last ``window`` successful latencies (at least ``min_delay``) and
+    hedging starts once ``min_samples`` are known. Each call earns ``max_ratio`` of a hedge
+    (banking at most ``max_burst``), so a slow upstream does not receive twice the load.
+    ``quantile=0`` disables it.
+    """
+
+    def __init__(self, quantile: float = 0.95, window: int = 200, min_samples: int = 20, min_delay: float = 0.01,
+                 max_ratio: float = 0.1, max_burst: float = 10.0):
+        self.quantile = quantile
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+        self.max_ratio = max_ratio
+        self.max_burst = max_burst
+        self.calls = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self._latencies = deque(maxlen=window)
+        self._delay = None
+        self._budget = 0.0
+
+    def observe(self, seconds: float) -> None:
+        """Record the latency of a successful request."""
+        self._latencies.append(seconds)
+        self._delay = None
+
+    def delay(self) -> Optional[float]:
+        """Return the seconds to wait before hedging, or None while hedging is off."""
+        if not self.quantile or len(self._latencies) < self.min_samples or self._budget < 1:
+            return None
+        if self._delay is None:
+            ordered = sorted(self._latencies)
+            self._delay = max(self.min_delay, ordered[min(len(ordered) - 1, int(self.quantile * len(ordered)))])
+        return self._delay
+
+    async def _timed(self, attempt: Callable[[], Awaitable]):
+        started = time.perf_counter()
+        result = await attempt()
+        self.observe(time.perf_counter() - started)
+        return result
+
+    async def call(self, attempt: Callable[[], Awaitable]):
+        """Await ``attempt()``, starting a second one if the first is slower than ``delay()``."""
+        self.calls += 1
+        self._budget = min(self.max_burst, self._budget + self.max_ratio)
+        tasks = [asyncio.ensure_future(self._timed(attempt))]
+        try:
+            delay = self.delay()
+            done, pending = await asyncio.wait(tasks, timeout=delay)
+            if not done:
+                self.hedged += 1
+                self._budget -= 1
+                tasks.append(asyncio.ensure_future(self._timed(attempt)))
+                pending = set(tasks)
+            while True:
+                errors = [task.exception() for task in done]
+                for task, error in zip(done, errors):
+                    if error is None:
+                        self.hedge_wins += task is not tasks[0]
+                        return task.result()
+                if not pending:
+                    raise errors[0]
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+    def stats(self) -> dict:
+        """Return the calls, how many were hedged (and the rate), how many the hedge won and the current delay (0 while off)."""
+        return {
+            'calls': self.calls,
+            'hedged': self.hedged,
+            'hedge_rate': self.hedged / self.calls if self.calls else 0.0,
+            'hedge_wins': self.hedge_wins,
+            'delay_s': self.delay() or 0.0,
+        }
+
+class FallbackEstimator:
+    """Local price estimate (price per m² times the construction size) for when SkyPrice is down.
+
+    The price per m² is the median of the past valuations around the apartment when
+    ``area_stats(lat, lng)`` finds at least ``min_samples``; otherwise the geometric mean of
+    its municipality, or of the whole city. The municipality means are calibrated from the
+    predictions observed by this process and, once, from ``load()``, which returns
+    ``(municipality, mean log price per m², count)`` rows (e.g. from the comparables store).
+    ``calibrate()`` runs that load; ``price_m2`` and ``estimate`` run it on first use otherwise.
+    They may block on ``area_stats`` and ``load``, so async callers run them in a thread.
+    """
+
+    def __init__(self, area_stats: Optional[Callable[[float, float], dict]] = None,
+                 load: Optional[Callable[[], Iterable[Tuple[str, float, int]]]] = None, min_samples: int = 5):
+        self.area_stats = area_stats
+        self.load = load
+        self.min_samples = min_samples
+        self.observed = 0
+        self.estimates = {}
+        self._log_sums = {}
+        self._counts = {}
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+
+    def _add(self, municipality: Optional[str], log_price_m2: float, count: int = 1) -> None:
+        # None acumula la ciudad completa
+        with self._lock:
+            for key in (normalize_text(str(municipality)) if municipality else None, None):
+                self._log_sums[key] = self._log_sums.get(key, 0.0) + log_price_m2 * count
+                self._counts[key] = self._counts.get(key, 0) + count
+
+    def calibrate(self) -> None:
+        """Add the municipality means from ``load()``, once (a full scan, meant for a thread at startup)."""
+        # Un candado aparte: las llamadas concurrentes esperan a que termine la primera carga
+        with self._load_lock:
+            if self.load is None:
+                return
+            load, self.load = self.load, None
+            for municipality, mean_log, count in load():
+                self._add(municipality, mean_log, count)
+
+    def observe(self, municipality: Optional[str], size: float, price: float) -> None:
+        """Calibrate with a SkyPrice prediction of an apartment."""
+        if size and float(size) > 0 and price > 0:
+            self.observed += 1
+            self._add(municipality, math.log(price / float(size)))
+
+    def price_m2(self, details: dict) -> Optional[Tuple[float, str]]:
+        """Return the price per m² for the apartment and its basis (``area``, ``municipality`` or ``city``)."""
+        if self.area_stats is not None and details.get('Lat') is not None and details.get('Lng') is not None:
+            area = self.area_stats(float(details['Lat']), float(details['Lng']))
+            if area['count'] >= self.min_samples:
+                return area['median'], 'area'
+        self.calibrate()
+        municipality = details.get('Municipality')
+        with self._lock:
+            for key, basis in ((normalize_text(str(municipality)) if municipality else None, 'municipality'), (None, 'city')):
+                if self._counts.get(key, 0) >= self.min_samples:
+                    return math.exp(self._log_sums[key] / self._counts[key]), basis
+        return None
+
+    def estimate(self, details: dict) -> Optional[float]:
+        """Return the estimated price of the apartment, or None without enough data."""
+        size = details.get('Size_Construction')
+        found = self.price_m2(details) if size else None
+        if found is None:
+            return None
+        price_m2, basis = found
+        with self._lock:
+            self.estimates[basis] = self.estimates.get(basis, 0) + 1
+        return price_m2 * float(size)
+
+    def stats(self) -> dict:
+        """Return the predictions observed and the estimates made by basis."""
+        return {'observed': self.observed, 'estimates': dict(self.estimates)}
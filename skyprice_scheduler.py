@@ -0,0 +1,161 @@
+# @Author: Humberto Alejandro Ortega Alcocer
+# @Date: 2024-Junio-24
+# @Description: Planificador justo (una fila por usuario, atendidas en round-robin) con control de admisión y descarte de carga.
+# @License: MIT
+import asyncio
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable, Hashable, Optional
+
+class SchedulerFull(Exception):
+    """A request was shed instead of queued; ``reason`` is ``user_queue``, ``queue`` or ``budget``."""
+
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+class FairScheduler:
+    """Admission control with one FIFO queue per key, served round-robin across keys.
+
+    At most ``max_active`` requests run at once and at most ``per_key_limit`` per key (1 keeps
+    each key's requests in order). A request is shed with SchedulerFull when its key already
+    has ``max_queued_per_key`` waiting, when ``max_queued`` are waiting overall, or when
+    ``backlog()`` (seconds of upstream budget already committed) exceeds ``max_wait``.
+    """
+
+    def __init__(self, max_active: int, per_key_limit: int = 1, max_queued_per_key: int = 5, max_queued: int = 1000,
+                 max_wait: float = 0.0, backlog: Optional[Callable[[], float]] = None):
+        self.max_active = max_active
+        self.per_key_limit = per_key_limit
+        self.max_queued_per_key = max_queued_per_key
+        self.max_queued = max_queued
+        self.max_wait = max_wait
+        self.backlog = backlog
+        self.active = 0
+        self.admitted = 0
+        self.delayed = 0
+        self.waited = 0.0
+        self.shed = {}
+        self._active_by_key = {}
+        # Filas con solicitudes en espera; el orden del diccionario es el turno del round-robin
+        self._queues = OrderedDict()
+
+    @property
+    def queued(self) -> int:
+        return sum(len(queue) for queue in self._queues.values())
+
+    def saturated(self) -> bool:
+        """Return whether every slot is taken."""
+        return self.active >= self.max_active
+
+    def _over_budget(self) -> bool:
+        return bool(self.max_wait) and self.backlog is not None and self.backlog() > self.max_wait
+
+    def _reject(self, reason: str) -> SchedulerFull:
+        self.shed[reason] = self.shed.get(reason, 0) + 1
+        return SchedulerFull(reason)
+
+    def _start(self, key: Hashable) -> None:
+        self.active += 1
+        self.admitted += 1
+        self._active_by_key[key] = self._active_by_key.get(key, 0) + 1
+
+    async def acquire(self, key: Hashable, on_queued: Optional[Callable[[int], Awaitable]] = None) -> None:
+        """Wait for a slot for ``key`` or raise SchedulerFull.
+
+        ``on_queued(position)`` is awaited when the request has to wait because every slot
+        is taken (not merely behind its own key's earlier requests).
+        """
+        if self._over_budget():
+            raise self._reject('budget')
+        queue = self._queues.get(key)
+        if not queue and self.active < self.max_active and self._active_by_key.get(key, 0) < self.per_key_limit:
+            self._start(key)
+            return
+        if queue is not None and len(queue) >= self.max_queued_per_key:
+            raise self._reject('user_queue')
+        if self.queued >= self.max_queued:
+            raise self._reject('queue')
+
+        future = asyncio.get_running_loop().create_future()
+        self._queues.setdefault(key, deque()).append(future)
+        self.delayed += 1
+        started = time.perf_counter()
+        try:
+            if on_queued is not None and self.saturated():
+                await on_queued(self.position(key, future))
+            await future
+        except BaseException:
+            if future.done() and not future.cancelled():
+                # The slot was granted while we were being cancelled: hand it to the next request
+                self.release(key)
+            else:
+                future.cancel()
+                self._discard(key, future)
+            raise
+        finally:
+            self.waited += time.perf_counter() - started
+
+    def release(self, key: Hashable) -> None:
+        """Free ``key``'s slot and start the next waiting requests in round-robin order."""
+        self.active -= 1
+        remaining = self._active_by_key[key] - 1
+        if remaining:
+            self._active_by_key[key] = remaining
+        else:
+            del self._active_by_key[key]
+        self._dispatch()
+
+    @asynccontextmanager
+    async def slot(self, key: Hashable, on_queued: Optional[Callable[[int], Awaitable]] = None):
+        """Hold a slot for ``key`` during the enclosed block."""
+        await self.acquire(key, on_queued)
+        try:
+            yield
+        finally:
+            self.release(key)
+
+    def position(self, key: Hashable, future: asyncio.Future) -> int:
+        """Estimate the 1-based turn of a waiting request, assuming no new arrivals."""
+        index = self._queues[key].index(future)
+        position, ahead = index + 1, True
+        for other, queue in self._queues.items():
+            if other == key:
+                ahead = False
+                continue
+            position += min(len(queue), index + 1 if ahead else index)
+        return position
+
+    def _dispatch(self) -> None:
+        while self.active < self.max_active:
+            key = next((key for key in self._queues if self._active_by_key.get(key, 0) < self.per_key_limit), None)
+            if key is None:
+                return
+            queue = self._queues.pop(key)
+            future = queue.popleft()
+            if queue:
+                # Turno al final de la rotación para que las demás llaves avancen
+                self._queues[key] = queue
+            self._start(key)
+            future.set_result(None)
+
+    def _discard(self, key: Hashable, future: asyncio.Future) -> None:
+        queue = self._queues.get(key)
+        if queue is None or future not in queue:
+            return
+        queue.remove(future)
+        if not queue:
+            del self._queues[key]
+
+    def stats(self) -> dict:
+        """Return the active and queued requests, how many had to wait or were shed, and the total wait."""
+        return {
+            'active': self.active,
+            'queued': self.queued,
+            'max_active': self.max_active,
+            'admitted': self.admitted,
+            'delayed': self.delayed,
+            'shed': dict(self.shed),
+            'waited_s': self.waited,
+        }
@@ -0,0 +1,117 @@
+# @Author: Humberto Alejandro Ortega Alcocer
+# @Date: 2024-Junio-24
+# @Description: Punto de entrada serverless: atiende una actualización del webhook por invocación con arranque en frío mínimo.
+# @Usage: handler skyprice_serverless.handler (evento HTTP de la plataforma o la actualización de Telegram directamente)
+# @License: MIT
+import asyncio
+import base64
+import hmac
+import json
+import logging
+import os
+import time
+
+# Este módulo solo importa la biblioteca estándar: el bot (y con él telegram) se carga con la primera
+# actualización que algún handler atiende, y los clientes de OpenAI y SkyPrice con su primer uso
+
+# Get the logger instance
+logger = logging.getLogger(__name__)
+
+# Secreto que Telegram envía en X-Telegram-Bot-Api-Secret-Token (el mismo del modo webhook)
+WEBHOOK_SECRET = os.getenv('SKYPRICE_WEBHOOK_SECRET', '')
+
+# Construir la aplicación al importar el módulo (en la fase de inicialización de la plataforma)
+SERVERLESS_EAGER = os.getenv('SKYPRICE_SERVERLESS_EAGER', '').lower() in ('1', 'true', 'yes')
+
+# Segundos máximos para escribir las extracciones, valuaciones y grabaciones pendientes antes de responder (la instancia puede congelarse)
+SERVERLESS_FLUSH_TIMEOUT = float(os.getenv('SKYPRICE_SERVERLESS_FLUSH_TIMEOUT', '1.0'))
+
+# Tipos de actualización que atiende algún handler del bot; el resto se confirma sin cargarlo
+HANDLED_UPDATES = ('message', 'edited_message', 'inline_query')
+
+# Estado reutilizado entre invocaciones de la misma instancia: el event loop (al que pertenecen las
+# conexiones HTTP abiertas), el módulo del bot y la aplicación ya inicializada
+_loop = None
+_bot = None
+_application = None
+_stats = {'invocations': 0, 'cold_starts': 0, 'ignored': 0, 'errors': 0, 'init_s': 0.0}
+
+def get_loop() -> asyncio.AbstractEventLoop:
+    """Return the event loop kept across warm invocations."""
+    global _loop
+    if _loop is None or _loop.is_closed():
+        _loop = asyncio.new_event_loop()
+    return _loop
+
+async def get_application():
+    """Import the bot and initialize its application once per instance."""
+    global _bot, _application
+    if _application is None:
+        started = time.perf_counter()
+        import skyprice_bot
+        skyprice_bot.configure_logging()
+        # Los archivos SQLite se abren aquí, en un hilo, y no con el primer handler que los usa
+        await asyncio.to_thread(skyprice_bot.open_stores)
+        application = skyprice_bot.build_application()
+        await application.initialize()
+        _bot, _application = skyprice_bot, application
+        _stats['cold_starts'] += 1
+        _stats['init_s'] = time.perf_counter() - started
+        logger.info("Serverless application ready in %.3fs", _stats['init_s'])
+    return _application
+
+async def process_update(data: dict) -> None:
+    """Run the handlers for one update until every reply has been sent."""
+    application = await get_application()
+    from telegram import Update
+    await application.process_update(Update.de_json(data, application.bot))
+    # Las ediciones finales del modo edit se envían en segundo plano: la instancia puede congelarse al responder
+    from skyprice_progress import drain_pending_deliveries
+    await drain_pending_deliveries(_bot.DELIVERY_DRAIN_TIMEOUT)
+
+def handle_update(body, secret_token: str = '') -> int:
+    """Process one webhook request body and return the HTTP status.
+
+    Unlike the webhook server, the answer is sent only after the update was handled, since
+    the platform may freeze the instance as soon as the function returns.
+    """
+    _stats['invocations'] += 1
+    if WEBHOOK_SECRET and not hmac.compare_digest(secret_token or '', WEBHOOK_SECRET):
+        return 403
+    try:
+        data = json.loads(body) if isinstance(body, (str, bytes)) else body
+    except ValueError:
+        return 400
+    if not isinstance(data, dict):
+        return 400
+    if not any(data.get(key) for key in HANDLED_UPDATES):
+        _stats['ignored'] += 1
+        return 200
+    try:
+        get_loop().run_until_complete(process_update(data))
+    except Exception:
+        # Telegram reintenta la entrega si la respuesta no es 2xx
+        _stats['errors'] += 1
+        logger.exception("Error processing update %s", data.get('update_id'))
+        return 500
+    _bot.extraction_cache.flush(SERVERLESS_FLUSH_TIMEOUT)
+    _bot.comparables_store.flush(SERVERLESS_FLUSH_TIMEOUT)
+    _bot.recorder.flush(SERVERLESS_FLUSH_TIMEOUT)
+    return 200
+
+def handler(event: dict, context=None) -> dict:
+    """Function entry point for HTTP events (``body``, ``headers``, ``isBase64Encoded``) or a bare update."""
+    if 'update_id' in event:
+        return {'statusCode': handle_update(event)}
+    body = event.get('body') or ''
+    if event.get('isBase64Encoded'):
+        body = base64.b64decode(body)
+    headers = {name.lower(): value for name, value in (event.get('headers') or {}).items()}
+    return {'statusCode': handle_update(body, headers.get('x-telegram-bot-api-secret-token', ''))}
+
+def stats() -> dict:
+    """Return the invocations, cold starts, ignored updates, errors and the last initialization time."""
+    return dict(_stats)
+
+if SERVERLESS_EAGER:
+    get_loop().run_until_complete(get_application())
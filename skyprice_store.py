@@ -0,0 +1,67 @@
+# @Author: Humberto Alejandro Ortega Alcocer
+# @Date: 2024-Junio-24
+# @Description: Almacén compartido (SQLite) de preferencias de usuario, accesible desde cualquier proceso del bot.
+# @License: MIT
+import asyncio
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+class PreferenceStore:
+    """Per-user preferences (e.g. the language) shared by every worker process.
+
+    Backed by a SQLite database in WAL mode so several processes on the same host can
+    read and write concurrently; ``path=None`` keeps the preferences in memory. Another
+    worker may hold the write lock for up to the 5 s busy timeout, so async callers use
+    ``aget_language`` and ``aset_language``, which run the query in a thread.
+    """
+
+    def __init__(self, path: Optional[str]):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path or ':memory:', check_same_thread=False, isolation_level=None, timeout=5.0)
+        if path:
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS user_preferences ('
+            'user_id INTEGER NOT NULL, name TEXT NOT NULL, value TEXT NOT NULL, updated_at REAL NOT NULL, '
+            'PRIMARY KEY (user_id, name))'
+        )
+
+    def get(self, user_id: int, name: str, default: Optional[str] = None) -> Optional[str]:
+        """Return a preference of the user, or the default."""
+        with self._lock:
+            row = self._db.execute(
+                'SELECT value FROM user_preferences WHERE user_id = ? AND name = ?', (user_id, name)
+            ).fetchone()
+        return row[0] if row else default
+
+    def set(self, user_id: int, name: str, value: str) -> None:
+        """Store a preference of the user."""
+        with self._lock:
+            self._db.execute(
+                'INSERT OR REPLACE INTO user_preferences (user_id, name, value, updated_at) VALUES (?, ?, ?, ?)',
+                (user_id, name, value, time.time())
+            )
+
+    def get_language(self, user_id: int) -> str:
+        """Return the language of the user (Spanish by default)."""
+        return self.get(user_id, 'language', 'es')
+
+    def set_language(self, user_id: int, language: str) -> None:
+        """Store the language of the user."""
+        self.set(user_id, 'language', language)
+
+    async def aget_language(self, user_id: int) -> str:
+        """Like ``get_language``, without blocking the event loop."""
+        return await asyncio.to_thread(self.get_language, user_id)
+
+    async def aset_language(self, user_id: int, language: str) -> None:
+        """Like ``set_language``, without blocking the event loop."""
+        await asyncio.to_thread(self.set_language, user_id, language)
+
+    def close(self) -> None:
+        """Close the database connection."""
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,77 @@
+# @Author: Humberto Alejandro Ortega Alcocer
+# @Date: 2024-Junio-24
+# @Description: Parser incremental de objetos JSON para procesar la respuesta del LLM mientras se transmite.
+# @License: MIT
+import json
+from typing import List, Tuple
+
+class IncrementalJSONParser:
+    """Parse a streamed JSON object, reporting each top-level member as soon as its value is complete.
+
+    Text before the opening brace (e.g. a Markdown fence) is ignored. Nested values are
+    returned whole once they close.
+    """
+
+    def __init__(self):
+        self.members = {}
+        self.complete = False
+        self._text = ''
+        self._pos = 0
+        self._depth = 0
+        self._state = 'start'
+        self._in_string = False
+        self._escape = False
+        self._start = 0
+        self._key = None
+
+    def feed(self, chunk: str) -> List[Tuple[str, object]]:
+        """Add streamed text and return the members completed by it, in order."""
+        self._text += chunk
+        completed = []
+        text = self._text
+        while self._pos < len(text) and not self.complete:
+            char = text[self._pos]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == '\\':
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+                    if self._state == 'key':
+                        self._key = json.loads(text[self._start:self._pos + 1])
+                        self._state = 'colon'
+            elif char == '"':
+                if self._depth > 0:
+                    self._in_string = True
+                    if self._state == 'key' and self._depth == 1:
+                        self._start = self._pos
+            elif char in '{[':
+                self._depth += 1
+                if self._depth == 1:
+                    self._state = 'key'
+            elif char in '}]' and self._depth > 0:
+                if self._depth == 1:
+                    if self._state == 'value':
+                        completed.append(self._member(self._pos))
+                    self.complete = True
+                self._depth -= 1
+            elif self._depth == 1 and char == ':' and self._state == 'colon':
+                self._state = 'value'
+                self._start = self._pos + 1
+            elif self._depth == 1 and char == ',' and self._state == 'value':
+                completed.append(self._member(self._pos))
+                self._state = 'key'
+            self._pos += 1
+        return completed
+
+    def _member(self, end: int) -> Tuple[str, object]:
+        value = json.loads(self._text[self._start:end])
+        self.members[self._key] = value
+        return self._key, value
+
+    def result(self) -> dict:
+        """Return the parsed object; raises ValueError if the object was not closed."""
+        if not self.complete:
+            raise ValueError('Incomplete JSON object')
+        return dict(self.members)
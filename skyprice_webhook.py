@@ -0,0 +1,308 @@
+# @Author: Humberto Alejandro Ortega Alcocer
+# @Date: 2024-Junio-24
+# @Description: Modo webhook del bot de SkyPrice: servidor HTTP embebido que reparte las actualizaciones entre N procesos.
+# @License: MIT
+import asyncio
+import hmac
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import time
+import zlib
+from typing import Awaitable, Callable, Optional
+
+from telegram import Bot, Update
+from telegram.ext import Application, BaseUpdateProcessor
+
+from skyprice_metrics import stage_seconds
+from skyprice_scheduler import FairScheduler, SchedulerFull
+
+# Get the logger instance
+logger = logging.getLogger(__name__)
+
+# Tamaño máximo aceptado para el cuerpo de una actualización
+MAX_BODY_SIZE = 1024 * 1024
+
+# Límite del semáforo de BaseUpdateProcessor: tan alto que nunca se alcanza, la concurrencia la
+# limita el planificador en do_process_update
+UNBOUNDED_UPDATES = 2 ** 31 - 1
+
+def update_chat_id(data: dict) -> int:
+    """Return the chat (or user) an update belongs to, used to route it to a worker."""
+    for key in ('message', 'edited_message', 'channel_post', 'edited_channel_post', 'business_message'):
+        if data.get(key):
+            return data[key]['chat']['id']
+    callback_query = data.get('callback_query')
+    if callback_query:
+        if callback_query.get('message'):
+            return callback_query['message']['chat']['id']
+        return callback_query['from']['id']
+    for key in ('inline_query', 'chosen_inline_result', 'shipping_query', 'pre_checkout_query', 'my_chat_member', 'chat_member', 'chat_join_request'):
+        if data.get(key):
+            payload = data[key]
+            return payload['chat']['id'] if 'chat' in payload else payload['from']['id']
+    return data.get('update_id', 0)
+
+def route_update(data: dict, workers: int) -> int:
+    """Return the worker index for an update; every update of a chat goes to the same worker."""
+    return zlib.crc32(str(update_chat_id(data)).encode('ascii')) % workers
+
+class TimedUpdateQueue(asyncio.Queue):
+    """Update queue that remembers when each update arrived, to measure how long it waited."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._arrivals = {}
+
+    def put_nowait(self, item) -> None:
+        super().put_nowait(item)
+        self._arrivals[id(item)] = time.perf_counter()
+
+    def pop_arrival(self, item) -> Optional[float]:
+        """Return (and forget) the arrival time of an update."""
+        return self._arrivals.pop(id(item), None)
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """Process updates concurrently across chats while keeping each chat's updates in order.
+
+    Admission goes through a ``FairScheduler`` keyed by chat: one update per chat runs at a
+    time and waiting chats are served round-robin, so a user who sends many messages cannot
+    starve the rest. The base class semaphore is given a limit that is never reached, so
+    updates waiting in the scheduler do not hold a slot. When the scheduler sheds an update the handler is skipped and
+    ``on_shed(update, reason)`` is awaited; ``on_queued(update, position)`` is awaited when an
+    update has to wait because every slot is taken. Inline queries skip the scheduler: their
+    handler mostly waits out the debounce and superseded queries return at once, so holding a
+    slot would only delay everyone else. With a ``TimedUpdateQueue`` the time from arrival
+    until the handler starts is recorded as the ``queue_wait`` stage.
+    """
+
+    def __init__(self, max_concurrent_updates: int, update_queue: Optional[TimedUpdateQueue] = None,
+                 scheduler: Optional[FairScheduler] = None,
+                 on_queued: Optional[Callable[[object, int], Awaitable]] = None,
+                 on_shed: Optional[Callable[[object, str], Awaitable]] = None):
+        super().__init__(UNBOUNDED_UPDATES)
+        self.update_queue = update_queue
+        self.scheduler = scheduler if scheduler is not None else FairScheduler(max_concurrent_updates)
+        self.on_queued = on_queued
+        self.on_shed = on_shed
+
+    def _record_queue_wait(self, update: object) -> None:
+        arrival = self.update_queue.pop_arrival(update) if self.update_queue is not None else None
+        if arrival is not None:
+            stage_seconds.observe(time.perf_counter() - arrival, stage='queue_wait')
+
+    async def do_process_update(self, update: object, coroutine: Awaitable) -> None:
+        if isinstance(update, Update) and update.inline_query is not None:
+            # El coordinador de consultas inline ya limita a una valuación por usuario
+            self._record_queue_wait(update)
+            await coroutine
+            return
+        chat_id = update.effective_chat.id if isinstance(update, Update) and update.effective_chat else None
+        key = chat_id if chat_id is not None else ('update', id(update))
+        on_queued = None
+        if self.on_queued is not None:
+            on_queued = lambda position: self.on_queued(update, position)
+        try:
+            await self.scheduler.acquire(key, on_queued)
+        except SchedulerFull as e:
+            if hasattr(coroutine, 'close'):
+                coroutine.close()
+            if self.update_queue is not None:
+                self.update_queue.pop_arrival(update)
+            if self.on_shed is not None:
+                await self.on_shed(update, e.reason)
+            return
+        try:
+            self._record_queue_wait(update)
+            await coroutine
+        finally:
+            self.scheduler.release(key)
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+class WebhookServer:
+    """Minimal HTTP/1.1 server that accepts Telegram webhook POSTs.
+
+    Each valid update is handed to ``on_update`` and answered with 200 right away, so
+    Telegram never waits for a valuation. ``GET /healthz`` reports liveness.
+    """
+
+    def __init__(self, on_update: Callable[[dict], None], path: str = '/telegram', secret_token: Optional[str] = None):
+        self.on_update = on_update
+        self.path = path
+        self.secret_token = secret_token
+        self.received = 0
+        self.server = None
+
+    async def start(self, host: str, port: int) -> None:
+        self.server = await asyncio.start_server(self._serve, host, port)
+        logger.info("Webhook server listening on %s:%s%s", host, port, self.path)
+
+    async def stop(self) -> None:
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+
+    async def _serve(self, reader, writer) -> None:
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, _ = request_line.decode('latin-1').split(' ', 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get('content-length', 0))
+                if length > MAX_BODY_SIZE:
+                    await self._respond(writer, 413)
+                    break
+                body = await reader.readexactly(length)
+                await self._respond(writer, self._handle(method, target, headers, body))
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    def _handle(self, method, target, headers, body) -> int:
+        """Validate the request and dispatch the update; returns the HTTP status."""
+        if method == 'GET' and target == '/healthz':
+            return 200
+        if method != 'POST' or target != self.path:
+            return 404
+        if self.secret_token and not hmac.compare_digest(
+            headers.get('x-telegram-bot-api-secret-token', ''), self.secret_token
+        ):
+            return 403
+        try:
+            data = json.loads(body)
+        except ValueError:
+            return 400
+        self.received += 1
+        self.on_update(data)
+        return 200
+
+    @staticmethod
+    async def _respond(writer, status: int) -> None:
+        reason = {200: 'OK', 400: 'Bad Request', 403: 'Forbidden', 404: 'Not Found', 413: 'Payload Too Large'}[status]
+        writer.write(f'HTTP/1.1 {status} {reason}\r\nContent-Length: 0\r\n\r\n'.encode('latin-1'))
+        await writer.drain()
+
+async def register_webhook(token: str, url: str, secret_token: Optional[str], base_url: Optional[str] = None) -> None:
+    """Point Telegram at our webhook URL."""
+    bot = Bot(token, base_url=base_url) if base_url else Bot(token)
+    async with bot:
+        await bot.set_webhook(url, secret_token=secret_token, allowed_updates=Update.ALL_TYPES)
+    logger.info("Webhook registered at %s", url)
+
+async def wait_for_stop_signal() -> None:
+    """Wait until SIGINT or SIGTERM is received."""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop.set)
+    await stop.wait()
+
+async def serve_in_process(application: Application, host: str, port: int, path: str, secret_token: Optional[str]) -> None:
+    """Run the webhook server and the application in the current process."""
+    async with application:
+        if application.post_init:
+            await application.post_init(application)
+        await application.start()
+        server = WebhookServer(
+            lambda data: application.update_queue.put_nowait(Update.de_json(data, application.bot)),
+            path=path, secret_token=secret_token,
+        )
+        await server.start(host, port)
+        await wait_for_stop_signal()
+        await server.stop()
+        await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+    if application.post_shutdown:
+        await application.post_shutdown(application)
+
+def worker_main(index: int, queue, ready) -> None:
+    """Entry point of a worker process: feed the routed updates into its own application."""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    os.environ['SKYPRICE_WORKER_INDEX'] = str(index)
+    from skyprice_bot import build_application, configure_logging
+    configure_logging()
+
+    async def run() -> None:
+        application = build_application()
+        loop = asyncio.get_running_loop()
+        async with application:
+            if application.post_init:
+                await application.post_init(application)
+            await application.start()
+            ready.set()
+            logger.info("Webhook worker %s ready", index)
+            while True:
+                data = await loop.run_in_executor(None, queue.get)
+                if data is None:
+                    break
+                await application.update_queue.put(Update.de_json(json.loads(data), application.bot))
+            await application.stop()
+            if application.post_stop:
+                await application.post_stop(application)
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+    asyncio.run(run())
+
+async def serve_with_workers(workers: int, host: str, port: int, path: str, secret_token: Optional[str]) -> None:
+    """Run the webhook server here and route each update to one of ``workers`` processes by chat id."""
+    context = multiprocessing.get_context('spawn')
+    queues = [context.Queue() for _ in range(workers)]
+    events = [context.Event() for _ in range(workers)]
+    processes = [
+        context.Process(target=worker_main, args=(index, queues[index], events[index]), name=f'skyprice-worker-{index}')
+        for index in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    loop = asyncio.get_running_loop()
+    for event in events:
+        await loop.run_in_executor(None, event.wait)
+
+    server = WebhookServer(
+        lambda data: queues[route_update(data, workers)].put(json.dumps(data)),
+        path=path, secret_token=secret_token,
+    )
+    await server.start(host, port)
+    await wait_for_stop_signal()
+    await server.stop()
+
+    for queue in queues:
+        queue.put(None)
+    for process in processes:
+        await loop.run_in_executor(None, process.join, 30)
+        if process.is_alive():
+            process.terminate()
+
+def run_webhook(build_application: Callable[[], Application], token: str, workers: int, host: str, port: int,
+                path: str, url: Optional[str], secret_token: Optional[str], base_url: Optional[str] = None) -> None:
+    """Start webhook mode; with a single worker everything runs in this process."""
+
+    async def run() -> None:
+        if url:
+            await register_webhook(token, url, secret_token, base_url)
+        if workers <= 1:
+            await serve_in_process(build_application(), host, port, path, secret_token)
+        else:
+            await serve_with_workers(workers, host, port, path, secret_token)
+
+    asyncio.run(run())